@@ -21,7 +21,7 @@ from cmp.stages.connectome.connectome import ConnectomeConfig, ConnectomeStage
 
 class ConnectomeConfigUI(ConnectomeConfig):
     output_types = List(['gPickle'], editor=CheckListEditor(
-        values=['gPickle', 'mat', 'cff', 'graphml'], cols=4))
+        values=['gPickle', 'mat', 'cff', 'graphml', 'npz'], cols=5))
     connectivity_metrics = List(
         ['Fiber number', 'Fiber length', 'Fiber density',
             'Fiber proportion', 'Normalized fiber density', 'ADC', 'gFA'],
@@ -34,6 +34,16 @@ class ConnectomeConfigUI(ConnectomeConfig):
                            Item('connectivity_metrics',
                                 label='Metrics', style='custom'),
                            Item('compute_curvature'),
+                           Item('number_of_workers', label='Number of workers'),
+                           Item('memory_budget', label='Memory budget (MB)'),
+                           Item('hierarchical_scales', label='Hierarchical scales'),
+                           Item('max_endpoint_distance', label='Max. endpoint distance (mm)'),
+                           Item('map_statistics', label='Map statistics'),
+                           Item('map_sketch_size', label='Map histogram bins',
+                                visible_when='map_statistics=="approximate" or memory_budget>0'),
+                           Item('compression_error', label='Final tractogram compression error (mm)'),
+                           Item('cache_dir', label='Fiber data cache'),
+                           Item('cache_disk_budget', label='Cache disk budget (MB)', visible_when='cache_dir!=""'),
                            label='Connectivity matrix', show_border=True
     ),
         # Group(
@@ -21,12 +21,22 @@ from cmp.stages.connectome.fmri_connectome import ConnectomeConfig, ConnectomeSt
 
 class ConnectomeConfigUI(ConnectomeConfig):
     output_types = List(['gPickle'], editor=CheckListEditor(
-        values=['gPickle', 'mat', 'cff', 'graphml'], cols=4))
+        values=['gPickle', 'mat', 'cff', 'graphml', 'npz'], cols=5))
+    connectivity_metrics = List(['corr'], editor=CheckListEditor(
+        values=[('corr', 'Correlation'), ('partial_corr', 'Partial correlation (Ledoit-Wolf)'),
+                ('tangent', 'Tangent space'), ('cov', 'Covariance')], cols=2))
 
     traits_view = View(VGroup('apply_scrubbing',
                               VGroup(Item('FD_thr', label='FD threshold'), Item('DVARS_thr', label='DVARS threshold'),
                                      visible_when="apply_scrubbing==True")),
-                       Item('output_types', style='custom'))
+                       Item('output_types', style='custom'),
+                       Item('connectivity_metrics', label='Metrics', style='custom'),
+                       VGroup('dynamic_fc',
+                              VGroup(Item('dfc_window_length', label='Window length'),
+                                     Item('dfc_step', label='Step'),
+                                     Item('dfc_dtype', label='Data type'),
+                                     visible_when="dynamic_fc==True")),
+                       Item('number_of_workers', label='Number of workers'))
 
 
 class ConnectomeStageUI(ConnectomeStage):
@@ -21,9 +21,17 @@ class Dipy_tracking_configUI(Dipy_tracking_config):
             Item('max_angle', label="Max angle (degree)"),
             Item('fa_thresh', label="FA threshold (classifier)",
                  visible_when='seed_from_gmwmi is False'),
+            Item('compression_error', label="Compression error (mm)"),
             label='Streamlines settings',
             orientation='vertical'
         ),
+        Group(
+            Item('build_connectome', label="Build connectomes while tracking"),
+            Item('connectome_chunk_size', label="Chunk size (streamlines)", visible_when='build_connectome'),
+            label='Connectome',
+            visible_when='SD or imaging_model=="DSI"',
+            orientation='vertical'
+        ),
         Group(
             Item('use_act', label="Use PFT"),
             Item('seed_from_gmwmi', visible_when='use_act'),
@@ -57,7 +65,8 @@ class MRtrix_tracking_configUI(MRtrix_tracking_config):
             Item('seed_from_gmwmi', visible_when='use_act'),
             label='Anatomically-Constrained Tractography (ACT)',
             orientation='vertical'
-        )
+        ),
+        Item('convert_to_trk', label='Convert to TrackVis .trk')
     ),
     )
 
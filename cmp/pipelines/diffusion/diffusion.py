@@ -679,6 +679,18 @@ class DiffusionPipeline(Pipeline):
                  self.subject + '_label-' + bids_atlas_label + '_desc-scale4_conndata-network_connectivity'),
                 ('connectome_scale5',
                  self.subject + '_label-' + bids_atlas_label + '_desc-scale5_conndata-network_connectivity'),
+                ('streamline_index_freesurferaparc', self.subject + \
+                 '_label-Desikan_desc-streamlineindex'),
+                ('streamline_index_scale1',
+                 self.subject + '_label-' + bids_atlas_label + '_desc-scale1_streamlineindex'),
+                ('streamline_index_scale2',
+                 self.subject + '_label-' + bids_atlas_label + '_desc-scale2_streamlineindex'),
+                ('streamline_index_scale3',
+                 self.subject + '_label-' + bids_atlas_label + '_desc-scale3_streamlineindex'),
+                ('streamline_index_scale4',
+                 self.subject + '_label-' + bids_atlas_label + '_desc-scale4_streamlineindex'),
+                ('streamline_index_scale5',
+                 self.subject + '_label-' + bids_atlas_label + '_desc-scale5_streamlineindex'),
                 ('dwi.nii.gz', self.subject + '_dwi.nii.gz'),
                 ('dwi.bval', self.subject + '_dwi.bval'),
                 # ('dwi.bvec',self.subject+'_dwi.bvec'),
@@ -821,6 +833,18 @@ class DiffusionPipeline(Pipeline):
                  self.subject + '_label-' + bids_atlas_label + '_desc-scale4_conndata-network_connectivity'),
                 ('connectome_scale5',
                  self.subject + '_label-' + bids_atlas_label + '_desc-scale5_conndata-network_connectivity'),
+                ('streamline_index_freesurferaparc', self.subject + \
+                 '_label-Desikan_desc-streamlineindex'),
+                ('streamline_index_scale1',
+                 self.subject + '_label-' + bids_atlas_label + '_desc-scale1_streamlineindex'),
+                ('streamline_index_scale2',
+                 self.subject + '_label-' + bids_atlas_label + '_desc-scale2_streamlineindex'),
+                ('streamline_index_scale3',
+                 self.subject + '_label-' + bids_atlas_label + '_desc-scale3_streamlineindex'),
+                ('streamline_index_scale4',
+                 self.subject + '_label-' + bids_atlas_label + '_desc-scale4_streamlineindex'),
+                ('streamline_index_scale5',
+                 self.subject + '_label-' + bids_atlas_label + '_desc-scale5_streamlineindex'),
                 ('dwi.nii.gz', self.subject + '_dwi.nii.gz'),
                 ('dwi.bval', self.subject + '_dwi.bval'),
                 # ('dwi.bvec',self.subject+'_dwi.bvec'),
@@ -1008,8 +1032,14 @@ class DiffusionPipeline(Pipeline):
                 ])
 
         if self.stages['Diffusion'].enabled:
+            # The connectomes are built by the Dipy tracking if build_connectome is set (see builds_connectome())
+            self.stages['Diffusion'].connectome_config = (self.stages['Connectome'].config
+                                                          if self.stages['Connectome'].enabled else None)
             diff_flow = self.create_stage_flow("Diffusion")
             diffusion_flow.connect([
+                (diffusion_inputnode, diff_flow, [('parcellation_scheme', 'inputnode.parcellation_scheme'),
+                                                  ('atlas_info', 'inputnode.atlas_info'),
+                                                  ('roi_graphMLs', 'inputnode.roi_graphMLs')]),
                 (reg_flow, diff_flow, [
                  ('outputnode.target_epicorrected', 'inputnode.diffusion')]),
                 # (reg_flow,diff_flow, [('outputnode.T1_registered_crop','inputnode.T1')]),
@@ -1083,13 +1113,33 @@ class DiffusionPipeline(Pipeline):
             #     self.stages['Connectome'].config.probtrackx = True
             # else:
             self.stages['Connectome'].config.probtrackx = False
+            self.stages['Connectome'].config.connectome_from_tracking = (self.stages['Diffusion'].enabled and
+                                                                         self.stages['Diffusion'].builds_connectome())
             self.stages['Connectome'].config.subject = self.global_conf.subject
             con_flow = self.create_stage_flow("Connectome")
+            if self.stages['Connectome'].config.connectome_from_tracking:
+                diffusion_flow.connect([
+                    (diff_flow, con_flow, [('outputnode.endpoints_file', 'inputnode.endpoints_file'),
+                                           ('outputnode.endpoints_mm_file', 'inputnode.endpoints_mm_file'),
+                                           ('outputnode.fiberslength_file', 'inputnode.fiberslength_file'),
+                                           ('outputnode.final_fiberslength_files',
+                                            'inputnode.final_fiberslength_files'),
+                                           ('outputnode.filtered_fiberslabel_files',
+                                            'inputnode.filtered_fiberslabel_files'),
+                                           ('outputnode.final_fiberlabels_files',
+                                            'inputnode.final_fiberlabels_files'),
+                                           ('outputnode.streamline_final_file', 'inputnode.streamline_final_file'),
+                                           ('outputnode.streamline_index_files',
+                                            'inputnode.streamline_index_files'),
+                                           ('outputnode.connectivity_matrices', 'inputnode.connectivity_matrices')])
+                ])
             diffusion_flow.connect([
                 (diffusion_inputnode, con_flow, [('parcellation_scheme', 'inputnode.parcellation_scheme'),
                                                  ('atlas_info',
                                                   'inputnode.atlas_info'),
                                                  ('roi_graphMLs', 'inputnode.roi_graphMLs')]),
+                # Voxel grid of the .tck tractograms, as for their conversion to .trk in the diffusion stage
+                (reg_flow, con_flow, [('outputnode.wm_mask_registered_crop', 'inputnode.wm_mask_registered')]),
                 (diff_flow, con_flow, [('outputnode.track_file', 'inputnode.track_file'),
                                        ('outputnode.FA', 'inputnode.FA'),
                                        ('outputnode.ADC', 'inputnode.ADC'),
@@ -1127,6 +1177,8 @@ class DiffusionPipeline(Pipeline):
                     #                 ('outputnode.final_fiberlabels_files','dwi.@final_fiberlabels_files'),
                     ('outputnode.streamline_final_file',
                      'dwi.@streamline_final_file'),
+                    ('outputnode.streamline_index_files',
+                     'dwi.@streamline_index_files'),
                     ("outputnode.connectivity_matrices",
                      "dwi.@connectivity_matrices")
                 ])
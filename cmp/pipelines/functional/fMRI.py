@@ -741,7 +741,9 @@ class fMRIPipeline(Pipeline):
                 (con_flow, sinker, [
                  ("outputnode.connectivity_matrices", "func.@connectivity_matrices")]),
                 (con_flow, sinker, [
-                 ("outputnode.avg_timeseries", "func.@avg_timeseries")])
+                 ("outputnode.avg_timeseries", "func.@avg_timeseries")]),
+                (con_flow, sinker, [
+                 ("outputnode.dynamic_connectivity_matrices", "func.@dynamic_connectivity_matrices")])
             ])
 
             # if self.parcellation_scheme == "Custom":
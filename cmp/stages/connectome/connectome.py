@@ -9,6 +9,7 @@
 
 # Global imports
 import os
+import glob
 
 from traits.api import *
 
@@ -30,10 +31,31 @@ from cmtklib.util import get_pipeline_dictionary_outputs
 class ConnectomeConfig(HasTraits):
     # modality = List(['Deterministic','Probabilistic'])
     probtrackx = Bool(False)
+    # Set by the pipeline when the connectomes are built by the Dipy tracking of the diffusion stage
+    connectome_from_tracking = Bool(False)
     compute_curvature = Bool(False)
     output_types = List(['gPickle', 'mat', 'cff', 'graphml'])
     connectivity_metrics = List(
         ['Fiber number', 'Fiber length', 'Fiber density', 'Fiber proportion', 'Normalized fiber density', 'ADC', 'gFA'])
+    number_of_workers = Int(1, desc="Number of processes used to build the connectomes of the different scales in parallel")
+    memory_budget = Int(0, desc="Memory budget (in MB) for the points of one chunk of fibers, used to process "
+                                "the tractogram by chunks (0: the whole tractogram is loaded in memory). The "
+                                "per-fiber arrays are memory-mapped and the per-edge arrays are not included "
+                                "in the budget")
+    hierarchical_scales = Bool(False, desc="Label the fiber endpoints in the finest scale only and derive "
+                                           "the labels of the nested coarser scales from it")
+    max_endpoint_distance = Float(0, desc="Maximal distance (in mm) at which the fiber endpoints falling in the "
+                                          "background are assigned to the nearest ROI (0: they are orphans)")
+    map_statistics = Enum('exact', ['exact', 'approximate'],
+                          desc="Statistics of the additional maps: exact or approximate in bounded memory "
+                               "(exact mean and std, approximated median)")
+    map_sketch_size = Int(16, desc="Number of bins of the per-edge histograms of the map values used by the "
+                                   "approximate statistics")
+    compression_error = Float(0, desc="Maximal error (in mm) of the lossy compression of the fibers saved in "
+                                      "the final tractogram (0: no compression)")
+    cache_dir = Directory(desc="Directory of the on-disk cache of the fiber data reused by the reruns "
+                               "with other maps or output types (empty: no cache)")
+    cache_disk_budget = Int(0, desc="Disk budget (in MB) of the fiber data cache (0: unlimited)")
     log_visualization = Bool(True)
     circular_layout = Bool(False)
     subject = Str
@@ -48,19 +70,39 @@ class ConnectomeStage(Stage):
 
         self.config = ConnectomeConfig()
         self.inputs = ["roi_volumes_registered", "roi_graphMLs",
-                       "track_file",
+                       "track_file", "wm_mask_registered",
                        "parcellation_scheme", "atlas_info",
                        "FA", "ADC", "AD", "RD",
                        "skewness", "kurtosis", "P0",
-                       "shore_maps", "mapmri_maps"]
-        self.outputs = ["endpoints_file", "endpoints_mm_file", "final_fiberslength_files",
+                       "shore_maps", "mapmri_maps",
+                       "endpoints_file", "endpoints_mm_file", "fiberslength_file", "final_fiberslength_files",
+                       "filtered_fiberslabel_files", "final_fiberlabels_files",
+                       "streamline_final_file", "streamline_index_files", "connectivity_matrices"]
+        self.outputs = ["endpoints_file", "endpoints_mm_file", "fiberslength_file", "final_fiberslength_files",
                         "filtered_fiberslabel_files", "final_fiberlabels_files",
-                        "streamline_final_file", "connectivity_matrices"]
+                        "streamline_final_file", "streamline_index_files", "connectivity_matrices"]
 
     def create_workflow(self, flow, inputnode, outputnode):
+        if self.config.connectome_from_tracking:
+            # The connectomes were built by the tracking (see DirectionGetterTractography)
+            flow.connect([
+                (inputnode, outputnode, [(output, output) for output in self.outputs])
+            ])
+            return
+
         cmtk_cmat = pe.Node(interface=cmtklib.connectome.CMTK_cmat(), name='compute_matrice')
         cmtk_cmat.inputs.compute_curvature = self.config.compute_curvature
         cmtk_cmat.inputs.output_types = self.config.output_types
+        cmtk_cmat.inputs.number_of_workers = self.config.number_of_workers
+        cmtk_cmat.inputs.memory_budget = self.config.memory_budget
+        cmtk_cmat.inputs.hierarchical_scales = self.config.hierarchical_scales
+        cmtk_cmat.inputs.max_endpoint_distance = self.config.max_endpoint_distance
+        cmtk_cmat.inputs.map_statistics = self.config.map_statistics
+        cmtk_cmat.inputs.map_sketch_size = self.config.map_sketch_size
+        cmtk_cmat.inputs.compression_error = self.config.compression_error
+        if self.config.cache_dir:
+            cmtk_cmat.inputs.cache_dir = self.config.cache_dir
+            cmtk_cmat.inputs.cache_disk_budget = self.config.cache_disk_budget
         cmtk_cmat.inputs.probtrackx = self.config.probtrackx
 
         # Additional maps
@@ -82,12 +124,14 @@ class ConnectomeStage(Stage):
 
         flow.connect([
             (inputnode, cmtk_cmat, [('track_file', 'track_file'),
+                                    ('wm_mask_registered', 'reference_image'),
                                     ('roi_graphMLs', 'roi_graphmls'),
                                     ('parcellation_scheme', 'parcellation_scheme'),
                                     ('atlas_info', 'atlas_info'),
                                     ('roi_volumes_registered', 'roi_volumes')]),
             (cmtk_cmat, outputnode, [('endpoints_file', 'endpoints_file'),
                                      ('endpoints_mm_file', 'endpoints_mm_file'),
+                                     ('fiberslength_file', 'fiberslength_file'),
                                      ('final_fiberslength_files',
                                       'final_fiberslength_files'),
                                      ('filtered_fiberslabel_files',
@@ -96,6 +140,8 @@ class ConnectomeStage(Stage):
                                       'final_fiberlabels_files'),
                                      ('streamline_final_file',
                                       'streamline_final_file'),
+                                     ('streamline_index_files',
+                                      'streamline_index_files'),
                                      ('connectivity_matrices', 'connectivity_matrices')])
         ])
 
@@ -173,4 +219,7 @@ class ConnectomeStage(Stage):
             # print(self.inspect_outputs)
 
     def has_run(self):
+        if self.config.connectome_from_tracking:
+            return len(glob.glob(os.path.join(os.path.dirname(self.stage_dir), "diffusion_stage", "tracking",
+                                              "dipy_*_tracking", "result_dipy_*_tracking.pklz"))) > 0
         return os.path.exists(os.path.join(self.stage_dir, "compute_matrice", "result_compute_matrice.pklz"))
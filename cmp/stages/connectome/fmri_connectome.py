@@ -32,6 +32,15 @@ class ConnectomeConfig(HasTraits):
     FD_thr = Float(0.2)
     DVARS_thr = Float(4.0)
     output_types = List(['gPickle', 'mat', 'cff', 'graphml'])
+    number_of_workers = Int(1, desc="Number of processes used to build the connectomes of the different scales in parallel")
+    connectivity_metrics = List(['corr'], desc="Functional connectivity estimators derived from the covariance of "
+                                               "the ROI time-series ('corr': Pearson correlation, 'partial_corr': "
+                                               "Ledoit-Wolf partial correlation, 'tangent': tangent space, "
+                                               "'cov': covariance)")
+    dynamic_fc = Bool(False, desc="Compute the correlations of sliding windows over the ROI time-series")
+    dfc_window_length = Int(60, desc="Number of time points of the sliding windows")
+    dfc_step = Int(1, desc="Number of time points between the starts of consecutive windows")
+    dfc_dtype = Enum('float32', ['float32', 'float16'], desc="Data type of the saved sliding-window correlations")
     log_visualization = Bool(True)
     circular_layout = Bool(False)
     subject = Str()
@@ -47,11 +56,17 @@ class ConnectomeStage(Stage):
         self.config = ConnectomeConfig()
         self.inputs = ["roi_volumes_registered", "func_file", "FD", "DVARS",
                        "parcellation_scheme", "atlas_info", "roi_graphMLs"]
-        self.outputs = ["connectivity_matrices", "avg_timeseries"]
+        self.outputs = ["connectivity_matrices", "avg_timeseries", "dynamic_connectivity_matrices"]
 
     def create_workflow(self, flow, inputnode, outputnode):
         cmtk_cmat = pe.Node(interface=cmtklib.connectome.rsfmri_conmat(), name='compute_matrice')
         cmtk_cmat.inputs.output_types = self.config.output_types
+        cmtk_cmat.inputs.number_of_workers = self.config.number_of_workers
+        cmtk_cmat.inputs.connectivity_metrics = self.config.connectivity_metrics
+        cmtk_cmat.inputs.dynamic_fc = self.config.dynamic_fc
+        cmtk_cmat.inputs.dfc_window_length = self.config.dfc_window_length
+        cmtk_cmat.inputs.dfc_step = self.config.dfc_step
+        cmtk_cmat.inputs.dfc_dtype = self.config.dfc_dtype
         cmtk_cmat.inputs.apply_scrubbing = self.config.apply_scrubbing
         cmtk_cmat.inputs.FD_th = self.config.FD_thr
         cmtk_cmat.inputs.DVARS_th = self.config.DVARS_thr
@@ -62,7 +77,8 @@ class ConnectomeStage(Stage):
                                      'parcellation_scheme'), ('atlas_info', 'atlas_info'),
                                     ('roi_volumes_registered', 'roi_volumes'), ('roi_graphMLs', 'roi_graphmls')]),
             (cmtk_cmat, outputnode,
-             [('connectivity_matrices', 'connectivity_matrices'), ("avg_timeseries", "avg_timeseries")])
+             [('connectivity_matrices', 'connectivity_matrices'), ("avg_timeseries", "avg_timeseries"),
+              ('dynamic_connectivity_matrices', 'dynamic_connectivity_matrices')])
         ])
 
     def define_inspect_outputs(self):
@@ -85,6 +101,9 @@ class ConnectomeStage(Stage):
             mat = func_outputs['func.@connectivity_matrices']
             # print('con_results_path : ',con_results_path)
 
+            metric_names = {'corr': 'Correlation', 'partial_corr': 'Partial correlation',
+                            'tangent': 'Tangent space', 'cov': 'Covariance'}
+
             if isinstance(mat, str):
                 print("single scale")
                 # print(mat)
@@ -92,10 +111,12 @@ class ConnectomeStage(Stage):
                     con_name = os.path.basename(mat).split(".")[
                         0].split("_")[-1]
                     if os.path.exists(mat):
-                        self.inspect_outputs_dict[
-                            'ROI-average time-series correlation - Connectome %s' % os.path.basename(mat)] = [
-                            "showmatrix_gpickle", layout, mat, "corr", "False",
-                            self.config.subject + ' - ' + con_name + ' - Correlation', map_scale]
+                        for metric in self.config.connectivity_metrics:
+                            self.inspect_outputs_dict[
+                                'ROI-average time-series %s - Connectome %s' % (
+                                    metric_names[metric].lower(), os.path.basename(mat))] = [
+                                "showmatrix_gpickle", layout, mat, metric, "False",
+                                self.config.subject + ' - ' + con_name + ' - ' + metric_names[metric], map_scale]
             else:
                 print("multi scale")
                 for mat in func_outputs['func.@connectivity_matrices']:
@@ -104,9 +125,12 @@ class ConnectomeStage(Stage):
                         con_name = os.path.basename(mat).split(".")[
                             0].split("_")[-1]
                         if os.path.exists(mat):
-                            self.inspect_outputs_dict['ROI-average time-series correlation - Connectome %s' % con_name] = [
-                                "showmatrix_gpickle", layout, mat, "corr", "False",
-                                self.config.subject + ' - ' + con_name + ' - Correlation', map_scale]
+                            for metric in self.config.connectivity_metrics:
+                                self.inspect_outputs_dict['ROI-average time-series %s - Connectome %s' % (
+                                    metric_names[metric].lower(), con_name)] = [
+                                    "showmatrix_gpickle", layout, mat, metric, "False",
+                                    self.config.subject + ' - ' + con_name + ' - ' + metric_names[metric],
+                                    map_scale]
 
             self.inspect_outputs = sorted([key for key in list(self.inspect_outputs_dict.keys())],
                                           key=str.lower)
@@ -9,6 +9,7 @@
 
 # General imports
 import os
+import glob
 
 from traits.api import *
 
@@ -212,9 +213,22 @@ class DiffusionStage(Stage):
         self.output_dir = output_dir
         self.config = DiffusionConfig()
         self.inputs = ["diffusion", "partial_volumes", "wm_mask_registered", "brain_mask_registered",
-                       "act_5tt_registered", "gmwmi_registered", "roi_volumes", "grad", "bvals", "bvecs"]
+                       "act_5tt_registered", "gmwmi_registered", "roi_volumes", "grad", "bvals", "bvecs",
+                       "roi_graphMLs", "parcellation_scheme", "atlas_info"]
         self.outputs = ["diffusion_model", "track_file", "fod_file", "FA", "ADC", "RD", "AD", "skewness", "kurtosis",
-                        "P0", "roi_volumes", "shore_maps", "mapmri_maps"]
+                        "P0", "roi_volumes", "shore_maps", "mapmri_maps",
+                        "endpoints_file", "endpoints_mm_file", "fiberslength_file", "final_fiberslength_files",
+                        "filtered_fiberslabel_files", "final_fiberlabels_files",
+                        "streamline_final_file", "streamline_index_files", "connectivity_matrices"]
+        # Configuration of the connectome stage, set by the pipeline when it is enabled
+        self.connectome_config = None
+
+    def builds_connectome(self):
+        """ Return True if the connectomes are built by the Dipy (fODF-based) tracking instead of the connectome stage """
+        tracking_config = self.config.dipy_tracking_config
+        return (self.config.tracking_processing_tool == 'Dipy' and self.connectome_config is not None
+                and tracking_config.build_connectome
+                and (tracking_config.SD or self.config.diffusion_imaging_model == 'DSI'))
 
     def create_workflow(self, flow, inputnode, outputnode):
 
@@ -324,7 +338,7 @@ class DiffusionStage(Stage):
 
         if self.config.tracking_processing_tool == 'Dipy':
             track_flow = create_dipy_tracking_flow(
-                self.config.dipy_tracking_config)
+                self.config.dipy_tracking_config, self.connectome_config if self.builds_connectome() else None)
             # print "Dipy tracking"
 
             if self.config.diffusion_imaging_model != 'DSI':
@@ -383,6 +397,42 @@ class DiffusionStage(Stage):
                  ('outputnode.track_file', 'track_file')])
             ])
 
+            if self.builds_connectome():
+                # Additional maps
+                map_merge = pe.Node(interface=util.Merge(6), name='merge_additional_maps')
+
+                flow.connect([
+                    (recon_flow, map_merge, [('outputnode.FA', 'in1'),
+                                             ('outputnode.MD', 'in2'),
+                                             ('outputnode.AD', 'in3'),
+                                             ('outputnode.RD', 'in4'),
+                                             ('outputnode.shore_maps', 'in5'),
+                                             ('outputnode.mapmri_maps', 'in6')]),
+                    (map_merge, track_flow, [('out', 'inputnode.additional_maps')]),
+                    (inputnode, track_flow, [('roi_graphMLs', 'inputnode.roi_graphMLs'),
+                                             ('parcellation_scheme', 'inputnode.parcellation_scheme'),
+                                             ('atlas_info', 'inputnode.atlas_info')]),
+                    (track_flow, outputnode, [('outputnode.endpoints_file', 'endpoints_file'),
+                                              ('outputnode.endpoints_mm_file', 'endpoints_mm_file'),
+                                              ('outputnode.fiberslength_file', 'fiberslength_file'),
+                                              ('outputnode.final_fiberslength_files', 'final_fiberslength_files'),
+                                              ('outputnode.filtered_fiberslabel_files',
+                                               'filtered_fiberslabel_files'),
+                                              ('outputnode.final_fiberlabels_files', 'final_fiberlabels_files'),
+                                              ('outputnode.streamline_final_file', 'streamline_final_file'),
+                                              ('outputnode.streamline_index_files', 'streamline_index_files'),
+                                              ('outputnode.connectivity_matrices', 'connectivity_matrices')])
+                ])
+
+                if self.config.dilate_rois:
+                    flow.connect([
+                        (dilate_rois, track_flow, [('out_file', 'inputnode.roi_volumes')])
+                    ])
+                else:
+                    flow.connect([
+                        (inputnode, track_flow, [('roi_volumes', 'inputnode.roi_volumes')])
+                    ])
+
         elif self.config.tracking_processing_tool == 'MRtrix' and self.config.recon_processing_tool == 'MRtrix':
             track_flow = create_mrtrix_tracking_flow(
                 self.config.mrtrix_tracking_config)
@@ -658,13 +708,23 @@ class DiffusionStage(Stage):
         # MRtrix
         if self.config.tracking_processing_tool == 'MRtrix':
 
-            diff_dir = os.path.join(self.stage_dir, "tracking", "trackvis")
-            streamline_res = os.path.join(diff_dir,"tract.trk")
+            if self.config.mrtrix_tracking_config.convert_to_trk:
+                diff_dir = os.path.join(self.stage_dir, "tracking", "trackvis")
+                streamline_res = os.path.join(diff_dir,"tract.trk")
+
+                if os.path.exists(streamline_res):
+                   self.inspect_outputs_dict[
+                        self.config.tracking_processing_tool + ' ' + self.config.diffusion_model + ' streamline'] = [
+                        'trackvis', streamline_res]
+            else:
+                diff_dir = os.path.join(self.stage_dir, "tracking",
+                                        "mrtrix_%s_tracking" % self.config.diffusion_model.lower())
+                streamline_res = glob.glob(os.path.join(diff_dir, "*_tracked.tck"))
 
-            if os.path.exists(streamline_res):
-               self.inspect_outputs_dict[
-                    self.config.tracking_processing_tool + ' ' + self.config.diffusion_model + ' streamline'] = [
-                    'trackvis', streamline_res]
+                if len(streamline_res) > 0:
+                    self.inspect_outputs_dict[
+                        self.config.tracking_processing_tool + ' ' + self.config.diffusion_model + ' streamline'] = [
+                        'mrview', '-tractography.load', streamline_res[0]]
 
         self.inspect_outputs = sorted([key for key in list(self.inspect_outputs_dict.keys())],
                                       key=str.lower)
@@ -678,4 +738,8 @@ class DiffusionStage(Stage):
                 return os.path.exists(os.path.join(self.stage_dir, "tracking", "dipy_probabilistic_tracking",
                                                    "result_dipy_probabilistic_tracking.pklz"))
         elif self.config.tracking_processing_tool == 'MRtrix':
-            return os.path.exists(os.path.join(self.stage_dir, "tracking", "trackvis", "result_trackvis.pklz"))
+            if self.config.mrtrix_tracking_config.convert_to_trk:
+                return os.path.exists(os.path.join(self.stage_dir, "tracking", "trackvis", "result_trackvis.pklz"))
+            tracking_node = "mrtrix_%s_tracking" % self.config.diffusion_model.lower()
+            return os.path.exists(os.path.join(self.stage_dir, "tracking", tracking_node,
+                                               "result_%s.pklz" % tracking_node))
@@ -46,6 +46,13 @@ class Dipy_tracking_config(HasTraits):
                           desc='Use FAST for partial volume estimation and Anatomically-Constrained Tractography (ACT) tissue classifier')
     seed_from_gmwmi = traits.Bool(False,
                                   desc="Seed from Grey Matter / White Matter interface (requires Anatomically-Constrained Tractography (ACT))")
+    compression_error = Float(0, desc="Maximal error (in mm) of the lossy compression of the saved streamlines "
+                                      "(0: no compression)")
+    build_connectome = traits.Bool(False,
+                                   desc="Build the connectomes from the streamlines as they are tracked, without "
+                                        "writing the whole tractogram (fODF-based tracking only, replaces the "
+                                        "computation of the connectome stage)")
+    connectome_chunk_size = Int(100000, desc="Number of streamlines processed at once to build the connectomes")
 
     # fast_number_of_classes = Int(3)
 
@@ -99,6 +106,9 @@ class MRtrix_tracking_config(HasTraits):
                                 '(requires Anatomically-Constrained Tractography (ACT))')
     backtrack = traits.Bool(True,
                             desc="Allow tracks to be truncated (requires Anatomically-Constrained Tractography (ACT))")
+    convert_to_trk = traits.Bool(True,
+                                 desc="Convert the .tck tractogram to TrackVis .trk format (the connectome stage "
+                                      "also reads .tck files directly, in the voxel grid of the white-matter mask)")
 
     def _SD_changed(self, new):
         if self.tracking_mode == "Deterministic" and not new:
@@ -127,18 +137,55 @@ class MRtrix_tracking_config(HasTraits):
             self.curvature = 0.0
 
 
-def create_dipy_tracking_flow(config):
+def connect_dipy_connectome(flow, config, connectome_config, inputnode, dipy_tracking, outputnode):
+    """ Build the connectomes in the tracking node if build_connectome is set and connect them to the output node """
+    if not config.build_connectome or connectome_config is None:
+        return
+
+    dipy_tracking.inputs.build_connectome = True
+    dipy_tracking.inputs.connectome_chunk_size = config.connectome_chunk_size
+    dipy_tracking.inputs.compute_curvature = connectome_config.compute_curvature
+    dipy_tracking.inputs.output_types = connectome_config.output_types
+    dipy_tracking.inputs.number_of_workers = connectome_config.number_of_workers
+    dipy_tracking.inputs.hierarchical_scales = connectome_config.hierarchical_scales
+    dipy_tracking.inputs.max_endpoint_distance = connectome_config.max_endpoint_distance
+    dipy_tracking.inputs.map_sketch_size = connectome_config.map_sketch_size
+
+    flow.connect([
+        (inputnode, dipy_tracking, [('roi_volumes', 'roi_volumes'),
+                                    ('roi_graphMLs', 'roi_graphmls'),
+                                    ('parcellation_scheme', 'parcellation_scheme'),
+                                    ('atlas_info', 'atlas_info'),
+                                    ('additional_maps', 'additional_maps')]),
+        (dipy_tracking, outputnode, [('endpoints_file', 'endpoints_file'),
+                                     ('endpoints_mm_file', 'endpoints_mm_file'),
+                                     ('fiberslength_file', 'fiberslength_file'),
+                                     ('final_fiberslength_files', 'final_fiberslength_files'),
+                                     ('filtered_fiberslabel_files', 'filtered_fiberslabel_files'),
+                                     ('final_fiberlabels_files', 'final_fiberlabels_files'),
+                                     ('streamline_final_file', 'streamline_final_file'),
+                                     ('streamline_index_files', 'streamline_index_files'),
+                                     ('connectivity_matrices', 'connectivity_matrices')])
+    ])
+
+
+def create_dipy_tracking_flow(config, connectome_config=None):
     flow = pe.Workflow(name="tracking")
     # inputnode
     inputnode = pe.Node(interface=util.IdentityInterface(
         fields=['DWI', 'fod_file', 'FA', 'T1', 'partial_volumes', 'wm_mask_resampled', 'gmwmi_file', 'gm_registered',
-                'bvals', 'bvecs', 'model']), name='inputnode')
+                'bvals', 'bvecs', 'model',
+                'roi_volumes', 'roi_graphMLs', 'parcellation_scheme', 'atlas_info', 'additional_maps']),
+        name='inputnode')
     # outputnode
 
     # CRS2XYZtkReg = subprocess.check_output
 
     outputnode = pe.Node(interface=util.IdentityInterface(
-        fields=["track_file"]), name='outputnode')
+        fields=["track_file",
+                "endpoints_file", "endpoints_mm_file", "fiberslength_file", "final_fiberslength_files",
+                "filtered_fiberslabel_files", "final_fiberlabels_files",
+                "streamline_final_file", "streamline_index_files", "connectivity_matrices"]), name='outputnode')
 
     if not config.SD and config.imaging_model != 'DSI':  # If tensor fitting was used
         dipy_tracking = pe.Node(
@@ -147,6 +194,7 @@ def create_dipy_tracking_flow(config):
         dipy_tracking.inputs.fa_thresh = config.fa_thresh
         dipy_tracking.inputs.max_angle = config.max_angle
         dipy_tracking.inputs.step_size = config.step_size
+        dipy_tracking.inputs.compression_error = config.compression_error
 
         flow.connect([
             # (dipy_seeds,dipy_tracking,[('seed_files','seed_file')]),
@@ -197,6 +245,7 @@ def create_dipy_tracking_flow(config):
             dipy_tracking.inputs.fa_thresh = config.fa_thresh
             dipy_tracking.inputs.max_angle = config.max_angle
             dipy_tracking.inputs.step_size = config.step_size
+            dipy_tracking.inputs.compression_error = config.compression_error
             dipy_tracking.inputs.use_act = config.use_act
             dipy_tracking.inputs.use_act = config.seed_from_gmwmi
             dipy_tracking.inputs.seed_density = config.seed_density
@@ -239,6 +288,8 @@ def create_dipy_tracking_flow(config):
                 (dipy_tracking, outputnode, [('tracks', 'track_file')])
             ])
 
+            connect_dipy_connectome(flow, config, connectome_config, inputnode, dipy_tracking, outputnode)
+
         elif config.tracking_mode == 'Probabilistic':
 
             # dipy_seeds = pe.Node(interface=make_seeds(),name="dipy_seeds")
@@ -255,6 +306,7 @@ def create_dipy_tracking_flow(config):
             dipy_tracking.inputs.fa_thresh = config.fa_thresh
             dipy_tracking.inputs.max_angle = config.max_angle
             dipy_tracking.inputs.step_size = config.step_size
+            dipy_tracking.inputs.compression_error = config.compression_error
             dipy_tracking.inputs.use_act = config.use_act
             dipy_tracking.inputs.seed_from_gmwmi = config.seed_from_gmwmi
             dipy_tracking.inputs.seed_density = config.seed_density
@@ -291,6 +343,8 @@ def create_dipy_tracking_flow(config):
                 (dipy_tracking, outputnode, [('tracks', 'track_file')])
             ])
 
+            connect_dipy_connectome(flow, config, connectome_config, inputnode, dipy_tracking, outputnode)
+
     return flow
 
 
@@ -299,6 +353,24 @@ def get_freesurfer_parcellation(roi_files):
     return roi_files[0]
 
 
+def connect_mrtrix_tracking_output(flow, config, inputnode, mrtrix_tracking, outputnode):
+    """ Connect the .tck tractogram to the output node, converted to .trk if convert_to_trk is set """
+    if config.convert_to_trk:
+        # converter = pe.Node(interface=mrtrix.MRTrix2TrackVis(),name="trackvis")
+        converter = pe.Node(interface=Tck2Trk(), name='trackvis')
+        converter.inputs.out_tracks = 'converted.trk'
+
+        flow.connect([
+            (mrtrix_tracking, converter, [('tracked', 'in_tracks')]),
+            (inputnode, converter, [('wm_mask_resampled', 'in_image')]),
+            (converter, outputnode, [('out_tracks', 'track_file')])
+        ])
+    else:
+        flow.connect([
+            (mrtrix_tracking, outputnode, [('tracked', 'track_file')])
+        ])
+
+
 def create_mrtrix_tracking_flow(config):
     flow = pe.Workflow(name="tracking")
     # inputnode
@@ -390,10 +462,6 @@ def create_mrtrix_tracking_flow(config):
                  ('wm_mask_resampled', 'seed_file')]),
             ])
 
-        # converter = pe.Node(interface=mrtrix.MRTrix2TrackVis(),name="trackvis")
-        converter = pe.Node(interface=Tck2Trk(), name='trackvis')
-        converter.inputs.out_tracks = 'converted.trk'
-
         flow.connect([
             # (mrtrix_seeds,mrtrix_tracking,[('seed_files','seed_file')]),
             (inputnode, mrtrix_tracking, [('DWI', 'in_file')]),
@@ -403,11 +471,10 @@ def create_mrtrix_tracking_flow(config):
             # (mrtrix_tracking,converter,[('tracked','in_file')]),
             # (inputnode,converter,[('wm_mask_resampled','image_file')]),
             # (converter,outputnode,[('out_file','track_file')])
-            (mrtrix_tracking, converter, [('tracked', 'in_tracks')]),
-            (inputnode, converter, [('wm_mask_resampled', 'in_image')]),
-            (converter, outputnode, [('out_tracks', 'track_file')])
         ])
 
+        connect_mrtrix_tracking_output(flow, config, inputnode, mrtrix_tracking, outputnode)
+
         # flow.connect([
         #               (inputnode,mrtrix_tracking,[('DWI','in_file'),('wm_mask_resampled','seed_file'),('wm_mask_resampled','mask_file')]),
         #               (mrtrix_tracking,converter,[('tracked','in_file')]),
@@ -441,8 +508,6 @@ def create_mrtrix_tracking_flow(config):
         else:
             mrtrix_tracking.inputs.inputmodel = 'Tensor_Prob'
         # converter = pe.MapNode(interface=mrtrix.MRTrix2TrackVis(),iterfield=['in_file'],name='trackvis')
-        converter = pe.Node(interface=Tck2Trk(), name='trackvis')
-        converter.inputs.out_tracks = 'converted.trk'
         # orientation_matcher = pe.Node(interface=match_orientation(), name="orient_matcher")
 
         flow.connect([
@@ -486,9 +551,8 @@ def create_mrtrix_tracking_flow(config):
             # (mrtrix_tracking,converter,[('tracked','in_file')]),
             # (inputnode,converter,[('wm_mask_resampled','image_file')]),
             # (converter,outputnode,[('out_file','track_file')])
-            (mrtrix_tracking, converter, [('tracked', 'in_tracks')]),
-            (inputnode, converter, [('wm_mask_resampled', 'in_image')]),
-            (converter, outputnode, [('out_tracks', 'track_file')])
         ])
 
+        connect_mrtrix_tracking_output(flow, config, inputnode, mrtrix_tracking, outputnode)
+
     return flow
@@ -0,0 +1,172 @@
+# Copyright (C) 2009-2020, Ecole Polytechnique Federale de Lausanne (EPFL) and
+# Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland
+# All rights reserved.
+#
+#  This software is distributed under the open-source license Modified BSD.
+
+""" CMTK on-disk cache of numpy arrays keyed by the content of the input files
+
+Each entry of the cache is a directory named after its key which contains one
+``.npy`` file per array. The entries are read as memory-mapped arrays and the
+least recently used ones are evicted when the cache exceeds its disk budget.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from os import path as op
+
+import numpy as np
+
+
+def hash_file(fname, block_size=1 << 24):
+    """ Compute the SHA-256 hash of the content of a file
+
+    Parameters
+    ----------
+    fname: path of the file
+    block_size: number of bytes read at once
+
+    Returns
+    -------
+    digest: hexadecimal SHA-256 digest
+    """
+    sha = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def make_cache_key(*parts):
+    """ Combine file hashes and parameters (anything with a stable ``repr``) into a cache key """
+    return hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()
+
+
+class ArrayCache(object):
+    """ On-disk cache of dictionaries of numpy arrays with LRU eviction
+
+    Parameters
+    ----------
+    cache_dir: directory of the cache (created if needed)
+    disk_budget: maximal size of the cache in MB (0: unlimited)
+    """
+
+    # age in seconds after which an incomplete entry is considered abandoned
+    stale_tmp_age = 6 * 3600
+
+    def __init__(self, cache_dir, disk_budget=0):
+        self.cache_dir = op.abspath(cache_dir)
+        self.disk_budget = disk_budget
+        if not op.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def _entry_dir(self, key):
+        return op.join(self.cache_dir, key)
+
+    def hash_file(self, fname):
+        """ Hash the content of a file (see ``hash_file``)
+
+        The hashes are memoized in the cache by path, size and modification time
+        so that large files are not read again when they did not change.
+        """
+        fname = op.realpath(fname)
+        stat = os.stat(fname)
+        memo_key = make_cache_key(fname, stat.st_size, stat.st_mtime_ns)
+        memo_file = op.join(self.cache_dir, 'file_hashes.json')
+        try:
+            with open(memo_file) as f:
+                memo = json.load(f)
+        except (IOError, ValueError):
+            memo = {}
+        if memo_key not in memo:
+            memo[memo_key] = hash_file(fname)
+            fd, tmp_file = tempfile.mkstemp(dir=self.cache_dir, suffix='.json')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(memo, f)
+            os.replace(tmp_file, memo_file)
+        return memo[memo_key]
+
+    def get(self, key, mmap_mode='r'):
+        """ Return the arrays of an entry as a dictionary (None if the entry is not in the cache)
+
+        The access time of the entry is updated for the LRU eviction.
+        """
+        entry_dir = self._entry_dir(key)
+        if not op.isdir(entry_dir):
+            return None
+        arrays = {}
+        for fname in os.listdir(entry_dir):
+            if fname.endswith('.npy'):
+                arrays[fname[:-4]] = np.load(op.join(entry_dir, fname), mmap_mode=mmap_mode)
+        os.utime(entry_dir, None)
+        return arrays
+
+    def put(self, key, arrays):
+        """ Store a dictionary of arrays in the cache under a key, then evict entries over the disk budget
+
+        The entry is written in a temporary directory which is renamed at the
+        end, so that concurrent processes never read partial entries.
+        """
+        entry_dir = self._entry_dir(key)
+        if op.isdir(entry_dir):
+            return
+        tmp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp_')
+        try:
+            for name, value in arrays.items():
+                np.save(op.join(tmp_dir, '%s.npy' % name), value)
+        except BaseException:
+            # e.g. disk full or interrupted: do not leave a partial entry behind
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # the entry was stored by another process in the meantime
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        """ Remove the least recently used entries until the cache fits in its disk budget
+
+        Temporary directories of entries which were never completed (e.g. the
+        process writing them was killed) are removed once they are older than
+        ``stale_tmp_age`` seconds, whatever the disk budget.
+
+        Parameters
+        ----------
+        keep: key of an entry which is never evicted (e.g. the entry just stored)
+        """
+        entries = []
+        total_size = 0
+        for key in os.listdir(self.cache_dir):
+            entry_dir = self._entry_dir(key)
+            if key.startswith('.tmp_') and op.isdir(entry_dir):
+                try:
+                    stale = time.time() - op.getmtime(entry_dir) > self.stale_tmp_age
+                except OSError:
+                    # renamed or removed by another process in the meantime
+                    continue
+                if stale:
+                    print("  ... Remove stale temporary cache entry %s" % key)
+                    shutil.rmtree(entry_dir, ignore_errors=True)
+                continue
+            if not self.disk_budget or key.startswith('.') or not op.isdir(entry_dir):
+                continue
+            size = sum(op.getsize(op.join(entry_dir, fname)) for fname in os.listdir(entry_dir))
+            entries.append((op.getmtime(entry_dir), key, size))
+            total_size += size
+
+        budget = self.disk_budget * 1024 ** 2
+        for _, key, size in sorted(entries):
+            if total_size <= budget:
+                break
+            if key == keep:
+                continue
+            print("  ... Evict cache entry %s (%.1f MB, last used %s)" %
+                  (key, size / 1024.0 ** 2, time.ctime(op.getmtime(self._entry_dir(key)))))
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+            total_size -= size
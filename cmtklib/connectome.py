@@ -11,25 +11,32 @@ from os import path as op
 import csv
 import glob
 import os
-import copy
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 
 from traits.api import *
 
 import nibabel as nib
+from nibabel.affines import apply_affine
 import numpy as np
 import networkx as nx
 
 import scipy.io as sio
+from scipy import sparse
 
 from nipype.interfaces.base import traits, \
-    File, TraitedSpec, BaseInterface, \
+    File, Directory, TraitedSpec, BaseInterface, \
     BaseInterfaceInputSpec, isdefined, \
     InputMultiPath, OutputMultiPath
 from nipype.interfaces import cmtk
 from nipype.utils.filemanip import split_filename
 
-from .util import mean_curvature, length
-from .parcellation import get_parcellation
+from .cache import ArrayCache, make_cache_key, hash_file
+from .streamlines import streamlines_to_buffer, get_point_streamlines, compute_lengths, compute_mean_curvatures, \
+    iter_rasmm_to_voxmm, compress_streamlines
+from .parcellation import get_parcellation, compute_roi_node_table, compute_label_mapping, \
+    compute_nearest_label_volume, compute_roi_averaging_matrix
 
 
 def group_analysis_sconn(output_dir, subjects_to_be_analyzed):
@@ -37,106 +44,1949 @@ def group_analysis_sconn(output_dir, subjects_to_be_analyzed):
     print("Perform group level analysis ...")
 
 
-def compute_curvature_array(fib):
+def compute_curvature_array(fib, number_of_threads=1):
     """ Computes the curvature array """
     print("Compute curvature ...")
 
+    points, offsets = streamlines_to_buffer([fi[0] for fi in fib])
+    meancurv = compute_mean_curvatures(points, offsets, number_of_threads).reshape(-1, 1)
+
+    return meancurv
+
+
+def voxmm_to_voxel_affine(voxelSize):
+    """ Returns the affine mapping trackvis ``voxmm`` coordinates to voxel indices
+
+    Parameters
+    ----------
+    voxelSize: 3-tuple containing the voxel size of the ROI image
+
+    Returns
+    -------
+    affine: (4, 4) array
+    """
+    affine = np.eye(4)
+    affine[[0, 1, 2], [0, 1, 2]] = 1.0 / np.asarray(voxelSize[:3], dtype=np.float64)
+    return affine
+
+
+def endpoints_to_voxels(endpointsmm, affine):
+    """ Map fiber endpoints to voxel indices in a single pass
+
+    Parameters
+    ----------
+    endpointsmm: array of shape [#fibers, 2, 3] with the endpoint coordinates
+    affine: (4, 4) array mapping the endpoint coordinates to voxel coordinates
+            (see ``voxmm_to_voxel_affine``)
+
+    Returns
+    -------
+    endpoints: array of shape [#fibers, 2, 3] with the voxel indices
+               (coordinates truncated towards zero)
+    """
+    return np.trunc(apply_affine(affine, endpointsmm))
+
+
+def get_endpoint_labels(endpoints, roiData):
+    """ Look up the ROI label of the start and end voxel of each fiber
+
+    Several parcellations sharing the same voxel grid can be stacked along a
+    fourth axis to look up the labels of all of them in a single pass.
+
+    Parameters
+    ----------
+    endpoints: array of shape [#fibers, 2, 3] with the endpoint voxel indices
+    roiData: 3D array of the parcellation, or 4D array of shape
+             [X, Y, Z, #parcellations] of stacked parcellations
+
+    Returns
+    -------
+    (labels: int32 array of shape [#fibers, 2] (0 for fibers outside the volume),
+             or [#fibers, 2, #parcellations] for stacked parcellations
+    outside): boolean array of shape [#fibers] set for fibers which start or
+              end outside the volume
+    """
+    vox = np.asarray(endpoints).astype(np.int64)
+    outside = np.any((vox < 0) | (vox >= np.asarray(roiData.shape[:3])), axis=(1, 2))
+
+    labels = np.zeros(vox.shape[:2] + roiData.shape[3:], dtype=np.int32)
+    vox_in = vox[~outside]
+    labels[~outside] = roiData[vox_in[..., 0], vox_in[..., 1], vox_in[..., 2]]
+    return labels, outside
+
+
+def get_fiber_labels(endpoint_labels, outside, nROIs):
+    """ Filter the endpoint labels and sort them so that startROI <= endROI
+
+    Parameters
+    ----------
+    endpoint_labels: int array of shape [#fibers, 2] (see ``get_endpoint_labels``)
+    outside: boolean array of shape [#fibers] flagging fibers outside the volume
+    nROIs: number of ROIs of the parcellation
+
+    Returns
+    -------
+    (fiberlabels: int32 array of shape [#fibers, 2] with the sorted labels of
+                  valid fibers, [-1, 0] for orphans and [0, 0] for fibers
+                  discarded otherwise
+    orphans): boolean array of shape [#fibers] flagging the fibers that start
+              or terminate in a voxel which is not labeled
+    """
+    startROI = np.minimum(endpoint_labels[:, 0], endpoint_labels[:, 1])
+    endROI = np.maximum(endpoint_labels[:, 0], endpoint_labels[:, 1])
+
+    orphans = ~outside & (startROI == 0)
+    valid = ~outside & ~orphans & (endROI <= nROIs)
+
+    fiberlabels = np.zeros((len(endpoint_labels), 2), dtype=np.int32)
+    fiberlabels[valid, 0] = startROI[valid]
+    fiberlabels[valid, 1] = endROI[valid]
+    fiberlabels[orphans, 0] = -1
+    return fiberlabels, orphans
+
+
+def build_edge_index(final_fiberlabels, final_fibers_idx, nROIs):
+    """ Group the fibers by edge
+
+    Each (startROI, endROI) pair is encoded as a single integer key and the keys
+    are sorted once. The fibers of the edge ``edges[e]`` are then given by
+    ``fibers[offsets[e]:offsets[e + 1]]`` (CSR layout).
+
+    Parameters
+    ----------
+    final_fiberlabels: int array of shape [#fibers, 2] with startROI <= endROI
+    final_fibers_idx: indices of these fibers in the tractogram
+    nROIs: number of ROIs of the parcellation
+
+    Returns
+    -------
+    (edges: int array of shape [#edges, 2] sorted by (startROI, endROI)
+    offsets: int array of shape [#edges + 1]
+    fibers): int array of shape [#fibers] with the fiber indices grouped by edge,
+             in increasing order inside each edge
+    """
+    n_keys = int(nROIs) + 1
+    keys = final_fiberlabels[:, 0].astype(np.int64) * n_keys + final_fiberlabels[:, 1]
+
+    order = np.argsort(keys, kind='stable')
+    edge_keys, starts = np.unique(keys[order], return_index=True)
+
+    edges = np.column_stack(np.divmod(edge_keys, n_keys))
+    offsets = np.append(starts, len(keys))
+    fibers = np.asarray(final_fibers_idx)[order]
+    return edges, offsets, fibers
+
+
+def compute_segment_statistics(values, offsets):
+    """ Compute the mean, median and standard deviation of each segment of values
+
+    NaN values are ignored, as with ``np.nanmean``, ``np.nanmedian`` and ``np.nanstd``.
+
+    Parameters
+    ----------
+    values: 1D array of values grouped by segment
+    offsets: int array of shape [#segments + 1] such that the values of segment
+             ``s`` are ``values[offsets[s]:offsets[s + 1]]``
+
+    Returns
+    -------
+    (mean, median, std): float64 arrays of shape [#segments]
+    """
+    values = np.asarray(values, dtype=np.float64)
+    offsets = np.asarray(offsets)
+    n_segments = len(offsets) - 1
+    segment_ids = np.repeat(np.arange(n_segments), np.diff(offsets))
+
+    finite = ~np.isnan(values)
+    values_0 = np.where(finite, values, 0.0)
+    counts = np.bincount(segment_ids[finite], minlength=n_segments)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(segment_ids, weights=values_0, minlength=n_segments) / counts
+        deviations = np.where(finite, values - mean[segment_ids], 0.0)
+        std = np.sqrt(np.bincount(segment_ids, weights=deviations ** 2, minlength=n_segments) / counts)
+
+    # sort the values inside each segment (NaNs are sorted last)
+    sorted_values = values[np.lexsort((values, segment_ids))]
+    median = np.full(n_segments, np.nan)
+    has_values = counts > 0
+    lower = (offsets[:-1] + (counts - 1) // 2)[has_values]
+    upper = (offsets[:-1] + counts // 2)[has_values]
+    median[has_values] = 0.5 * (sorted_values[lower] + sorted_values[upper])
+
+    return mean, median, std
+
+
+def compute_edge_fiber_measures(edges, offsets, lengths, node_volumes):
+    """ Compute the fiber number, length, proportion and density measures of all edges
+
+    density = (#fibers / mean_fibers_length) * (2 / (volume_roi_u + volume_roi_v))
+
+    Parameters
+    ----------
+    edges: int array of shape [#edges, 2] (see ``build_edge_index``)
+    offsets: int array of shape [#edges + 1] (see ``build_edge_index``)
+    lengths: fiber lengths grouped by edge
+    node_volumes: ROI volumes indexed by label
+
+    Returns
+    -------
+    measures: dictionary of arrays of shape [#edges] indexed by measure name
+    """
+    number_of_fibers = np.diff(offsets)
+    total_fibers = float(len(lengths))
+    total_volume = float(np.sum(node_volumes[np.unique(edges)]))
+
+    length_mean, length_median, length_std = compute_segment_statistics(lengths, offsets)
+
+    volumes = node_volumes[edges[:, 0]] + node_volumes[edges[:, 1]]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        density = (number_of_fibers / length_mean) * (2.0 / volumes)
+        normalized_density = ((number_of_fibers / total_fibers) / length_mean) * (2.0 * total_volume / volumes)
+    has_length = length_mean > 0.0
+
+    return {'number_of_fibers': number_of_fibers,
+            'fiber_length_mean': length_mean,
+            'fiber_length_median': length_median,
+            'fiber_length_std': length_std,
+            'fiber_proportion': 100.0 * (number_of_fibers / total_fibers),
+            'fiber_density': np.where(has_length, density, 0.0),
+            'normalized_fiber_density': np.where(has_length, normalized_density, 0.0)}
+
+
+def sample_map_along_streamlines(points, point_fibers, n_fibers, mdata, voxelSize):
+    """ Sample a scalar map at every point of every fiber in a single gather
+
+    Parameters
+    ----------
+    points: array of shape [#points, 3] with the points of all fibers (voxmm coordinates)
+    point_fibers: int array of shape [#points] with the fiber index of each point
+    n_fibers: number of fibers
+    mdata: 3D array of the scalar map
+    voxelSize: 3-tuple containing the voxel size of the scalar map
+
+    Returns
+    -------
+    (values: array of shape [#points] with the map value at each point
+             (0 for points outside the volume)
+    fiber_outside): boolean array of shape [#fibers] flagging the fibers
+                    with at least one point outside the volume
+    """
+    vox = endpoints_to_voxels(points, voxmm_to_voxel_affine(voxelSize)).astype(np.int64)
+    point_outside = np.any((vox < 0) | (vox >= np.asarray(mdata.shape[:3])), axis=1)
+    fiber_outside = np.bincount(point_fibers[point_outside], minlength=n_fibers) > 0
+
+    values = np.zeros(len(points), dtype=mdata.dtype)
+    vox_in = vox[~point_outside]
+    values[~point_outside] = mdata[vox_in[:, 0], vox_in[:, 1], vox_in[:, 2]]
+    return values, fiber_outside
+
+
+def compute_edge_map_statistics(values, point_fibers, fiber_outside, edge_fibers, edge_offsets):
+    """ Reduce the map values sampled along the fibers to per-edge statistics
+
+    The values of all the points of all the fibers of an edge are pooled.
+    Fibers leaving the map volume are discarded.
+
+    Parameters
+    ----------
+    values: array of shape [#points] (see ``sample_map_along_streamlines``)
+    point_fibers: int array of shape [#points] with the fiber index of each point
+    fiber_outside: boolean array of shape [#fibers] (see ``sample_map_along_streamlines``)
+    edge_fibers: fiber indices grouped by edge (see ``build_edge_index``)
+    edge_offsets: int array of shape [#edges + 1] (see ``build_edge_index``)
+
+    Returns
+    -------
+    (mean, median, std): float64 arrays of shape [#edges] (NaN for edges
+                         without any fiber inside the map volume)
+    """
+    n_edges = len(edge_offsets) - 1
+    fiber_edges = np.full(len(fiber_outside), -1, dtype=np.int64)
+    fiber_edges[edge_fibers] = np.repeat(np.arange(n_edges), np.diff(edge_offsets))
+    fiber_edges[fiber_outside] = -1
+
+    point_edges = fiber_edges[point_fibers]
+    selected = np.flatnonzero(point_edges >= 0)
+    order = selected[np.argsort(point_edges[selected], kind='stable')]
+
+    offsets = np.zeros(n_edges + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(point_edges[selected], minlength=n_edges))
+    return compute_segment_statistics(values[order], offsets)
+
+
+def get_fiber_edge_keys(endpoint_labels, outside, nROIs):
+    """ Return the key of the edge of each fiber (see ``build_edge_index``)
+
+    Parameters
+    ----------
+    endpoint_labels: int array of shape [#fibers, 2] (see ``get_endpoint_labels``)
+    outside: boolean array of shape [#fibers] flagging fibers outside the volume
+    nROIs: number of ROIs of the parcellation
+
+    Returns
+    -------
+    keys: int64 array of shape [#fibers] with the key ``startROI * (nROIs + 1) + endROI``
+          of each fiber connecting two ROIs (-1 for the other fibers)
+    """
+    fiberlabels, _ = get_fiber_labels(endpoint_labels, outside, nROIs)
+    keys = fiberlabels[:, 0].astype(np.int64) * (int(nROIs) + 1) + fiberlabels[:, 1]
+    keys[fiberlabels[:, 0] <= 0] = -1
+    return keys
+
+
+def compute_map_histogram_bins(mdata, n_bins):
+    """ Compute the bins of the histograms of the map values used by ``EdgeMapStatistics``
+
+    The bins are the quantiles of the non-zero voxels of the map, so that each
+    bin holds about the same number of voxels and the bins are narrow where the
+    values are frequent.
+
+    Parameters
+    ----------
+    mdata: 3D array of the scalar map
+    n_bins: number of bins
+
+    Returns
+    -------
+    bin_edges: float64 array of shape [#bins + 1] (fewer bins if the map has few distinct values)
+    """
+    values = mdata[mdata != 0]
+    if len(values) == 0:
+        values = np.asarray(mdata).ravel()
+    bin_edges = np.unique(np.quantile(values.astype(np.float64), np.linspace(0.0, 1.0, int(n_bins) + 1)))
+    if len(bin_edges) < 2:
+        bin_edges = np.repeat(bin_edges, 2)
+    return bin_edges
+
+
+class EdgeMapStatistics(object):
+    """ Running statistics of the values of a map sampled along the fibers of each edge
+
+    The values are folded chunk by chunk into per-edge aggregates of fixed size:
+    the count, mean and sum of squared deviations (merged with the pairwise
+    update of Chan et al.), the minimum and maximum, and a histogram of the
+    values with bins shared by all the edges (see ``compute_map_histogram_bins``).
+    The mean and standard deviation are exact. The median is interpolated
+    in the histogram: its error is bounded by the width of the bin containing it.
+
+    Parameters
+    ----------
+    bin_edges: increasing array of shape [#bins + 1]
+    """
+
+    def __init__(self, bin_edges):
+        self.bin_edges = np.asarray(bin_edges, dtype=np.float64)
+        n_bins = len(self.bin_edges) - 1
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.means = np.zeros(0)
+        self.m2 = np.zeros(0)
+        self.mins = np.zeros(0)
+        self.maxs = np.zeros(0)
+        self.histograms = np.zeros((0, n_bins), dtype=np.int64)
+        # number of fibers of the edges discarded because they leave the map volume
+        self.n_discarded = 0
+
+    def _insert_keys(self, keys):
+        """ Add the aggregates of new edges, keeping the edge keys sorted """
+        new_keys = np.setdiff1d(keys, self.keys, assume_unique=True)
+        if len(new_keys) == 0:
+            return
+        all_keys = np.union1d(self.keys, new_keys)
+        positions = np.searchsorted(all_keys, self.keys)
+
+        def _grow(array, fill):
+            grown = np.full((len(all_keys),) + array.shape[1:], fill, dtype=array.dtype)
+            grown[positions] = array
+            return grown
+
+        self.counts = _grow(self.counts, 0)
+        self.means = _grow(self.means, 0.0)
+        self.m2 = _grow(self.m2, 0.0)
+        self.mins = _grow(self.mins, np.inf)
+        self.maxs = _grow(self.maxs, -np.inf)
+        self.histograms = _grow(self.histograms, 0)
+        self.keys = all_keys
+
+    def update(self, keys, values):
+        """ Fold values into the aggregates of their edges
+
+        Parameters
+        ----------
+        keys: int array of shape [#values] with the edge key of each value
+        values: array of shape [#values]
+        """
+        if len(values) == 0:
+            return
+        chunk_keys, ids = np.unique(keys, return_inverse=True)
+        self._insert_keys(chunk_keys)
+        slots = np.searchsorted(self.keys, chunk_keys)
+        values = np.asarray(values, dtype=np.float64)
+        n_keys = len(chunk_keys)
+        n_bins = self.histograms.shape[1]
+
+        # moments of the chunk, merged with the moments of the previous chunks
+        counts = np.bincount(ids, minlength=n_keys)
+        means = np.bincount(ids, weights=values, minlength=n_keys) / counts
+        m2 = np.bincount(ids, weights=(values - means[ids]) ** 2, minlength=n_keys)
+        previous_counts = self.counts[slots].astype(np.float64)
+        total = previous_counts + counts
+        delta = means - self.means[slots]
+        self.means[slots] += delta * counts / total
+        self.m2[slots] += m2 + delta ** 2 * previous_counts * counts / total
+        self.counts[slots] += counts
+
+        order = np.argsort(ids, kind='stable')
+        starts = np.zeros(n_keys, dtype=np.int64)
+        starts[1:] = np.cumsum(counts)[:-1]
+        self.mins[slots] = np.minimum(self.mins[slots], np.minimum.reduceat(values[order], starts))
+        self.maxs[slots] = np.maximum(self.maxs[slots], np.maximum.reduceat(values[order], starts))
+
+        bins = np.clip(np.searchsorted(self.bin_edges, values, side='right') - 1, 0, n_bins - 1)
+        self.histograms[slots] += np.bincount(ids * n_bins + bins, minlength=n_keys * n_bins).reshape(n_keys, n_bins)
+
+    def compute_medians(self):
+        """ Interpolate the median of each edge in its histogram """
+        n_bins = self.histograms.shape[1]
+        rows = np.arange(len(self.keys))
+        cumulative = np.cumsum(self.histograms, axis=1)
+        half = 0.5 * self.counts
+        # bin containing the median
+        b = np.minimum(np.count_nonzero(cumulative < half[:, np.newaxis], axis=1), n_bins - 1)
+        before = cumulative[rows, b] - self.histograms[rows, b]
+        # the values out of the bin range are counted in the first / last bin
+        low = np.where(b == 0, self.mins, np.clip(self.bin_edges[b], self.mins, self.maxs))
+        high = np.where(b == n_bins - 1, self.maxs, np.clip(self.bin_edges[b + 1], self.mins, self.maxs))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            t = np.clip((half - before) / self.histograms[rows, b], 0.0, 1.0)
+        return low + t * (high - low)
+
+    def summarize(self):
+        """ Return the edge keys and their mean, median and standard deviation (dictionary of arrays) """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            std = np.sqrt(self.m2 / self.counts)
+        return {'keys': self.keys, 'mean': self.means, 'median': self.compute_medians(), 'std': std,
+                'n_discarded': np.array([self.n_discarded], dtype=np.int64)}
+
+
+def update_edge_map_statistics(statistics, points, fiber_offsets, scale_fiber_keys, mdata, voxelSize):
+    """ Sample a map along a chunk of fibers and fold the values into the edge statistics of each resolution
+
+    The fibers leaving the map volume are discarded, as in ``compute_edge_map_statistics``.
+
+    Parameters
+    ----------
+    statistics: ``EdgeMapStatistics`` of each resolution
+    points: array of shape [#points, 3] with the points of the fibers of the chunk
+    fiber_offsets: int array of shape [#fibers + 1] (see ``cmtklib.streamlines.streamlines_to_buffer``)
+    scale_fiber_keys: edge key of each fiber of the chunk for each resolution (see ``get_fiber_edge_keys``)
+    mdata: 3D array of the scalar map
+    voxelSize: 3-tuple containing the voxel size of the scalar map
+    """
+    point_fibers = get_point_streamlines(fiber_offsets)
+    values, fiber_outside = sample_map_along_streamlines(points, point_fibers, len(fiber_offsets) - 1, mdata,
+                                                         voxelSize)
+    for stats, fiber_keys in zip(statistics, scale_fiber_keys):
+        stats.n_discarded += int(np.count_nonzero(fiber_outside & (fiber_keys >= 0)))
+        point_keys = np.where(fiber_outside, -1, fiber_keys)[point_fibers]
+        kept = point_keys >= 0
+        stats.update(point_keys[kept], values[kept])
+
+
+def compute_edge_map_statistics_by_chunks(points, fiber_offsets, scale_fiber_keys, mdata, voxelSize, sketch_size,
+                                          chunk_size=100000):
+    """ Compute the per-edge map statistics of each resolution from fibers loaded in memory
+
+    The map is sampled along ``chunk_size`` fibers at a time and the values are
+    folded into ``EdgeMapStatistics``, as in ``compute_fiber_data_from_chunks``,
+    so that the values of all the points are never held at once.
+
+    Parameters
+    ----------
+    points: array of shape [#points, 3] with the points of all fibers
+    fiber_offsets: int array of shape [#fibers + 1] (see ``cmtklib.streamlines.streamlines_to_buffer``)
+    scale_fiber_keys: edge key of each fiber for each resolution (see ``get_fiber_edge_keys``)
+    mdata: 3D array of the scalar map
+    voxelSize: 3-tuple containing the voxel size of the scalar map
+    sketch_size: number of bins of the per-edge histograms
+    chunk_size: number of fibers sampled at once
+
+    Returns
+    -------
+    summaries: statistics of each resolution (see ``EdgeMapStatistics.summarize``)
+    """
+    bin_edges = compute_map_histogram_bins(mdata, sketch_size)
+    statistics = [EdgeMapStatistics(bin_edges) for _ in scale_fiber_keys]
+    n = len(fiber_offsets) - 1
+    for f0 in range(0, n, chunk_size):
+        f1 = min(f0 + chunk_size, n)
+        o0, o1 = fiber_offsets[f0], fiber_offsets[f1]
+        update_edge_map_statistics(statistics, points[o0:o1], fiber_offsets[f0:f1 + 1] - o0,
+                                   [fiber_keys[f0:f1] for fiber_keys in scale_fiber_keys], mdata, voxelSize)
+    return [stats.summarize() for stats in statistics]
+
+
+def lookup_edge_map_statistics(summary, edge_keys):
+    """ Return the map statistics of given edges from a summary of ``EdgeMapStatistics``
+
+    Returns
+    -------
+    (mean, median, std): float64 arrays of shape [#edges] (NaN for edges
+                         without any fiber inside the map volume)
+    """
+    keys = np.asarray(summary['keys'])
+    positions = np.searchsorted(keys, edge_keys)
+    found = positions < len(keys)
+    found[found] = keys[positions[found]] == edge_keys[found]
+    statistics = []
+    for name in ('mean', 'median', 'std'):
+        values = np.full(len(edge_keys), np.nan)
+        values[found] = np.asarray(summary[name])[positions[found]]
+        statistics.append(values)
+    return tuple(statistics)
+
+
+def create_endpoints_array(fib, voxelSize, print_info):
+    """ Create the endpoints arrays for each fiber
+
+    Parameters
+    ----------
+    fib: the fibers data
+    voxelSize: 3-tuple containing the voxel size of the ROI image
+
+    Returns
+    -------
+    (endpoints: matrix of size [#fibers, 2, 3] containing for each fiber the
+               index of its first and last point in the voxelSize volume
+    endpointsmm) : endpoints in milimeter coordinates
+
+    """
+    if print_info:
+        print("========================")
+        print("create_endpoints_array")
+
+    # Gather the first and last point of each fiber
     n = len(fib)
+    endpointsmm = np.zeros((n, 2, 3))
+    if n > 0:
+        endpointsmm[:, 0, :] = [fi[0][0] for fi in fib]
+        endpointsmm[:, 1, :] = [fi[0][-1] for fi in fib]
+
+    # Translate from mm to index
+    endpoints = endpoints_to_voxels(endpointsmm, voxmm_to_voxel_affine(voxelSize))
+
+    # Return the matrices
+    return (endpoints, endpointsmm)
+
+
+def compress_fibers(fibers, compression_error, number_of_threads=1):
+    """ Compress trackvis fibers by linearization (see ``cmtklib.streamlines.compute_compression_mask``)
+
+    Parameters
+    ----------
+    fibers: list of (points, scalars, properties) tuples as returned by ``nib.trackvis.read``
+    compression_error: maximal distance (in mm) between a dropped point and the compressed fiber
+    number_of_threads: number of threads used to compress chunks of fibers in parallel
+
+    Returns
+    -------
+    compressed: list of (points, scalars, properties) tuples
+    """
+    _, masks = compress_streamlines([fi[0] for fi in fibers], compression_error,
+                                    number_of_threads=number_of_threads)
+    return [(fi[0][m], fi[1][m] if fi[1] is not None else None, fi[2]) for fi, m in zip(fibers, masks)]
+
+
+def save_fibers(oldhdr, oldfib, fname, indices, compression_error=0, number_of_threads=1):
+    """ Stores a new trackvis file fname using only given indices
+
+    If ``compression_error`` (in mm) is set, the fibers are compressed before
+    being written (see ``compress_fibers``).
+
+    Returns
+    -------
+    n_points: number of points of each fiber written in the file
+    """
+
+    hdrnew = oldhdr.copy()
+
+    outstreams = []
+    for i in indices:
+        outstreams.append(oldfib[i])
+
+    if compression_error:
+        outstreams = compress_fibers(outstreams, compression_error, number_of_threads)
+
+    n_fib_out = len(outstreams)
+    hdrnew['n_count'] = n_fib_out
+
+    print("Writing final no orphan fibers: %s" % fname)
+    nib.trackvis.write(fname, outstreams, hdrnew)
+    return np.array([len(fi[0]) for fi in outstreams], dtype=np.int64)
+
+
+class FiberSubset(object):
+    """ Iterable over the fibers of a trackvis file with given indices, read one at a time
+
+    It has a length so that ``nib.trackvis.write`` fills the ``n_count`` header field.
+    If ``compression_error`` is set, the fibers are compressed by batches of
+    ``batch_size`` fibers (see ``compress_fibers``). The number of points of the
+    fibers read so far is stored in ``n_points``.
+    """
+
+    def __init__(self, intrk, indices, compression_error=0, number_of_threads=1, batch_size=10000):
+        self.intrk = intrk
+        self.indices = np.asarray(indices)
+        self.compression_error = compression_error
+        self.number_of_threads = number_of_threads
+        self.batch_size = batch_size
+        self.n_points = []
+
+    def __len__(self):
+        return len(self.indices)
+
+    def _iter_fibers(self):
+        fib_iter, hdr = nib.trackvis.read(self.intrk, as_generator=True)
+        keep = np.zeros(self.indices.max() + 1 if len(self.indices) > 0 else 0, dtype=bool)
+        keep[self.indices] = True
+        for i, fi in enumerate(fib_iter):
+            if i >= len(keep):
+                break
+            if keep[i]:
+                yield fi
+
+    def _iter_batches(self):
+        batch = []
+        for fi in self._iter_fibers():
+            batch.append(fi)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def __iter__(self):
+        self.n_points = []
+        for batch in self._iter_batches():
+            if self.compression_error:
+                batch = compress_fibers(batch, self.compression_error, self.number_of_threads)
+            for fi in batch:
+                self.n_points.append(len(fi[0]))
+                yield fi
+
+
+def save_fibers_from_file(intrk, oldhdr, fname, indices, compression_error=0, number_of_threads=1):
+    """ Stores a new trackvis file fname using only given indices of the fibers of intrk
+
+    Same as ``save_fibers`` except that the fibers are streamed from intrk
+    instead of being all loaded in memory.
+    """
+    hdrnew = oldhdr.copy()
+    hdrnew['n_count'] = len(indices)
+
+    print("Writing final no orphan fibers: %s" % fname)
+    fibers = FiberSubset(intrk, indices, compression_error, number_of_threads)
+    nib.trackvis.write(fname, fibers, hdrnew)
+    return np.array(fibers.n_points, dtype=np.int64)
+
+
+def estimate_fiber_chunk_size(intrk, hdr, n_fibers, memory_budget):
+    """ Estimate the number of fibers that can be processed at once under a memory budget
+
+    The average number of points per fiber is estimated from the size of the
+    trackvis file. Each point requires about 128 bytes of working memory
+    (loaded float32 coordinates, float64 coordinates and voxel indices,
+    sampled map values) and each fiber about 512 bytes of overhead.
+    Only the working memory of one chunk is budgeted, not the per-fiber and
+    per-edge arrays accumulated over the chunks (see ``cmat``).
+
+    Parameters
+    ----------
+    intrk: trackvis file
+    hdr: header of the trackvis file
+    n_fibers: number of fibers in the trackvis file
+    memory_budget: memory budget in MB
+
+    Returns
+    -------
+    chunk_size: number of fibers per chunk
+    """
+    point_bytes = 4 * (3 + int(hdr['n_scalars']))
+    data_bytes = max(os.path.getsize(intrk) - hdr.nbytes, 0)
+    points_per_fiber = float(data_bytes) / max(n_fibers, 1) / point_bytes
+    fiber_bytes = 128 * points_per_fiber + 512
+    return max(int(memory_budget * 1024 ** 2 / fiber_bytes), 1)
+
+
+class NpyFileWriter(object):
+    """ Write an array to a ``.npy`` file by blocks of rows, without holding it in memory
+
+    The number of rows does not need to be known in advance: the shape in the
+    header is updated when the writer is closed, and the file then holds a
+    standard ``.npy`` array.
+
+    Parameters
+    ----------
+    fname: output ``.npy`` file
+    row_shape: shape of each row of the array (e.g. (2, 3) for an array of shape [#fibers, 2, 3])
+    dtype: data type of the array
+    """
+
+    # size of the .npy header, large enough for any shape with a few dimensions
+    header_size = 128
+
+    def __init__(self, fname, row_shape, dtype):
+        self.fname = fname
+        self.row_shape = tuple(row_shape)
+        self.dtype = np.dtype(dtype)
+        self.n_rows = 0
+        self.fileobj = open(fname, 'wb')
+        self._write_header()
+
+    def _write_header(self):
+        header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (
+            np.lib.format.dtype_to_descr(self.dtype), (self.n_rows,) + self.row_shape)
+        magic = np.lib.format.magic(1, 0)
+        # the header is padded with spaces to a fixed size so that it can be rewritten in place
+        header_length = self.header_size - len(magic) - 2
+        self.fileobj.seek(0)
+        self.fileobj.write(magic + np.array(header_length, dtype='<u2').tobytes() +
+                           (header.ljust(header_length - 1) + '\n').encode('latin1'))
+        self.fileobj.seek(0, os.SEEK_END)
+
+    def write(self, rows):
+        """ Append rows (array of shape [#rows] + row_shape) to the array """
+        rows = np.ascontiguousarray(rows, dtype=self.dtype).reshape((-1,) + self.row_shape)
+        self.fileobj.write(rows.tobytes())
+        self.n_rows += len(rows)
+
+    def close(self):
+        """ Write the final shape in the header and return the array memory-mapped in read-only mode """
+        self._write_header()
+        self.fileobj.close()
+        if self.n_rows == 0:
+            return np.zeros((0,) + self.row_shape, dtype=self.dtype)
+        return np.load(self.fname, mmap_mode='r')
+
+
+def compute_fiber_data_from_chunks(fiber_chunks, roi_data, roi_voxel_size, additional_maps, compute_curvature,
+                                   fiber_dir, n_rois, number_of_threads=1, sketch_size=16, label_mappings=None,
+                                   chunk_callback=None):
+    """ Compute the per-fiber data used by ``cmat`` from a stream of chunks of fibers
+
+    Only one chunk of fibers is held in memory at a time, so that the fibers
+    can come from a file read by chunks or directly from a tracking algorithm.
+    Once the fibers of a chunk are labeled, the map values sampled along them
+    are folded into fixed-size per-edge aggregates for each resolution (see
+    ``EdgeMapStatistics``) before the next chunk is processed. The per-fiber arrays are appended chunk by chunk to ``.npy``
+    files (see ``NpyFileWriter``) and returned memory-mapped: the endpoints (and
+    curvature) arrays are saved to ``endpoints.npy`` and ``endpointsmm.npy``
+    (and ``meancurvature.npy``), the lengths to ``fiberslength.npy`` and the other
+    arrays to ``fiber_dir``.
+
+    Parameters
+    ----------
+    fiber_chunks: iterable of lists of fibers (arrays of points in trackvis voxmm coordinates)
+    roi_data: ROI volumes of all resolutions stacked along the last axis
+    roi_voxel_size: 3-tuple containing the voxel size of the ROI volumes
+    additional_maps: dictionary of the additional map files indexed by map name
+    compute_curvature: compute the mean curvature of the fibers if True
+    fiber_dir: directory where the per-fiber arrays which are not outputs of ``cmat`` are written
+    n_rois: number of ROIs of each resolution
+    number_of_threads: number of threads used to compute the fiber lengths and curvatures
+    sketch_size: number of bins of the per-edge histograms of the map values (see ``EdgeMapStatistics``)
+    label_mappings: None, or the label mappings deriving the labels of all resolutions from the
+                    labels looked up in roi_data (see ``get_label_lookup_volume``)
+    chunk_callback: function called after each chunk with the index of its first
+                    fiber, its fibers and their endpoint labels (all resolutions) and outside flags
+
+    Returns
+    -------
+    fiber_data: dictionary with the per-fiber arrays and the per-edge map statistics
+                of each resolution (see ``compute_scale_connectome``)
+    """
+    maps = {}
+    map_statistics = {}
+    for k, v in list(additional_maps.items()):
+        da = nib.load(v)
+        maps[k] = (np.nan_to_num(da.get_data()), da.get_header().get_zooms())
+        bin_edges = compute_map_histogram_bins(maps[k][0], sketch_size)
+        map_statistics[k] = [EdgeMapStatistics(bin_edges) for _ in n_rois]
+
+    n_resolutions = roi_data.shape[-1] if label_mappings is None else len(label_mappings)
+    writers = {'endpoints': NpyFileWriter('endpoints.npy', (2, 3), np.float64),
+               'endpointsmm': NpyFileWriter('endpointsmm.npy', (2, 3), np.float64),
+               'lengths': NpyFileWriter('fiberslength.npy', (), np.float64),
+               'labels': NpyFileWriter(op.join(fiber_dir, 'labels.npy'), (2, n_resolutions), np.int32),
+               'outside': NpyFileWriter(op.join(fiber_dir, 'outside.npy'), (), bool)}
+    if compute_curvature:
+        writers['meancurv'] = NpyFileWriter('meancurvature.npy', (1,), np.float64)
+
+    start = 0
+    for fib in fiber_chunks:
+        if len(fib) == 0:
+            continue
+        stop = start + len(fib)
+
+        # create_endpoints_array expects the records of nib.trackvis.read
+        chunk_endpoints, chunk_endpointsmm = create_endpoints_array([(fi, None, None) for fi in fib],
+                                                                    roi_voxel_size, False)
+        chunk_labels, chunk_outside = get_endpoint_labels(chunk_endpoints, roi_data)
+        chunk_labels = map_multiscale_labels(chunk_labels, label_mappings)
+        writers['endpoints'].write(chunk_endpoints)
+        writers['endpointsmm'].write(chunk_endpointsmm)
+        writers['labels'].write(chunk_labels)
+        writers['outside'].write(chunk_outside)
+        if chunk_callback is not None:
+            chunk_callback(start, fib, chunk_labels, chunk_outside)
+
+        points, fiber_offsets = streamlines_to_buffer(fib)
+        del fib
+        writers['lengths'].write(compute_lengths(points, fiber_offsets, number_of_threads))
+        if compute_curvature:
+            writers['meancurv'].write(compute_mean_curvatures(points, fiber_offsets, number_of_threads))
+
+        if maps:
+            scale_fiber_keys = [get_fiber_edge_keys(chunk_labels[:, :, r], chunk_outside, nROIs)
+                                for r, nROIs in enumerate(n_rois)]
+        for k, (mdata, zooms) in list(maps.items()):
+            update_edge_map_statistics(map_statistics[k], points, fiber_offsets, scale_fiber_keys, mdata, zooms)
+        del points
+
+        print("  ... %i fibers" % stop)
+        start = stop
+
+    arrays = dict((name, writer.close()) for name, writer in writers.items())
+    fiber_data = {'labels': arrays['labels'],
+                  'outside': arrays['outside'],
+                  'lengths': arrays['lengths'],
+                  'maps': {},
+                  'edge_maps': dict((k, tuple(stats.summarize() for stats in map_statistics[k])) for k in maps)}
+    return fiber_data
+
+
+def iter_streamline_chunks(streamlines, chunk_size):
+    """ Group an iterable of streamlines in lists of chunk_size streamlines """
+    streamlines = iter(streamlines)
+    while True:
+        fib = [pts for _, pts in zip(range(chunk_size), streamlines)]
+        if len(fib) == 0:
+            break
+        yield fib
+
+
+def iter_trk_chunks(intrk, chunk_size):
+    """ Read the fibers of a trackvis file by chunks of chunk_size fibers (points only) """
+    fib_iter, _ = nib.trackvis.read(intrk, as_generator=True)
+    return iter_streamline_chunks((fi[0] for fi in fib_iter), chunk_size)
+
+
+def compute_fiber_data_by_chunks(intrk, roi_data, roi_voxel_size, additional_maps, compute_curvature,
+                                 memory_budget, fiber_dir, n_rois, number_of_threads=1, sketch_size=16,
+                                 label_mappings=None):
+    """ Compute the per-fiber data used by ``cmat`` reading the fibers by chunks
+
+    The chunks fit in ``memory_budget`` (see ``compute_fiber_data_from_chunks``).
+
+    Parameters
+    ----------
+    intrk: trackvis file
+    roi_data: ROI volumes of all resolutions stacked along the last axis
+    roi_voxel_size: 3-tuple containing the voxel size of the ROI volumes
+    additional_maps: dictionary of the additional map files indexed by map name
+    compute_curvature: compute the mean curvature of the fibers if True
+    memory_budget: memory budget in MB for one chunk of fibers
+    fiber_dir: directory where the per-fiber arrays which are not outputs of ``cmat`` are written
+    n_rois: number of ROIs of each resolution
+    number_of_threads: number of threads used to compute the fiber lengths and curvatures
+    sketch_size: number of bins of the per-edge histograms of the map values (see ``EdgeMapStatistics``)
+    label_mappings: see ``compute_fiber_data_from_chunks``
+
+    Returns
+    -------
+    (fiber_data: dictionary with the per-fiber arrays (see ``compute_scale_connectome``)
+    hdr): header of the trackvis file
+    """
+    fib_iter, hdr = nib.trackvis.read(intrk, as_generator=True)
+    n = int(hdr['n_count'])
+    if n == 0:
+        # the number of fibers is not stored in the header
+        n = sum(1 for _ in fib_iter)
+
+    chunk_size = estimate_fiber_chunk_size(intrk, hdr, n, memory_budget)
+    print("  >> Process the %i fibers by chunks of %i fibers (memory budget: %i MB)" % (n, chunk_size,
+                                                                                       memory_budget))
+    fiber_data = compute_fiber_data_from_chunks(iter_trk_chunks(intrk, chunk_size), roi_data, roi_voxel_size,
+                                                additional_maps, compute_curvature, fiber_dir, n_rois,
+                                                number_of_threads, sketch_size, label_mappings)
+    return fiber_data, hdr
+
+
+def create_trk_header(affine, shape, voxel_size, voxel_order=None):
+    """ Create the header of a trackvis file for fibers in the voxmm coordinates of an image grid
+
+    Parameters
+    ----------
+    affine: voxel to RAS+ mm affine of the image
+    shape: dimensions of the image
+    voxel_size: voxel size of the image
+    voxel_order: voxel order of the image (default: deduced from the affine)
+
+    Returns
+    -------
+    hdr: trackvis header (``nib.trackvis`` format)
+    """
+    from nibabel.orientations import aff2axcodes
+
+    hdr = nib.trackvis.empty_header()
+    hdr['dim'] = tuple(shape[:3])
+    hdr['voxel_size'] = tuple(voxel_size[:3])
+    if voxel_order is None:
+        voxel_order = "".join(aff2axcodes(affine))
+    hdr['voxel_order'] = voxel_order
+    hdr['vox_to_ras'] = np.asarray(affine).copy()
+    return hdr
+
+
+def map_rasmm_streamlines(streamlines, reference_image):
+    """ Map fibers in RAS+ mm coordinates (e.g. generated by a tracking) to the trackvis voxmm coordinates of an image
+
+    The fibers are mapped one at a time as they are consumed (see ``iter_rasmm_to_voxmm``).
+
+    Parameters
+    ----------
+    streamlines: iterable of arrays of shape [#points, 3] in RAS+ mm coordinates
+    reference_image: image or image file defining the voxel grid of the fibers
+
+    Returns
+    -------
+    (streamlines: generator of float32 arrays of shape [#points, 3]
+    hdr): trackvis header (``nib.trackvis`` format) of the voxmm coordinates
+    """
+    ref = nib.load(reference_image) if isinstance(reference_image, str) else reference_image
+    hdr = create_trk_header(ref.affine, ref.shape, ref.header.get_zooms())
+    return iter_rasmm_to_voxmm(streamlines, ref.affine, ref.header.get_zooms()), hdr
+
+
+def load_tractogram(track_file, reference_image=None, lazy=False):
+    """ Load a tractogram supported by ``nib.streamlines`` (.tck, .trk) with the fibers in trackvis voxmm coordinates
+
+    The fibers of a .tck file are in RAS+ mm coordinates and are mapped to
+    the voxel grid of ``reference_image``. The fibers of a .trk file are
+    mapped to the voxel grid described in its header.
+
+    Parameters
+    ----------
+    track_file: tractogram file
+    reference_image: image defining the voxel grid of the fibers (required for .tck files)
+    lazy: return a generator reading the fibers one at a time instead of a list
+
+    Returns
+    -------
+    (streamlines: list or generator of float32 arrays of shape [#points, 3]
+    hdr: trackvis header (``nib.trackvis`` format) of the voxmm coordinates
+    n_fibers): number of fibers stored in the file header (0 if unknown)
+    """
+    from nibabel.streamlines import Field
+    from nibabel.streamlines.trk import get_affine_rasmm_to_trackvis
+
+    tractogram_file = nib.streamlines.load(track_file, lazy_load=lazy)
+    header = tractogram_file.header
+    if isinstance(tractogram_file, nib.streamlines.TrkFile):
+        voxel_order = header[Field.VOXEL_ORDER]
+        if isinstance(voxel_order, bytes):
+            voxel_order = voxel_order.decode('latin1')
+        hdr = create_trk_header(header[Field.VOXEL_TO_RASMM], header[Field.DIMENSIONS], header[Field.VOXEL_SIZES],
+                                voxel_order)
+        rasmm_to_voxmm = get_affine_rasmm_to_trackvis(header)
+        streamlines = (nib.affines.apply_affine(rasmm_to_voxmm, pts).astype(np.float32)
+                       for pts in tractogram_file.streamlines)
+    else:
+        if reference_image is None:
+            raise ValueError('A reference image is required to map the fibers of %s to voxels' % track_file)
+        streamlines, hdr = map_rasmm_streamlines(tractogram_file.streamlines, reference_image)
+
+    if not lazy:
+        streamlines = list(streamlines)
+    n_fibers = int(header.get(Field.NB_STREAMLINES, 0) or 0)
+    return streamlines, hdr, n_fibers
+
+
+class TrkChunkWriter(object):
+    """ Write a trackvis file chunk by chunk of fibers
+
+    The number of fibers is written in the header when the writer is closed.
+    If ``compression_error`` is set, the fibers are compressed before being
+    written (see ``cmtklib.streamlines.compress_streamlines``). The number of
+    points of the written fibers is stored in ``n_points``.
+    """
+
+    def __init__(self, fname, hdr, compression_error=0, number_of_threads=1):
+        self.compression_error = compression_error
+        self.number_of_threads = number_of_threads
+        self.n_points = []
+        self.hdr = hdr.copy()
+        if int(self.hdr['n_scalars']) != 0 or int(self.hdr['n_properties']) != 0:
+            raise ValueError('Only fibers without scalars and properties can be written by chunks')
+        self.hdr['n_count'] = 0
+        self.fileobj = open(fname, 'wb')
+        self.fileobj.write(self.hdr.tobytes())
+
+    def write(self, fibers):
+        """ Append a list of fibers (arrays of points in trackvis voxmm coordinates) """
+        int_dtype = np.dtype(np.int32).newbyteorder(self.hdr.dtype['n_count'].byteorder)
+        float_dtype = np.dtype(np.float32).newbyteorder(self.hdr.dtype['n_count'].byteorder)
+        if self.compression_error:
+            fibers, _ = compress_streamlines(fibers, self.compression_error,
+                                             number_of_threads=self.number_of_threads)
+        for pts in fibers:
+            self.n_points.append(len(pts))
+            self.fileobj.write(np.array([len(pts)], dtype=int_dtype).tobytes())
+            self.fileobj.write(np.asarray(pts, dtype=float_dtype).tobytes())
+        self.hdr['n_count'] += len(fibers)
+
+    def close(self):
+        self.fileobj.seek(0)
+        self.fileobj.write(self.hdr.tobytes())
+        self.fileobj.close()
+
+
+def get_trk_record_offsets(n_points, hdr):
+    """ Compute the byte offsets of consecutive streamlines in a trackvis file
+
+    Parameters
+    ----------
+    n_points: number of points of each streamline, in the order of the file
+    hdr: trackvis header (for the number of scalars and properties)
+
+    Returns
+    -------
+    offsets: int64 array of shape [#streamlines] with the position of the record
+             of each streamline in the file
+    """
+    record_sizes = 4 + 4 * (np.asarray(n_points, dtype=np.int64) * (3 + int(hdr['n_scalars'])) +
+                            int(hdr['n_properties']))
+    offsets = np.full(len(record_sizes), 1000, dtype=np.int64)
+    offsets[1:] += np.cumsum(record_sizes)[:-1]
+    return offsets
+
+
+STREAMLINE_INDEX_ARRAYS = ('edge_keys', 'number_of_keys', 'edges', 'offsets', 'tractogram_fibers', 'fibers',
+                           'byte_offsets')
+
+
+def save_streamline_index(prefix, edges, edge_offsets, edge_fibers, nROIs, final_fibers_idx, final_n_points, hdr):
+    """ Save the streamlines of each edge of a connectome as a CSR index
+
+    Each array is saved in its own ``<prefix>_<name>.npy`` file, so that it can
+    be memory-mapped (see ``load_streamline_index``). The arrays are
+
+    - ``edge_keys``: the key ``startROI * number_of_keys + endROI`` of each edge, sorted
+    - ``number_of_keys``: number of ROIs + 1
+    - ``edges``: the (startROI, endROI) pair of each edge
+    - ``offsets``: the streamlines of edge ``e`` are at positions
+      ``offsets[e]:offsets[e + 1]`` of the following arrays
+    - ``tractogram_fibers``: index of each streamline in the input tractogram
+    - ``fibers``: index of each streamline in ``streamline_final.trk`` (-1 if it is not stored in it)
+    - ``byte_offsets``: position of the record of each streamline in ``streamline_final.trk`` (-1 if it is
+      not stored in it)
+
+    Parameters
+    ----------
+    prefix: prefix of the output ``.npy`` files
+    edges, edge_offsets, edge_fibers: CSR index of the edges (see ``build_edge_index``)
+    nROIs: number of ROIs of the parcellation
+    final_fibers_idx: indices of the fibers stored in ``streamline_final.trk``, sorted
+    final_n_points: number of points of the fibers stored in ``streamline_final.trk``
+    hdr: header of ``streamline_final.trk``
+
+    Returns
+    -------
+    fnames: list of the saved ``.npy`` files
+    """
+    n_keys = int(nROIs) + 1
+    edge_fibers = np.asarray(edge_fibers, dtype=np.int64)
+    final_fibers_idx = np.asarray(final_fibers_idx, dtype=np.int64)
+
+    # position of the fibers in streamline_final.trk
+    positions = np.searchsorted(final_fibers_idx, edge_fibers)
+    stored = positions < len(final_fibers_idx)
+    stored[stored] = final_fibers_idx[positions[stored]] == edge_fibers[stored]
+    fibers = np.where(stored, positions, -1)
+    byte_offsets = np.full(len(edge_fibers), -1, dtype=np.int64)
+    byte_offsets[stored] = get_trk_record_offsets(final_n_points, hdr)[positions[stored]]
+
+    arrays = {'edge_keys': np.asarray(edges[:, 0], dtype=np.int64) * n_keys + edges[:, 1],
+              'number_of_keys': np.array(n_keys, dtype=np.int64),
+              'edges': np.asarray(edges, dtype=np.int32),
+              'offsets': np.asarray(edge_offsets, dtype=np.int64),
+              'tractogram_fibers': edge_fibers,
+              'fibers': fibers,
+              'byte_offsets': byte_offsets}
+    fnames = []
+    for name in STREAMLINE_INDEX_ARRAYS:
+        fnames.append('%s_%s.npy' % (prefix, name))
+        np.save(fnames[-1], arrays[name])
+    return fnames
+
+
+def load_streamline_index(prefix):
+    """ Memory-map the arrays of a streamline index saved by ``save_streamline_index``
+
+    Parameters
+    ----------
+    prefix: prefix of the ``.npy`` files of the index (e.g. ``streamline_index_scale1``)
+
+    Returns
+    -------
+    index: dictionary of read-only memory-mapped arrays indexed by name
+    """
+    index = {}
+    for name in STREAMLINE_INDEX_ARRAYS:
+        index[name] = np.load('%s_%s.npy' % (prefix, name), mmap_mode='r')
+    index['number_of_keys'] = int(index['number_of_keys'])
+    return index
+
+
+def get_edge_streamlines(index, startROI, endROI):
+    """ Return the streamlines connecting two ROIs from a streamline index
+
+    Parameters
+    ----------
+    index: streamline index (see ``load_streamline_index``)
+    startROI, endROI: labels of the two ROIs
+
+    Returns
+    -------
+    (fibers: index of the streamlines in ``streamline_final.trk`` (-1 if not stored in it)
+    byte_offsets: position of their records in ``streamline_final.trk`` (-1 if not stored in it)
+    tractogram_fibers): index of the streamlines in the input tractogram
+    """
+    u, v = min(startROI, endROI), max(startROI, endROI)
+    key = int(u) * int(index['number_of_keys']) + int(v)
+    e = np.searchsorted(index['edge_keys'], key)
+    if e == len(index['edge_keys']) or index['edge_keys'][e] != key:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+    start, stop = index['offsets'][e], index['offsets'][e + 1]
+    return (np.asarray(index['fibers'][start:stop]), np.asarray(index['byte_offsets'][start:stop]),
+            np.asarray(index['tractogram_fibers'][start:stop]))
+
+
+def read_trk_streamlines(trk_file, byte_offsets):
+    """ Read the streamlines of a trackvis file located at given byte offsets
+
+    Parameters
+    ----------
+    trk_file: trackvis file
+    byte_offsets: position of the records of the streamlines in the file
+
+    Returns
+    -------
+    (streamlines: list of (points, scalars, properties) tuples as returned by ``nib.trackvis.read``
+    hdr): header of the trackvis file
+    """
+    _, hdr = nib.trackvis.read(trk_file, as_generator=True)
+    with open(trk_file, 'rb') as f:
+        # the byte order is given by the header size field
+        endianness = '<' if np.frombuffer(f.read(1000)[996:1000], dtype='<i4')[0] == 1000 else '>'
+        n_s = int(hdr['n_scalars'])
+        n_p = int(hdr['n_properties'])
+        streamlines = []
+        for offset in byte_offsets:
+            f.seek(int(offset))
+            n_pts = int(np.fromfile(f, dtype=endianness + 'i4', count=1)[0])
+            pts = np.fromfile(f, dtype=endianness + 'f4', count=n_pts * (3 + n_s)).reshape(n_pts, 3 + n_s)
+            props = np.fromfile(f, dtype=endianness + 'f4', count=n_p) if n_p > 0 else None
+            streamlines.append((pts[:, :3], pts[:, 3:] if n_s > 0 else None, props))
+    return streamlines, hdr
+
+
+def extract_edge_bundle(index_prefix, trk_file, startROI, endROI, out_file=None):
+    """ Extract the bundle of streamlines connecting two ROIs without reading the whole tractogram
+
+    Parameters
+    ----------
+    index_prefix: prefix of the streamline index of the parcellation scale (``streamline_index_<scale>``)
+    trk_file: the ``streamline_final.trk`` file created with the index
+    startROI, endROI: labels of the two ROIs
+    out_file: if given, the bundle is also saved in this trackvis file
+
+    Returns
+    -------
+    streamlines: list of (points, scalars, properties) tuples as returned by ``nib.trackvis.read``
+    """
+    index = load_streamline_index(index_prefix)
+    fibers, byte_offsets, _ = get_edge_streamlines(index, startROI, endROI)
+    missing = np.count_nonzero(fibers < 0)
+    if missing > 0:
+        print("  ... WARNING - %i streamlines of the edge are not stored in %s" % (missing, trk_file))
+    streamlines, hdr = read_trk_streamlines(trk_file, byte_offsets[fibers >= 0])
+
+    if out_file is not None:
+        hdrnew = hdr.copy()
+        hdrnew['n_count'] = len(streamlines)
+        nib.trackvis.write(out_file, streamlines, hdrnew)
+    return streamlines
+
+
+def share_arrays(arrays, dirname):
+    """ Save the arrays of a (nested) dictionary as .npy files to share them between processes
+
+    Parameters
+    ----------
+    arrays: dictionary of arrays, or of dictionaries / tuples of arrays
+    dirname: directory where the .npy files are saved
+
+    Returns
+    -------
+    shared: dictionary with the same structure where the arrays are replaced by
+            the paths of the .npy files (see ``load_shared_arrays``)
+    """
+    def _share(value, name):
+        if isinstance(value, np.ndarray):
+            fname = op.join(dirname, '%s.npy' % name)
+            np.save(fname, value)
+            return fname
+        if isinstance(value, dict):
+            return dict((k, _share(v, '%s_%s' % (name, k))) for k, v in value.items())
+        if isinstance(value, tuple):
+            return tuple(_share(v, '%s_%i' % (name, i)) for i, v in enumerate(value))
+        return value
+
+    return _share(arrays, 'shared')
+
+
+def load_shared_arrays(shared):
+    """ Memory-map the .npy files of a dictionary created by ``share_arrays``
+
+    Arrays which were not shared are returned as they are.
+    """
+    if isinstance(shared, str) and shared.endswith('.npy'):
+        return np.load(shared, mmap_mode='r')
+    if isinstance(shared, dict):
+        return dict((k, load_shared_arrays(v)) for k, v in shared.items())
+    if isinstance(shared, tuple):
+        return tuple(load_shared_arrays(v) for v in shared)
+    return shared
+
+
+def order_edges_as_networkx(edges, node_ids):
+    """ Return the order in which ``networkx`` reports the edges of an undirected graph
+
+    The edges are reported node by node, in the order of the nodes in the graph,
+    and for each node in the order in which its edges were added.
+
+    Parameters
+    ----------
+    edges: int array of shape [#edges, 2] with the edges in the order in which
+           they were added to the graph
+    node_ids: node ids in the order in which they were added to the graph
+              (the nodes only added with the edges come after them)
+
+    Returns
+    -------
+    (node_order: int array with the ids of all the nodes of the graph in order
+    order: indices of the edges in the order in which they are reported
+    flip): boolean array of shape [#edges] flagging the edges reported as (v, u)
+    """
+    node_order = np.asarray(node_ids, dtype=np.int64)
+    edge_nodes = np.asarray(edges, dtype=np.int64).ravel()
+    edge_node_ids, first_index = np.unique(edge_nodes, return_index=True)
+    extra = ~np.isin(edge_node_ids, node_order)
+    node_order = np.concatenate((node_order, edge_node_ids[extra][np.argsort(first_index[extra])]))
+
+    sorter = np.argsort(node_order, kind='stable')
+    ranks = sorter[np.searchsorted(node_order, np.asarray(edges, dtype=np.int64), sorter=sorter)]
+    ranks = ranks.reshape(-1, 2)
+    flip = ranks[:, 1] < ranks[:, 0]
+    order = np.lexsort((np.arange(len(ranks)), ranks.min(axis=1)))
+    return node_order, order, flip
+
+
+def get_first_edge_keys(edge_data, order, nan_undefined=True):
+    """ Return the measures defined for the first reported edge
+
+    With ``nan_undefined``, the NaN values are measures which are not set on
+    the edge (structural connectomes). Otherwise NaN is a value like any other,
+    e.g. the correlation of an empty ROI (functional connectomes), and all
+    the measures are returned.
+    """
+    if len(order) == 0:
+        return []
+    if not nan_undefined:
+        return list(edge_data.keys())
+    return [key for key, values in edge_data.items() if not np.isnan(values[order[0]])]
+
+
+def write_connectome_tsv(fname, edges, edge_data, edge_keys, node_ids, nan_undefined=True):
+    """ Write the edges and their measures in a TSV file directly from the edge arrays
+
+    The output is the same as writing the corresponding ``networkx`` graph with
+    ``nx.write_edgelist``: the edges are written in the same order and, with
+    ``nan_undefined``, the undefined (NaN) measures of an edge are skipped.
+    Otherwise the NaN values are written as ``nan``.
+
+    Parameters
+    ----------
+    fname: TSV file
+    edges: int array of shape [#edges, 2] in the order in which they are added to the graph
+    edge_data: dictionary of arrays of shape [#edges] indexed by measure name
+    edge_keys: measures written in the TSV file
+    node_ids: node ids in the order in which they are added to the graph
+    nan_undefined: NaN values are measures which are not set on the edge (see ``get_first_edge_keys``)
+    """
+    _, order, flip = order_edges_as_networkx(edges, node_ids)
+    sources = np.where(flip, edges[:, 1], edges[:, 0])[order].tolist()
+    targets = np.where(flip, edges[:, 0], edges[:, 1])[order].tolist()
+
+    columns = []
+    for key in edge_keys:
+        values = np.asarray(edge_data[key])[order]
+        defined = ~np.isnan(values) if nan_undefined else np.ones(len(values), dtype=bool)
+        columns.append(list(zip(defined.tolist(), values.tolist())))
+
+    # Write header fields
+    with open(fname, 'w') as out_file:
+        tsv_writer = csv.writer(out_file, delimiter='\t')
+        header = ['source', 'target']
+        header = header + [key for key in edge_keys]
+        tsv_writer.writerow(header)
+    # Write list of graph edges with all connectivity metrics (edge_keys)
+    with open(fname, 'ab') as out_file:
+        for e in range(len(order)):
+            fields = [str(sources[e]), str(targets[e])]
+            fields += [str(column[e][1]) for column in columns if column[e][0]]
+            out_file.write(('\t'.join(fields) + '\n').encode('utf-8'))
+
+
+def get_connectome_matrices(edges, edge_data, edge_keys, node_ids, nan_undefined=True):
+    """ Create the dense connectivity matrix of each measure directly from the edge arrays
+
+    The matrices are the same as the ones given by ``nx.to_numpy_matrix`` for the
+    corresponding ``networkx`` graph (rows and columns in the order of the nodes,
+    1 for the edges where the measure is undefined with ``nan_undefined``, NaN
+    otherwise).
+
+    Parameters
+    ----------
+    edges: int array of shape [#edges, 2] in the order in which they are added to the graph
+    edge_data: dictionary of arrays of shape [#edges] indexed by measure name
+    edge_keys: measures for which a matrix is created
+    node_ids: node ids in the order in which they are added to the graph
+    nan_undefined: NaN values are measures which are not set on the edge (see ``get_first_edge_keys``)
+
+    Returns
+    -------
+    matrices: dictionary of arrays of shape [#nodes, #nodes] indexed by measure name
+    """
+    node_order, _, _ = order_edges_as_networkx(edges, node_ids)
+    sorter = np.argsort(node_order, kind='stable')
+    u = sorter[np.searchsorted(node_order, edges[:, 0], sorter=sorter)]
+    v = sorter[np.searchsorted(node_order, edges[:, 1], sorter=sorter)]
+
+    matrices = {}
+    for key in edge_keys:
+        values = np.asarray(edge_data[key], dtype=np.float64)
+        if nan_undefined:
+            values = np.where(np.isnan(values), 1.0, values)
+        matrix = np.zeros((len(node_order), len(node_order)))
+        matrix[u, v] = values
+        matrix[v, u] = values
+        matrices[key] = matrix
+    return matrices
+
+
+def save_connectome_npz(fname, edges, edge_data, nodes):
+    """ Save a connectome as aligned arrays in a ``.npz`` file
+
+    The file contains the sparse (COO) edge list ``edge_source`` / ``edge_target``
+    with one aligned array ``edge_<measure>`` per measure (NaN where the measure is
+    undefined), and the node table ``node_id`` with one array ``node_<attribute>``
+    per node attribute. The arrays are not compressed, so that each of them can be
+    loaded separately (see ``cmtklib.util.load_connectome_npz``).
+
+    Parameters
+    ----------
+    fname: output ``.npz`` file
+    edges: int array of shape [#edges, 2]
+    edge_data: dictionary of arrays of shape [#edges] indexed by measure name
+    nodes: list of (node id, node attribute dictionary) tuples
+    """
+    arrays = {'edge_source': np.asarray(edges[:, 0], dtype=np.int32),
+              'edge_target': np.asarray(edges[:, 1], dtype=np.int32)}
+    for key, values in edge_data.items():
+        arrays['edge_' + key] = np.asarray(values)
+
+    arrays['node_id'] = np.array([int(u) for u, _ in nodes], dtype=np.int32)
+    node_keys = list(nodes[0][1].keys()) if len(nodes) > 0 else []
+    for key in node_keys:
+        values = np.array([d[key] for _, d in nodes])
+        if values.dtype == np.object_:
+            values = values.astype(str)
+        arrays['node_' + key] = values
+    np.savez(fname, **arrays)
+
+
+def compute_scale_connectome(parkey, parval, roi_fname, r, parcellation_scheme, fiber_data, output_types):
+    """ Create the connection matrix of one resolution from the fiber data shared by all resolutions
+
+    Parameters
+    ----------
+    parkey: name of the resolution
+    parval: dictionary with the ``number_of_regions`` and the
+            ``node_information_graphml`` of the resolution
+    roi_fname: ROI volume of the resolution
+    r: index of the resolution in the label table
+    parcellation_scheme: parcellation scheme
+    fiber_data: dictionary with the per-fiber arrays computed by ``cmat``
+                (arrays or paths to ``.npy`` files, see ``share_arrays``).
+                The maps are given either as the values sampled at each point
+                (``maps`` with ``point_fibers``) or as the per-edge statistics of
+                each resolution (``edge_maps``, see ``EdgeMapStatistics``)
+    output_types: output types of the connectivity matrices
+
+    Returns
+    -------
+    (final_fibers_idx: indices of the fibers connecting two ROIs of the resolution
+    edge_index): (edges, offsets, fibers, nROIs) CSR index of the edges (see ``build_edge_index``)
+    """
+    fiber_data = load_shared_arrays(fiber_data)
+
+    print("------------------------")
+    print("Resolution = " + parkey)
+    print("------------------------")
+
+    roiData = nib.load(roi_fname).get_data()
+    n = len(fiber_data['lengths'])
+
+    # affine_vox_to_world = np.matrix(roi.affine[:3, :3])
+
+    # print "roiData shape : %s " % roiData.shape
+    # print "Affine Voxel 2 World transformation : ",affine_vox_to_world
+
+    # affine_world_to_vox = np.linalg.inv(affine_vox_to_world)
+    # origin = np.matrix(roi.affine[:3, 3]).T
+    # print "Affine World 2 Voxel transformation : ",affine_world_to_vox
+
+    # Create the matrix
+    print("  >> Create the connection matrix (%s rois)" %
+          parval['number_of_regions'])
+
+    nROIs = parval['number_of_regions']
+    G = nx.Graph()
+
+    # add node information from parcellation
+    gp = nx.read_graphml(parval['node_information_graphml'])
+    n_nodes = len(gp)
     pc = -1
-    meancurv = np.zeros((n, 1))
-    for i, fi in enumerate(fib):
+    cnt = -1
+
+    # compute the volume and the position of all the ROIs at once
+    if parcellation_scheme != "Lausanne2018":
+        label_key = "dn_correspondence_id"
+    else:
+        label_key = "dn_multiscaleID"
+    node_table = compute_roi_node_table(roiData, max([int(d[label_key]) for _, d in gp.nodes(data=True)] + [0]))
+
+    thalamic_labels = []
+    for u, d in gp.nodes(data=True):
+
         # Percent counter
-        pcN = int(round(float(100 * i) / n))
-        if pcN > pc and pcN % 1 == 0:
+        cnt += 1
+        pcN = int(round(float(100 * cnt) / n_nodes))
+        if pcN > pc and pcN % 10 == 0:
             pc = pcN
             print('%4.0f%%' % (pc))
-        meancurv[i, 0] = mean_curvature(fi[0])
 
-    return meancurv
+        G.add_node(int(u))
+        for key in d:
+            G.nodes[int(u)][key] = d[key]
+        # compute a position for the node based on the mean position of the
+        # ROI in voxel coordinates (segmentation volume )
+        if parcellation_scheme != "Lausanne2018":
+            G.nodes[int(u)]['dn_position'] = tuple(node_table['centroid'][int(d["dn_correspondence_id"])])
+            G.nodes[int(u)]['roi_volume'] = node_table['volume'][int(d["dn_correspondence_id"])]
+            # print "Add node %g - roi volume : %g " % (int(u),np.sum( roiData== int(d["dn_correspondence_id"]) ))
+            # Store parcellation labels corresponding to thalamic nuclei
+            # if gp.node[int(u)]['dn_fsname'] == 'thalamus':
+            #     thalamic_labels.append(int(u))
+        else:
+            # if int(u) == 53:
+            #    print("&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&")
+            G.nodes[int(u)]['dn_position'] = tuple(node_table['centroid'][int(d["dn_multiscaleID"])])
+            G.nodes[int(u)]['roi_volume'] = node_table['volume'][int(d["dn_multiscaleID"])]
+            # if int(u) == 53:
+            #    print("&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&")
+            # print "Add node %g - roi volume (2018): %g " % (int(u),np.sum( roiData== int(d["dn_multiscaleID"]) ))
+            # if int(u) == 53:
+            #    print("&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&")
+
+    thalamic_labels = np.array(thalamic_labels)
+    print("  ************************")
+    print('  >> Labels of thalamic nuclei :')
+    print('  {}'.format(thalamic_labels))
+    print("  ************************")
+
+    print("  >> Processing fibers and computing metrics (%s fibers)" % n)
+
+    # TODO: Refine fibers ending in thalamus
+    # if (startROI in thalamic_labels) or (endROI in thalamic_labels):
+    # Extract all thalamic nuclei the fiber is passing through
+
+    # Refine start/endROI connecting to the most probable nucleus
+
+    fiberlabels, orphans = get_fiber_labels(fiber_data['labels'][:, :, r], fiber_data['outside'], nROIs)
+    dis = int(np.count_nonzero(orphans))
+
+    final_fibers_idx = np.flatnonzero(fiberlabels[:, 0] > 0)
+    final_fiberlabels_array = fiberlabels[final_fibers_idx]
+
+    # Group the fibers by edge (CSR layout)
+    edges, edge_offsets, edge_fibers = build_edge_index(final_fiberlabels_array, final_fibers_idx, nROIs)
+
+    print(
+        "  ... INFO - Found %i (%f percent out of %i fibers) fibers that start or terminate in a voxel which is not labeled. (orphans)" % (
+            dis, dis * 100.0 / n, n))
+    print("  ... INFO - Valid fibers: %i (%f percent)" %
+          (n - dis, 100 - dis * 100.0 / n))
+
+    # print "roi : ",roi
+    # print "roiData size : ",roiData.size
+    # print "roiData shape : ",roiData.shape
+
+    # create a final fiber length array
+    final_fiberlength_array = fiber_data['lengths'][final_fibers_idx]
+
+    # ROI volumes indexed by label
+    node_volumes = np.zeros(int(nROIs) + 1)
+    for u, d in G.nodes(data=True):
+        if int(u) <= nROIs:
+            node_volumes[int(u)] = d['roi_volume']
+
+    # compute the fiber measures of all edges at once
+    edge_lengths = fiber_data['lengths'][edge_fibers]
+    edge_measures = compute_edge_fiber_measures(edges, edge_offsets, edge_lengths, node_volumes)
+
+    # reduce the additional map samples for all edges at once
+    edge_map_measures = {}
+    map_items = [(k, map_data, None) for k, map_data in fiber_data['maps'].items()]
+    map_items += [(k, None, scale_summaries[r]) for k, scale_summaries in fiber_data.get('edge_maps', {}).items()]
+    for k, map_data, summary in map_items:
+        if summary is None:
+            fiber_outside = map_data[-1]
+            n_discarded = np.count_nonzero(fiber_outside[edge_fibers])
+        else:
+            n_discarded = int(summary['n_discarded'][0])
+        if n_discarded > 0:
+            print("  ... ERROR - %i fibers leave the volume of the %s map. They are discarded for this measure." %
+                  (n_discarded, k))
+        if summary is None:
+            map_mean, map_median, map_std = compute_edge_map_statistics(map_data[0], fiber_data['point_fibers'],
+                                                                        fiber_outside, edge_fibers, edge_offsets)
+        else:
+            # per-edge statistics folded chunk by chunk (see EdgeMapStatistics)
+            edge_key_ids = edges[:, 0].astype(np.int64) * (int(nROIs) + 1) + edges[:, 1]
+            map_mean, map_median, map_std = lookup_edge_map_statistics(summary, edge_key_ids)
+        edge_map_measures[k + '_mean'] = map_mean
+        edge_map_measures[k + '_std'] = map_std
+        edge_map_measures[k + '_median'] = map_median
+
+    # All the measures aligned with the edges (NaN where a measure is undefined)
+    # maps measures are not defined if all the fibers of the edge leave the map volume
+    edge_data = {'number_of_fibers': edge_measures['number_of_fibers']}
+    for key in list(edge_measures.keys())[1:]:
+        edge_data[key] = edge_measures[key]
+    edge_data.update(edge_map_measures)
+
+    # The edges are added to the graph in the order of their first fiber, as when
+    # the fibers are processed one by one, so that the TSV, mat and graph outputs
+    # keep the networkx edge order
+    added = np.argsort(edge_fibers[edge_offsets[:-1]], kind='stable')
+    graph_edges = edges[added]
+    graph_edge_data = dict((key, np.asarray(values)[added]) for key, values in edge_data.items())
+
+    node_ids = [int(u) for u in G.nodes()]
+    _, edge_order, _ = order_edges_as_networkx(graph_edges, node_ids)
+    edge_keys = get_first_edge_keys(graph_edge_data, edge_order)
+
+    # Edges are only added to the graph once all of their measures are computed
+    G_out = G
+
+    # update edges (only needed by the graph outputs)
+    # measures to add here
+    # FIXME treat case of self-connection that gives di['fiber_length_mean'] = 0.0
+    if 'gPickle' in output_types or 'graphml' in output_types:
+        for ei in range(len(graph_edges)):
+            u = int(graph_edges[ei, 0])
+            v = int(graph_edges[ei, 1])
+
+            di = {'number_of_fibers': int(graph_edge_data['number_of_fibers'][ei])}
+            for key in list(graph_edge_data.keys())[1:]:
+                if not np.isnan(graph_edge_data[key][ei]):
+                    di[key] = float(graph_edge_data[key][ei])
+
+            G_out.add_edge(u, v)
+            for key in di:
+                G_out[u][v][key] = di[key]
+
+    print("  ************************************************")
+
+    print("  >> Save connectome maps as :")
+
+    # Storing network/graph in TSV format (by default to be BIDS compliant)
+    print('    - connectome_%s.tsv' % parkey)
+    write_connectome_tsv('connectome_%s.tsv' % parkey, graph_edges, graph_edge_data, edge_keys, node_ids)
+
+    # Storing network/graph in other formats that might be prefered by the user
+    if 'gPickle' in output_types:
+        print('    - connectome_%s.gpickle' % parkey)
+        nx.write_gpickle(G_out, 'connectome_%s.gpickle' % parkey)
+    if 'mat' in output_types:
+        # edges
+        edge_struct = get_connectome_matrices(graph_edges, graph_edge_data,
+                                              [key for key in edge_keys if key != 'fiblist'],
+                                              node_ids)
+
+        # nodes
+        size_nodes = int(parval['number_of_regions'])
+
+        # Get the node attributes/keys from the first node and then break.
+        # Change w.r.t networkx2
+        for u, d in G_out.nodes(data=True):
+            node_keys = list(d.keys())
+            break
+
+        node_struct = {}
+        for node_key in node_keys:
+            if node_key == 'dn_position':
+                node_arr = np.zeros([size_nodes, 3], dtype=np.float)
+            else:
+                node_arr = np.zeros(size_nodes, dtype=np.object_)
+
+            node_n = 0
+            for _, node_data in G_out.nodes(data=True):
+                node_arr[node_n] = node_data[node_key]
+                node_n += 1
+            node_struct[node_key] = node_arr
+        print('    - connectome_%s.mat' % parkey)
+        sio.savemat('connectome_%s.mat' % parkey, long_field_names=True,
+                    mdict={'sc': edge_struct,
+                           'nodes': node_struct})
+    if 'npz' in output_types:
+        print('    - connectome_%s.npz' % parkey)
+        save_connectome_npz('connectome_%s.npz' % parkey, edges, edge_data, list(G.nodes(data=True)))
+    if 'graphml' in output_types:
+        g2 = nx.Graph()
+        for u_gml, v_gml, d_gml in G_out.edges(data=True):
+            g2.add_edge(u_gml, v_gml)
+            for key in d_gml:
+                g2[u_gml][v_gml][key] = d_gml[key]
+        for u_gml, d_gml in G_out.nodes(data=True):
+            g2.add_node(u_gml)
+            if parcellation_scheme != "Lausanne2018":
+                g2.node[u_gml]['dn_correspondence_id'] = d_gml['dn_correspondence_id']
+            else:
+                g2.node[u_gml]['dn_multiscaleID'] = d_gml['dn_multiscaleID']
+            g2.node[u_gml]['dn_fsname'] = d_gml['dn_fsname']
+            g2.node[u_gml]['dn_hemisphere'] = d_gml['dn_hemisphere']
+            g2.node[u_gml]['dn_name'] = d_gml['dn_name']
+            g2.node[u_gml]['dn_position_x'] = d_gml['dn_position'][0]
+            g2.node[u_gml]['dn_position_y'] = d_gml['dn_position'][1]
+            g2.node[u_gml]['dn_position_z'] = d_gml['dn_position'][2]
+            g2.node[u_gml]['dn_region'] = d_gml['dn_region']
+            print('    - connectome_%s.graphml' % parkey)
+        nx.write_graphml(g2, 'connectome_%s.graphml' % parkey)
+
+    # print("Storing final fiber length array")
+    fiberlabels_fname = 'final_fiberslength_%s.npy' % str(parkey)
+    np.save(fiberlabels_fname, final_fiberlength_array)
+
+    # print("Storing all fiber labels (with orphans)")
+    fiberlabels_fname = 'filtered_fiberslabel_%s.npy' % str(parkey)
+    np.save(fiberlabels_fname, np.array(fiberlabels, dtype=np.int32), )
+
+    # print("Storing final fiber labels (no orphans)")
+    fiberlabels_noorphans_fname = 'final_fiberlabels_%s.npy' % str(parkey)
+    np.save(fiberlabels_noorphans_fname, final_fiberlabels_array)
+
+    return final_fibers_idx, (edges, edge_offsets, edge_fibers, nROIs)
+
+
+def get_resolutions(parcellation_scheme, roi_graphmls, atlas_info):
+    """ Return the resolutions of a parcellation scheme
+
+    Parameters
+    ----------
+    parcellation_scheme: parcellation scheme
+    roi_graphmls: GraphML description of the ROI volumes (Lausanne2018)
+    atlas_info: resolutions of a custom atlas
+
+    Returns
+    -------
+    resolutions: dictionary with the ``number_of_regions`` and the
+                 ``node_information_graphml`` of each resolution
+    """
+    if parcellation_scheme != "Custom":
+        if parcellation_scheme != "Lausanne2018":
+            # print "get resolutions from parcellation_scheme"
+            resolutions = get_parcellation(parcellation_scheme)
+        else:
+            resolutions = get_parcellation(parcellation_scheme)
+            for parkey, parval in list(resolutions.items()):
+                for graphml in roi_graphmls:
+                    if parkey in graphml:
+                        roi_graphml_fname = graphml
+                        # print roi_graphml_fname
+                resolutions[parkey]['node_information_graphml'] = op.abspath(
+                    roi_graphml_fname)
+
+            # print("##################################################")
+            # print("Atlas info (Lausanne2018) :")
+            # print(resolutions)
+            # print("##################################################")
+    else:
+        # print "get resolutions from atlas_info: "
+        resolutions = atlas_info
+        # print resolutions
+
+    # print "resolutions : %s" % resolutions
+    return resolutions
+
+
+def load_roi_volumes(resolutions, roi_volumes, parcellation_scheme):
+    """ Open the ROI volume of each resolution
+
+    The number of regions of the Lausanne2018 resolutions is updated from the volumes.
+
+    Returns
+    -------
+    (roi_fnames: ROI volume file of each resolution
+    roi_datas): ROI volume data of each resolution
+    """
+    roi_fnames = []
+    roi_datas = []
+    for parkey, parval in list(resolutions.items()):
+        for vol in roi_volumes:
+            if (parkey in vol) or (len(roi_volumes) == 1):
+                roi_fname = vol
+                # print roi_fname
+        roiData = nib.load(roi_fname).get_data()
+        if parcellation_scheme == "Lausanne2018":
+            parval['number_of_regions'] = roiData.max()
+        roi_fnames.append(roi_fname)
+        roi_datas.append(roiData)
+
+    return roi_fnames, roi_datas
 
 
-def create_endpoints_array(fib, voxelSize, print_info):
-    """ Create the endpoints arrays for each fiber
+def get_label_lookup_volume(roi_datas, hierarchical_scales=False, voxel_size=None, max_endpoint_distance=0):
+    """ Return the volume in which the endpoint labels of all resolutions are looked up
+
+    By default, the ROI volumes of all resolutions are stacked to look up the labels
+    of all of them in one pass. With ``hierarchical_scales``, only the finest
+    resolution is looked up and the labels of the coarser resolutions are derived
+    from it with a label mapping (see ``map_multiscale_labels``), which
+    guarantees that a fiber kept at the finest resolution is kept at every resolution.
+
+    If ``max_endpoint_distance`` is set, the background voxels of the volume take
+    the label of the nearest ROI voxel within this distance (see
+    ``compute_nearest_label_volume``), so that the endpoints falling slightly
+    outside the ROIs are assigned to the nearest ROI instead of being orphans.
 
     Parameters
     ----------
-    fib: the fibers data
-    voxelSize: 3-tuple containing the voxel size of the ROI image
+    roi_datas: ROI volume data of each resolution (see ``load_roi_volumes``)
+    hierarchical_scales: derive the labels of the coarser resolutions from the finest one
+    voxel_size: voxel size of the ROI volumes in mm
+    max_endpoint_distance: maximal distance in mm between an endpoint and the ROI it is assigned to
+                           (0: endpoints in the background are orphans)
 
     Returns
     -------
-    (endpoints: matrix of size [#fibers, 2, 3] containing for each fiber the
-               index of its first and last point in the voxelSize volume
-    endpointsmm) : endpoints in milimeter coordinates
-
+    (label_volume: 4D array of shape [X, Y, Z, #parcellations looked up]
+    label_mappings): None, or the finest to coarse label mapping of each resolution
     """
-    if print_info:
-        print("========================")
-        print("create_endpoints_array")
+    if not hierarchical_scales or len(roi_datas) < 2:
+        label_volume = np.stack(roi_datas, axis=-1)
+        label_mappings = None
+    else:
+        finest = int(np.argmax([roiData.max() for roiData in roi_datas]))
+        print("  >> Map the labels of resolution %i to the %i resolutions" % (finest + 1, len(roi_datas)))
+        label_mappings = [compute_label_mapping(roi_datas[finest], roiData) for roiData in roi_datas]
+        label_volume = roi_datas[finest][..., np.newaxis].copy()
 
-    # Init
-    n = len(fib)
-    endpoints = np.zeros((n, 2, 3))
-    endpointsmm = np.zeros((n, 2, 3))
-    pc = -1
+    if max_endpoint_distance > 0:
+        print("  >> Assign the background voxels to the nearest ROI within %g mm" % max_endpoint_distance)
+        for r in range(label_volume.shape[-1]):
+            label_volume[..., r] = compute_nearest_label_volume(label_volume[..., r], voxel_size,
+                                                                max_endpoint_distance)
+    return label_volume, label_mappings
 
-    # Computation for each fiber
-    for i, fi in enumerate(fib):
 
-        # Percent counter
-        if print_info:
-            pcN = int(round(float(100 * i) / n))
-            if pcN > pc and pcN % 20 == 0:
-                pc = pcN
-                print('%4.0f%%' % (pc))
+def map_multiscale_labels(labels, label_mappings):
+    """ Derive the endpoint labels of all resolutions from the labels of the finest one
 
-        f = fi[0]
+    Parameters
+    ----------
+    labels: int array of shape [#fibers, 2, 1] with the finest endpoint labels
+    label_mappings: finest to coarse label mapping of each resolution (see ``get_label_lookup_volume``)
+
+    Returns
+    -------
+    multiscale_labels: int32 array of shape [#fibers, 2, #resolutions]
+    """
+    if label_mappings is None:
+        return labels
+    return np.stack([mapping[labels[..., 0]] for mapping in label_mappings], axis=-1)
 
-        # store startpoint
-        endpoints[i, 0, :] = f[0, :]
-        # store endpoint
-        endpoints[i, 1, :] = f[-1, :]
 
-        # store startpoint
-        endpointsmm[i, 0, :] = f[0, :]
-        # store endpoint
-        endpointsmm[i, 1, :] = f[-1, :]
+def compute_scale_connectomes(resolutions, roi_fnames, parcellation_scheme, fiber_data, output_types,
+                              number_of_workers=1):
+    """ Create the connection matrices of all resolutions, in parallel if ``number_of_workers`` > 1
 
-        # print 'endpoints (mm) : ',endpoints[i, 0, :],' ; ',endpoints[i, 1, :]
+    Returns
+    -------
+    (scales: (parkey, parval, roi_fname, r, parcellation_scheme) arguments of each resolution
+    results): outputs of ``compute_scale_connectome`` for each resolution
+    """
+    scales = [(parkey, parval, roi_fnames[r], r, parcellation_scheme)
+              for r, (parkey, parval) in enumerate(list(resolutions.items()))]
+    if number_of_workers > 1 and len(scales) > 1:
+        # The fiber data is shared with the workers through memory-mapped .npy files
+        print("  >> Process %i resolutions with %i workers" % (len(scales), number_of_workers))
+        shared_dir = tempfile.mkdtemp(prefix='cmat_shared_', dir=os.getcwd())
+        try:
+            shared_fiber_data = share_arrays(fiber_data, shared_dir)
+            with ProcessPoolExecutor(max_workers=min(number_of_workers, len(scales))) as executor:
+                futures = [executor.submit(compute_scale_connectome, *scale, fiber_data=shared_fiber_data,
+                                           output_types=output_types)
+                           for scale in scales]
+                results = [future.result() for future in futures]
+        finally:
+            shutil.rmtree(shared_dir, ignore_errors=True)
+    else:
+        results = [compute_scale_connectome(*scale, fiber_data=fiber_data, output_types=output_types)
+                   for scale in scales]
+    return scales, results
 
-        # Translate from mm to index
-        endpoints[i, 0, 0] = int(endpoints[i, 0, 0] / float(voxelSize[0]))
-        endpoints[i, 0, 1] = int(endpoints[i, 0, 1] / float(voxelSize[1]))
-        endpoints[i, 0, 2] = int(endpoints[i, 0, 2] / float(voxelSize[2]))
-        endpoints[i, 1, 0] = int(endpoints[i, 1, 0] / float(voxelSize[0]))
-        endpoints[i, 1, 1] = int(endpoints[i, 1, 1] / float(voxelSize[1]))
-        endpoints[i, 1, 2] = int(endpoints[i, 1, 2] / float(voxelSize[2]))
 
-        # print 'endpoints : ',endpoints[i, 0, :],' ; ',endpoints[i, 1, :]
+def save_streamline_indexes(scales, results, final_n_points, hdr):
+    """ Save the index of the streamlines of each edge in ``streamline_final.trk`` for each resolution
 
-    # Return the matrices
-    return (endpoints, endpointsmm)
+    ``streamline_final.trk`` contains the fibers kept at the last resolution.
 
+    Parameters
+    ----------
+    scales, results: outputs of ``compute_scale_connectomes``
+    final_n_points: number of points of the fibers written in ``streamline_final.trk``
+    hdr: header of ``streamline_final.trk``
+    """
+    final_fibers_idx = results[-1][0]
+    print("  > Save the streamline index of each resolution")
+    for (parkey, _, _, _, _), (_, (edges, edge_offsets, edge_fibers, nROIs)) in zip(scales, results):
+        save_streamline_index('streamline_index_%s' % parkey, edges, edge_offsets, edge_fibers, nROIs,
+                              final_fibers_idx, final_n_points, hdr)
 
-def save_fibers(oldhdr, oldfib, fname, indices):
-    """ Stores a new trackvis file fname using only given indices """
 
-    hdrnew = oldhdr.copy()
+def get_fiber_cache_keys(cache, intrk, reference_image, roi_fnames, roi_voxel_size, hierarchical_scales,
+                         max_endpoint_distance, compute_curvature, additional_maps, map_statistics, map_sketch_size,
+                         n_rois):
+    """ Compute the keys of the fiber data of ``cmat`` in an ``ArrayCache``
 
-    outstreams = []
-    for i in indices:
-        outstreams.append(oldfib[i])
+    Each key combines the content hashes of the files and the parameters the
+    data depends on, so that a change of the ROI volumes only invalidates the
+    endpoint labels and a new map only needs its own values to be sampled.
 
-    n_fib_out = len(outstreams)
-    hdrnew['n_count'] = n_fib_out
+    Parameters
+    ----------
+    cache: ``cmtklib.cache.ArrayCache``
+    intrk: tractogram file
+    reference_image: reference image of a non trackvis tractogram (None for a trackvis file)
+    roi_fnames: ROI volume of each resolution
+    roi_voxel_size: voxel size of the ROI volumes (used to compute the endpoints)
+    hierarchical_scales, max_endpoint_distance: see ``get_label_lookup_volume``
+    compute_curvature: include the key of the mean curvatures
+    additional_maps: dictionary of the additional map files indexed by map name
+    map_statistics, map_sketch_size: see ``cmat``
+    n_rois: number of ROIs of each resolution (the approximate map statistics are computed per edge)
 
-    print("Writing final no orphan fibers: %s" % fname)
-    nib.trackvis.write(fname, outstreams, hdrnew)
+    Returns
+    -------
+    keys: dictionary of the keys of the 'geometry' (endpoints, lengths and numbers of points),
+          'curvature', 'labels' and 'map_<name>' entries
+    """
+    tractogram = [cache.hash_file(intrk)]
+    if reference_image is not None:
+        tractogram.append(cache.hash_file(reference_image))
+    rois = [cache.hash_file(fname) for fname in roi_fnames]
+    voxel_size = tuple(float(v) for v in roi_voxel_size[:3])
+
+    keys = {'geometry': make_cache_key('geometry', tractogram, voxel_size),
+            'labels': make_cache_key('labels', tractogram, rois, bool(hierarchical_scales),
+                                     float(max_endpoint_distance))}
+    if compute_curvature:
+        keys['curvature'] = make_cache_key('curvature', tractogram)
+    for k, v in additional_maps.items():
+        if map_statistics == 'approximate':
+            keys['map_%s' % k] = make_cache_key('map', keys['labels'], [int(nROIs) for nROIs in n_rois],
+                                                cache.hash_file(v), map_statistics, int(map_sketch_size))
+        else:
+            keys['map_%s' % k] = make_cache_key('map', tractogram, cache.hash_file(v), map_statistics)
+    return keys
 
 
 def cmat(intrk, roi_volumes, roi_graphmls, parcellation_scheme, compute_curvature=True, additional_maps={},
-         output_types=['gPickle'], atlas_info={}):
-    """ Create the connection matrix for each resolution using fibers and ROIs. """
+         output_types=['gPickle'], atlas_info={}, number_of_workers=1, memory_budget=0, hierarchical_scales=False,
+         max_endpoint_distance=0, map_statistics='exact', map_sketch_size=16, reference_image=None,
+         compression_error=0, cache_dir=None, cache_disk_budget=0):
+    """ Create the connection matrix for each resolution using fibers and ROIs.
+
+    The resolutions are processed by ``number_of_workers`` processes in parallel,
+    and the fiber lengths and curvatures by as many threads.
+
+    If ``memory_budget`` (in MB) is set, the tractogram is not loaded at once but
+    processed by chunks of fibers fitting in the budget. The statistics of the
+    additional maps are then approximated as with ``map_statistics='approximate'``.
+    The budget bounds the memory used for the points of the fibers, which is
+    the dominant cost. It does not bound the memory used per fiber: the endpoints,
+    labels, lengths and curvatures are written to memory-mapped ``.npy`` files
+    (see ``compute_fiber_data_from_chunks``), but grouping the fibers by edge
+    still needs of the order of 64 bytes per fiber for each resolution (see
+    ``build_edge_index``). The per-edge map statistics need about
+    ``8 * (map_sketch_size + 6)`` bytes per edge, map and resolution.
+
+    With ``map_statistics='approximate'``, the values of the additional maps are
+    sampled by chunks of fibers and folded into per-edge running moments and
+    histograms of ``map_sketch_size`` bins (see ``EdgeMapStatistics``), instead of
+    being kept for all the points of all the fibers. The mean and standard
+    deviation stay exact and the median is approximated.
+
+    If ``hierarchical_scales`` is set, the endpoints are only labeled in the finest
+    resolution and the labels of the nested coarser resolutions are derived from
+    it (see ``get_label_lookup_volume``).
+
+    If ``max_endpoint_distance`` (in mm) is set, the endpoints in the background
+    are assigned to the nearest ROI within this distance instead of being orphans.
+
+    Besides trackvis files, the tractograms supported by ``nib.streamlines``
+    (e.g. MRtrix .tck) are read directly (see ``load_tractogram``). Their fibers
+    are mapped to the voxel grid of ``reference_image`` (default: the first ROI
+    volume). With a ``memory_budget``, they are streamed by chunks (see ``cmat_from_streamlines``).
+
+    If ``compression_error`` (in mm) is set, the fibers of ``streamline_final.trk``
+    are compressed by linearization within this error (see ``compress_fibers``).
+    The connectomes are computed from the original fibers.
+
+    If ``cache_dir`` is set, the fiber data computed when the tractogram is loaded
+    in memory (endpoints, lengths, curvatures, endpoint labels and map values) is
+    stored in an on-disk cache keyed by the content of the input files (see
+    ``get_fiber_cache_keys``). A rerun only computes the data whose inputs
+    changed, e.g. the values of a new map, and does not load the tractogram at
+    all if nothing changed. The least recently used entries are evicted when
+    the cache exceeds ``cache_disk_budget`` MB (0: unlimited).
+    """
 
     print("========================")
     print("> Creation of connectome maps")
@@ -144,11 +1994,38 @@ def cmat(intrk, roi_volumes, roi_graphmls, parcellation_scheme, compute_curvatur
     # create the endpoints for each fibers
     en_fname = 'endpoints.npy'
     en_fnamemm = 'endpointsmm.npy'
-    # ep_fname  = 'lengths.npy'
+    len_fname = 'fiberslength.npy'
     curv_fname = 'meancurvature.npy'
     # intrk = op.join(gconf.get_cmp_fibers(), 'streamline_filtered.trk')
-    print('... tractogram :' + intrk)
-    fib, hdr = nib.trackvis.read(intrk, False)
+
+    is_trk = nib.streamlines.detect_format(intrk) is nib.streamlines.TrkFile
+    if not is_trk:
+        if reference_image is None:
+            reference_image = roi_volumes[0]
+        print('... tractogram : %s (reference image: %s)' % (intrk, reference_image))
+        if memory_budget:
+            streamlines, hdr, n = load_tractogram(intrk, reference_image, lazy=True)
+            chunk_size = estimate_fiber_chunk_size(intrk, hdr, n, memory_budget)
+            cmat_from_streamlines(streamlines, hdr, roi_volumes, roi_graphmls, parcellation_scheme,
+                                  compute_curvature=compute_curvature, additional_maps=additional_maps,
+                                  output_types=output_types, atlas_info=atlas_info,
+                                  number_of_workers=number_of_workers, chunk_size=chunk_size,
+                                  hierarchical_scales=hierarchical_scales,
+                                  max_endpoint_distance=max_endpoint_distance, map_sketch_size=map_sketch_size,
+                                  compression_error=compression_error)
+            return
+    else:
+        print('... tractogram :' + intrk)
+
+    def _load_fibers():
+        if is_trk:
+            return nib.trackvis.read(intrk, False)
+        streamlines, hdr, _ = load_tractogram(intrk, reference_image)
+        # same records as nib.trackvis.read
+        return [(pts, None, None) for pts in streamlines], hdr
+
+    # the fibers are loaded when needed (not at all if everything is in the cache)
+    fib = None
 
     # print "Header trackvis : ",hdr
     # print "Header trackvis id_string : ",hdr['id_string']
@@ -156,40 +2033,10 @@ def cmat(intrk, roi_volumes, roi_graphmls, parcellation_scheme, compute_curvatur
 
     print('... parcellation : %s' % parcellation_scheme)
 
-    if parcellation_scheme != "Custom":
-        if parcellation_scheme != "Lausanne2018":
-            # print "get resolutions from parcellation_scheme"
-            resolutions = get_parcellation(parcellation_scheme)
-        else:
-            resolutions = get_parcellation(parcellation_scheme)
-            for parkey, parval in list(resolutions.items()):
-                for vol, graphml in zip(roi_volumes, roi_graphmls):
-                    # print parkey
-                    if parkey in vol:
-                        roi_fname = vol
-                        # print roi_fname
-                    if parkey in graphml:
-                        roi_graphml_fname = graphml
-                        # print roi_graphml_fname
-                # roi_fname = roi_volumes[r]
-                # r += 1
-                roi = nib.load(roi_fname)
-                roiData = roi.get_data()
-                resolutions[parkey]['number_of_regions'] = roiData.max()
-                resolutions[parkey]['node_information_graphml'] = op.abspath(
-                    roi_graphml_fname)
-
-            del roi, roiData
-            # print("##################################################")
-            # print("Atlas info (Lausanne2018) :")
-            # print(resolutions)
-            # print("##################################################")
-    else:
-        # print "get resolutions from atlas_info: "
-        resolutions = atlas_info
-        # print resolutions
+    resolutions = get_resolutions(parcellation_scheme, roi_graphmls, atlas_info)
 
-    # print "resolutions : %s" % resolutions
+    # Open the ROI volume of each resolution once (scale1 for lausanne2008/18) (first volume for nativefreesurfer)
+    roi_fnames, roi_datas = load_roi_volumes(resolutions, roi_volumes, parcellation_scheme)
 
     # Previously, load_endpoints_from_trk() used the voxel size stored
     # in the track hdr to transform the endpoints to ROI voxel space.
@@ -202,477 +2049,322 @@ def cmat(intrk, roi_volumes, roi_graphmls, parcellation_scheme, compute_curvatur
     firstROI = nib.load(firstROIFile)
     roiVoxelSize = firstROI.get_header().get_zooms()
 
-    # print "roi Voxel Size",roiVoxelSize
-    (endpoints, endpointsmm) = create_endpoints_array(fib, roiVoxelSize, True)
-    np.save(en_fname, endpoints)
-    np.save(en_fnamemm, endpointsmm)
+    n_rois = [parval['number_of_regions'] for parval in resolutions.values()]
+
+    # the per-fiber arrays of the chunked mode are written to disk chunk by chunk and memory-mapped
+    fiber_dir = tempfile.mkdtemp(prefix='cmat_fibers_', dir=os.getcwd()) if memory_budget else None
+    try:
+        if memory_budget:
+            label_volume, label_mappings = get_label_lookup_volume(roi_datas, hierarchical_scales, roiVoxelSize,
+                                                                   max_endpoint_distance)
+            del roi_datas
+            fiber_data, hdr = compute_fiber_data_by_chunks(
+                intrk, label_volume, roiVoxelSize, additional_maps, compute_curvature, memory_budget, fiber_dir,
+                n_rois, number_of_workers, map_sketch_size, label_mappings)
+            del label_volume
+            if np.any(fiber_data['outside']):
+                print("  ... ERROR: %i fibers start or end outside the volume. They are discarded." %
+                      np.count_nonzero(fiber_data['outside']))
+            print("========================")
+        else:
+            cache = None
+            cached = {}
+            if cache_dir:
+                print('  >> Fiber data cache : %s' % cache_dir)
+                cache = ArrayCache(cache_dir, cache_disk_budget)
+                cache_keys = get_fiber_cache_keys(cache, intrk, None if is_trk else reference_image, roi_fnames,
+                                                  roiVoxelSize, hierarchical_scales, max_endpoint_distance,
+                                                  compute_curvature, additional_maps, map_statistics, map_sketch_size,
+                                                  n_rois)
+                cached = dict((name, cache.get(key)) for name, key in cache_keys.items())
+
+            def _store(name, arrays):
+                if cache is not None:
+                    cache.put(cache_keys[name], arrays)
+                return arrays
+
+            # only the fiber data which is not in the cache is computed
+            needed = (['geometry'] + (['curvature'] if compute_curvature else []) +
+                      ['map_%s' % k for k in additional_maps])
+            if any(cached.get(name) is None for name in needed):
+                fib, hdr = _load_fibers()
+                # concatenate the points of all fibers once
+                points, fiber_offsets = streamlines_to_buffer([fi[0] for fi in fib])
+
+            geometry = cached.get('geometry')
+            if geometry is None:
+                # print "roi Voxel Size",roiVoxelSize
+                (endpoints, endpointsmm) = create_endpoints_array(fib, roiVoxelSize, True)
+                # compute the length of all fibers
+                fiber_lengths = compute_lengths(points, fiber_offsets, number_of_workers)
+                geometry = _store('geometry', {'endpoints': endpoints, 'endpointsmm': endpointsmm,
+                                               'lengths': fiber_lengths, 'n_points': np.diff(fiber_offsets)})
+            else:
+                print('  >> Fiber endpoints and lengths loaded from the cache')
+                fiber_offsets = np.zeros(len(geometry['n_points']) + 1, dtype=np.int64)
+                fiber_offsets[1:] = np.cumsum(geometry['n_points'])
+            np.save(en_fname, geometry['endpoints'])
+            np.save(en_fnamemm, geometry['endpointsmm'])
+
+            # only compute curvature if required
+            if compute_curvature:
+                curvature = cached.get('curvature')
+                if curvature is None:
+                    print("Compute curvature ...")
+                    meancurv = compute_mean_curvatures(points, fiber_offsets, number_of_workers).reshape(-1, 1)
+                    curvature = _store('curvature', {'meancurvature': meancurv})
+                np.save(curv_fname, curvature['meancurvature'])
+
+            print("========================")
+
+            n = len(geometry['lengths'])
+
+            # The work which does not depend on the parcellation is done only once for all resolutions
+
+            # ROI start => ROI end for all fibers and all resolutions in one pass
+            labels = cached.get('labels')
+            if labels is None:
+                label_volume, label_mappings = get_label_lookup_volume(roi_datas, hierarchical_scales, roiVoxelSize,
+                                                                       max_endpoint_distance)
+                print("  >> Look up the endpoint labels in %i parcellation(s)" % label_volume.shape[-1])
+                multiscale_labels, outside = get_endpoint_labels(geometry['endpoints'], label_volume)
+                del label_volume
+                multiscale_labels = map_multiscale_labels(multiscale_labels, label_mappings)
+                labels = _store('labels', {'labels': multiscale_labels, 'outside': outside})
+            else:
+                print("  >> Endpoint labels loaded from the cache")
+            del roi_datas
+            if np.any(labels['outside']):
+                print("  ... ERROR: %i fibers start or end outside the volume. They are discarded." %
+                      np.count_nonzero(labels['outside']))
+
+            # sample the additional maps along all fibers
+            mmap = additional_maps
+            mmapdata = {}
+            edge_maps = {}
+            print('  >> Maps to be processed :')
+            if mmap and map_statistics == 'approximate':
+                print('  >> Map values folded by chunks of fibers into per-edge moments and histograms (%i bins)' %
+                      map_sketch_size)
+                scale_fiber_keys = [get_fiber_edge_keys(labels['labels'][:, :, r], labels['outside'], nROIs)
+                                    for r, nROIs in enumerate(n_rois)]
+            elif mmap:
+                # fiber index of each point
+                point_fibers = get_point_streamlines(fiber_offsets)
+            summary_names = ('keys', 'mean', 'median', 'std', 'n_discarded')
+            for k, v in list(mmap.items()):
+                print("     - %s map" % k)
+                map_data = cached.get('map_%s' % k)
+                if map_data is None:
+                    da = nib.load(v)
+                    mdata = da.get_data()
+                    print(mdata.max())
+                    mdata = np.nan_to_num(mdata)
+                    print(mdata.max())
+                    if map_statistics == 'approximate':
+                        summaries = compute_edge_map_statistics_by_chunks(points, fiber_offsets, scale_fiber_keys,
+                                                                          mdata, da.get_header().get_zooms(),
+                                                                          map_sketch_size)
+                        map_data = _store('map_%s' % k, dict(('%s_%i' % (name, r), summary[name])
+                                                             for r, summary in enumerate(summaries)
+                                                             for name in summary_names))
+                    else:
+                        values, fiber_outside = sample_map_along_streamlines(points, point_fibers, n, mdata,
+                                                                             da.get_header().get_zooms())
+                        map_data = _store('map_%s' % k, {'values': values, 'fiber_outside': fiber_outside})
+                    del mdata
+                else:
+                    print("       (loaded from the cache)")
+                if map_statistics == 'approximate':
+                    edge_maps[k] = tuple(dict((name, map_data['%s_%i' % (name, r)]) for name in summary_names)
+                                         for r in range(len(n_rois)))
+                else:
+                    mmapdata[k] = (map_data['values'], map_data['fiber_outside'])
+            if fib is not None:
+                del points
+
+            print("  ************************")
+
+            fiber_data = {'labels': labels['labels'],
+                          'outside': labels['outside'],
+                          'lengths': geometry['lengths'],
+                          'maps': mmapdata,
+                          'edge_maps': edge_maps}
+            if mmapdata and map_statistics == 'exact':
+                fiber_data['point_fibers'] = point_fibers
+
+            # the lengths of all fibers are saved with the endpoints to build connectomes
+            # for other parcellations without the tractogram (see cmat_from_endpoints)
+            np.save(len_fname, fiber_data['lengths'])
+
+        scales, results = compute_scale_connectomes(resolutions, roi_fnames, parcellation_scheme, fiber_data,
+                                                    output_types, number_of_workers)
+        final_fibers_indices = [final_fibers_idx for final_fibers_idx, _ in results]
+
+        print("  > Filtering tractography - keeping only no orphan fibers")
+        finalfibers_fname = 'streamline_final.trk'
+        if fib is None and not is_trk:
+            fib, hdr = _load_fibers()
+        if fib is None:
+            if not memory_budget:
+                hdr = nib.trackvis.read(intrk, as_generator=True)[1]
+            final_n_points = save_fibers_from_file(intrk, hdr, finalfibers_fname, final_fibers_indices[-1],
+                                                   compression_error, number_of_workers)
+        else:
+            final_n_points = save_fibers(hdr, fib, finalfibers_fname, final_fibers_indices[-1],
+                                         compression_error, number_of_workers)
 
-    # only compute curvature if required
-    if compute_curvature:
-        meancurv = compute_curvature_array(fib)
-        np.save(curv_fname, meancurv)
+        save_streamline_indexes(scales, results, final_n_points, hdr)
+    finally:
+        if fiber_dir is not None:
+            shutil.rmtree(fiber_dir, ignore_errors=True)
 
+    print("Done.")
     print("========================")
 
-    n = len(fib)
 
-    # resolution = gconf.parcellation.keys()
+def cmat_from_endpoints(endpoints_mm_file, fiberslength_file, roi_volumes, roi_graphmls, parcellation_scheme,
+                        output_types=['gPickle'], atlas_info={}, number_of_workers=1, hierarchical_scales=False,
+                        max_endpoint_distance=0):
+    """ Create the connection matrix for each resolution from the endpoints and lengths saved by ``cmat``
 
-    streamline_wrote = False
-    for parkey, parval in list(resolutions.items()):
-        # if parval['number_of_regions'] != 83:
-        #    continue
+    The tractogram is not read, which makes it possible to build the connectomes
+    of other parcellations (registered to the same space) in seconds. The
+    measures of the additional maps, the curvature and the final tractogram are
+    not computed.
 
-        # print("Resolution = "+parkey)
+    Parameters
+    ----------
+    endpoints_mm_file: ``endpointsmm.npy`` file saved by ``cmat``
+    fiberslength_file: ``fiberslength.npy`` file saved by ``cmat``
+    roi_volumes: ROI volumes registered to diffusion space
+    roi_graphmls: GraphML description of the ROI volumes (Lausanne2018)
+    parcellation_scheme: parcellation scheme
+    output_types: output types of the connectivity matrices
+    atlas_info: resolutions of a custom atlas
+    number_of_workers: number of processes used to process the resolutions in parallel
+    hierarchical_scales: derive the labels of the coarser resolutions from the finest one
+                         (see ``get_label_lookup_volume``)
+    max_endpoint_distance: maximal distance in mm between an endpoint and the ROI it is assigned to
+                           (0: endpoints in the background are orphans)
+    """
+    print("========================")
+    print("> Creation of connectome maps from cached endpoints")
 
-        print("------------------------")
-        print("Resolution = " + parkey)
-        print("------------------------")
+    print('... endpoints : %s' % endpoints_mm_file)
+    endpointsmm = np.load(endpoints_mm_file, mmap_mode='r')
+    fiber_lengths = np.load(fiberslength_file)
+    if len(fiber_lengths) != len(endpointsmm):
+        msg = "The number of fibers in %s (%i) and %s (%i) differ" % (endpoints_mm_file, len(endpointsmm),
+                                                                      fiberslength_file, len(fiber_lengths))
+        print(msg)
+        raise Exception(msg)
 
-        # create empty fiber label array
-        fiberlabels = np.zeros((n, 2))
-        final_fiberlabels = []
-        final_fibers_idx = []
+    print('... parcellation : %s' % parcellation_scheme)
+    resolutions = get_resolutions(parcellation_scheme, roi_graphmls, atlas_info)
+    roi_fnames, roi_datas = load_roi_volumes(resolutions, roi_volumes, parcellation_scheme)
+
+    # all the ROI volumes are assumed to have the voxel size of the first one (see cmat)
+    roiVoxelSize = nib.load(roi_volumes[0]).get_header().get_zooms()
+    endpoints = endpoints_to_voxels(endpointsmm, voxmm_to_voxel_affine(roiVoxelSize))
+
+    label_volume, label_mappings = get_label_lookup_volume(roi_datas, hierarchical_scales, roiVoxelSize,
+                                                           max_endpoint_distance)
+    del roi_datas
+
+    print("  >> Look up the endpoint labels in %i parcellation(s)" % label_volume.shape[-1])
+    multiscale_labels, outside = get_endpoint_labels(endpoints, label_volume)
+    del label_volume, endpoints
+    multiscale_labels = map_multiscale_labels(multiscale_labels, label_mappings)
+    if np.any(outside):
+        print("  ... ERROR: %i fibers start or end outside the volume. They are discarded." %
+              np.count_nonzero(outside))
+
+    fiber_data = {'labels': multiscale_labels,
+                  'outside': outside,
+                  'lengths': fiber_lengths,
+                  'maps': {}}
+    compute_scale_connectomes(resolutions, roi_fnames, parcellation_scheme, fiber_data, output_types,
+                              number_of_workers)
 
-        # Open the corresponding ROI (scale1 for lausanne2008/18) (first volume for nativefreesurfer)
+    print("Done.")
+    print("========================")
 
-        # print("Open the corresponding ROI")
-        for vol in roi_volumes:
-            # print parkey
-            if (parkey in vol) or (len(roi_volumes) == 1):
-                roi_fname = vol
-                # print roi_fname
-        # roi_fname = roi_volumes[r]
-        # r += 1
-        roi = nib.load(roi_fname)
-        roiData = roi.get_data()
-
-        # affine_vox_to_world = np.matrix(roi.affine[:3, :3])
-
-        # print "roiData shape : %s " % roiData.shape
-        # print "Affine Voxel 2 World transformation : ",affine_vox_to_world
-
-        # affine_world_to_vox = np.linalg.inv(affine_vox_to_world)
-        # origin = np.matrix(roi.affine[:3, 3]).T
-        # print "Affine World 2 Voxel transformation : ",affine_world_to_vox
-
-        # Create the matrix
-        print("  >> Create the connection matrix (%s rois)" %
-              parval['number_of_regions'])
-
-        nROIs = parval['number_of_regions']
-        G = nx.Graph()
-
-        # add node information from parcellation
-        gp = nx.read_graphml(parval['node_information_graphml'])
-        n_nodes = len(gp)
-        pc = -1
-        cnt = -1
-
-        thalamic_labels = []
-        for u, d in gp.nodes(data=True):
-
-            # Percent counter
-            cnt += 1
-            pcN = int(round(float(100 * cnt) / n_nodes))
-            if pcN > pc and pcN % 10 == 0:
-                pc = pcN
-                print('%4.0f%%' % (pc))
-
-            G.add_node(int(u))
-            for key in d:
-                G.nodes[int(u)][key] = d[key]
-            # compute a position for the node based on the mean position of the
-            # ROI in voxel coordinates (segmentation volume )
-            if parcellation_scheme != "Lausanne2018":
-                G.nodes[int(u)]['dn_position'] = tuple(
-                    np.mean(np.where(roiData == int(d["dn_correspondence_id"])), axis=1))
-                G.nodes[int(u)]['roi_volume'] = np.sum(
-                    roiData == int(d["dn_correspondence_id"]))
-                # print "Add node %g - roi volume : %g " % (int(u),np.sum( roiData== int(d["dn_correspondence_id"]) ))
-                # Store parcellation labels corresponding to thalamic nuclei
-                # if gp.node[int(u)]['dn_fsname'] == 'thalamus':
-                #     thalamic_labels.append(int(u))
-            else:
-                # if int(u) == 53:
-                #    print("&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&")
-                G.nodes[int(u)]['dn_position'] = tuple(
-                    np.mean(np.where(roiData == int(d["dn_multiscaleID"])), axis=1))
-                G.nodes[int(u)]['roi_volume'] = np.sum(
-                    roiData == int(d["dn_multiscaleID"]))
-                # if int(u) == 53:
-                #    print("&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&")
-                # print "Add node %g - roi volume (2018): %g " % (int(u),np.sum( roiData== int(d["dn_multiscaleID"]) ))
-                # if int(u) == 53:
-                #    print("&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&")
-
-        thalamic_labels = np.array(thalamic_labels)
-        print("  ************************")
-        print('  >> Labels of thalamic nuclei :')
-        print('  {}'.format(thalamic_labels))
-        print("  ************************")
-
-        dis = 0
-
-        # prepare: compute the measures
-        t = [c[0] for c in fib]
-        h = np.array(t, dtype=np.object)
-
-        mmap = additional_maps
-        mmapdata = {}
-        print('  >> Maps to be processed :')
-        for k, v in list(mmap.items()):
-            print("     - %s map" % k)
-            da = nib.load(v)
-            mdata = da.get_data()
-            print(mdata.max())
-            mdata = np.nan_to_num(mdata)
-            print(mdata.max())
-            mmapdata[k] = (mdata, da.get_header().get_zooms())
-
-        # print("mmapdata size : %g " % len(mmapdata.items()))
-
-        print("  ************************")
-
-        print("  >> Processing fibers and computing metrics (%s fibers)" % n)
-        pc = -1
-        for i in range(n):  # n: number of fibers
-
-            # Percent counter
-            pcN = int(round(float(100 * i) / n))
-            if pcN > pc and pcN % 10 == 0:
-                pc = pcN
-                print('%4.0f%%' % (pc))
-
-            # ROI start => ROI end
-            try:
-                startvox = np.zeros((3, 1)).astype(int)
-                startvox[0] = np.int(endpoints[i, 0, 0])
-                startvox[1] = np.int(endpoints[i, 0, 1])
-                startvox[2] = np.int(endpoints[i, 0, 2])
-
-                endvox = np.zeros((3, 1)).astype(int)
-                endvox[0] = np.int(endpoints[i, 1, 0])
-                endvox[1] = np.int(endpoints[i, 1, 1])
-                endvox[2] = np.int(endpoints[i, 1, 2])
-
-                ##print "start point : ",startvox
-                ##print "end point : ",endvox
-                ##print "roi data shape : ",roiData.shape
-
-                # endpoints from create_endpoints_array
-                startROI = int(roiData[startvox[0], startvox[1], startvox[2]])
-                endROI = int(roiData[endvox[0], endvox[1], endvox[2]])
-
-            except IndexError:
-                print(
-                    "... ERROR: An index error occured for fiber %s. This means that the fiber start or endpoint is outside the volume. Continue." % i)
-                continue
-
-            # Filter
-            if startROI == 0 or endROI == 0:
-                dis += 1
-                fiberlabels[i, 0] = -1
-                continue
-
-            if startROI > nROIs or endROI > nROIs:
-                #                print("Start or endpoint of fiber terminate in a voxel which is labeled higher")
-                #                print("than is expected by the parcellation node information.")
-                #                print("Start ROI: %i, End ROI: %i" % (startROI, endROI))
-                #                print("This needs bugfixing!")
-                continue
-
-            # Switch the rois in order to enforce startROI < endROI
-            if endROI < startROI:
-                tmp = startROI
-                startROI = endROI
-                endROI = tmp
-
-            # TODO: Refine fibers ending in thalamus
-            # if (startROI in thalamic_labels) or (endROI in thalamic_labels):
-            # Extract all thalamic nuclei the fiber is passing through
-
-            # Refine start/endROI connecting to the most probable nucleus
-
-            # Update fiber label
-            fiberlabels[i, 0] = startROI
-            fiberlabels[i, 1] = endROI
-
-            final_fiberlabels.append([startROI, endROI])
-            final_fibers_idx.append(i)
-
-            # Add edge to graph
-            if G.has_edge(startROI, endROI):
-                G[startROI][endROI]['fiblist'].append(i)
-            else:
-                G.add_edge(startROI, endROI, fiblist=[i])
-
-        print(
-            "  ... INFO - Found %i (%f percent out of %i fibers) fibers that start or terminate in a voxel which is not labeled. (orphans)" % (
-                dis, dis * 100.0 / n, n))
-        print("  ... INFO - Valid fibers: %i (%f percent)" %
-              (n - dis, 100 - dis * 100.0 / n))
-
-        # print "roi : ",roi
-        # print "roiData size : ",roiData.size
-        # print "roiData shape : ",roiData.shape
-
-        # create a final fiber length array
-        finalfiberlength = []
-        for idx in final_fibers_idx:
-            # compute length of fiber
-            # print('Fiber %i length: %d' % (idx, length(fib[idx][0])))
-            finalfiberlength.append(length(fib[idx][0]))
-
-        # convert to array
-        final_fiberlength_array = np.array(finalfiberlength)
-
-        # make final fiber labels as array
-        final_fiberlabels_array = np.array(final_fiberlabels, dtype=np.int32)
-
-        total_fibers = 0
-        total_volume = 0
-        u_old = -1
-        for u, v, d in G.edges(data=True):
-            total_fibers += len(d['fiblist'])
-            if u != u_old:
-                # print("Node %i"%int(u))
-                # print(G.nodes[int(u)])
-                total_volume += G.nodes[int(u)]['roi_volume']
-            u_old = u
-
-        G_out = copy.deepcopy(G)
-
-        # update edges
-        # measures to add here
-        # FIXME treat case of self-connection that gives di['fiber_length_mean'] = 0.0
-        for u, v, d in G.edges(data=True):
-            # Check for diagonal elements that raise an error when the edge is visited a second time
-            # print('({}, {}): {}'.format(u, v, list(G[u][v].keys())))
-            G_out.remove_edge(u, v)
-
-            # print("u / v : {} / {}".format(u,v))
-            if len(list(G[u][v].keys())) == 1:
-                di = {'number_of_fibers': len(G[u][v]['fiblist'])}
-
-                # print("G[u][v]['fiblist'] : {}".format(G[u][v]['fiblist']))
-
-                # additional measures
-                # compute mean/std of fiber measure
-                if u <= v:
-                    idx = np.where((final_fiberlabels_array[:, 0] == int(u)) & (
-                        final_fiberlabels_array[:, 1] == int(v)))[0]
-                else:
-                    idx = np.where((final_fiberlabels_array[:, 0] == int(v)) & (
-                        final_fiberlabels_array[:, 1] == int(u)))[0]
-
-                # print("idx : {}".format(idx))
-                # print("final_fiberlength_array[idx] : {}".format(final_fiberlength_array[idx]))
-
-                di['fiber_length_mean'] = float(
-                    np.nanmean(final_fiberlength_array[idx]))
-                di['fiber_length_median'] = float(
-                    np.nanmedian(final_fiberlength_array[idx]))
-                di['fiber_length_std'] = float(
-                    np.nanstd(final_fiberlength_array[idx]))
-
-                di['fiber_proportion'] = float(
-                    100.0 * (di['number_of_fibers'] / float(total_fibers)))
-
-                # Compute density
-                # density = (#fibers / mean_fibers_length) * (2 / (area_roi_u + area_roi_v))
-
-                # print "G.nodes[int(u)]['roi_volume'] : %i / G.nodes[int(v)]['roi_volume'] : %i"
-                #   % (G.nodes[int(u)]['roi_volume'],G.nodes[int(v)]['roi_volume'])
-                # print "di['number_of_fibers'] : %i / di['fiber_length_mean'] : %i" % (di['number_of_fibers'],di['fiber_length_mean'])
-
-                if di['fiber_length_mean'] > 0.0:
-                    di['fiber_density'] = float((float(di['number_of_fibers']) / float(di['fiber_length_mean'])) * float(
-                        2.0 / (G.nodes[int(u)]['roi_volume'] + G.nodes[int(v)]['roi_volume'])))
-                    di['normalized_fiber_density'] = float(
-                        ((float(di['number_of_fibers']) / float(total_fibers)) / float(di['fiber_length_mean'])) * (
-                            (2.0 * float(total_volume)) / (
-                                G.nodes[int(u)]['roi_volume'] + G.nodes[int(v)]['roi_volume'])))
-                else:
-                    di['fiber_density'] = 0.0
-                    di['normalized_fiber_density'] = 0.0
-                # this is indexed into the fibers that are valid in the sense of touching start
-                # and end roi and not going out of the volume
-                if u <= v:
-                    idx_valid = np.where((fiberlabels[:, 0] == int(u)) & (
-                        fiberlabels[:, 1] == int(v)))[0]
-                else:
-                    idx_valid = np.where((fiberlabels[:, 0] == int(v)) & (
-                        fiberlabels[:, 1] == int(u)))[0]
-
-                for k, vv in list(mmapdata.items()):
-                    val = []
-
-                    # print("Processing %s map..." % k)
-                    # print(vv[1])
-                    for i in idx_valid:
-                        # retrieve indices
-                        try:
-                            # print(h[i])
-                            idx2 = (h[i] / vv[1]).astype(np.uint32)
-                            # print "idx2 : ",idx2
-                            val.append(vv[0][idx2[:, 0], idx2[:, 1], idx2[:, 2]])
-                        except IndexError as e:
-                            print(
-                                "  ... ERROR - Index error occured when trying extract scalar values for measure", k)
-                            print("  ... ERROR - Discard fiber with index",
-                                  i, "Exception: ", e)
-
-                    # print(k)
-                    if len(val) > 0:
-                        da = np.concatenate(val)
-                        # print(da.max())
-                        # print(np.median(da))
-
-                        if k == 'shore_rtop':
-                            di[k + '_mean'] = da.astype(np.float64).mean()
-                            di[k + '_std'] = da.astype(np.float64).std()
-                            di[k + '_median'] = np.median(da.astype(np.float64))
-                        else:
-                            di[k + '_mean'] = da.mean().astype(np.float)
-                            di[k + '_std'] = da.std().astype(np.float)
-                            di[k + '_median'] = np.median(da).astype(np.float)
-
-                        # print(di[k + '_median'])
-                        del da
-                        del val
-
-                G_out.add_edge(u, v)
-                for key in di:
-                    G_out[u][v][key] = di[key]
-
-                # print('({}, {}): {}'.format(u, v, list(G[u][v].keys())))
-
-        # print("  ************************************************************************")
-
-        # for u, v, d in G.edges(data=True):
-
-        #     print('({}, {}): {}'.format(u, v, list(d.keys())))
-        #     if 'fiblist' in list(d.keys()):
-        #         print(G[u][v]['fiblist'])
-
-        del G
-
-        print("  ************************************************")
-
-        print("  >> Save connectome maps as :")
-
-        # Get the edge attributes/keys/weights from the first edge and then break.
-        # Change w.r.t networkx2
-        edge_keys = []
-        for u, v, d in G_out.edges(data=True):
-            # print(list(d.keys()))
-            edge_keys = list(d.keys())
-            break
 
-        # Storing network/graph in TSV format (by default to be BIDS compliant)
-        print('    - connectome_%s.tsv' % parkey)
-        # Write header fields
-        with open('connectome_%s.tsv' % parkey, 'w') as out_file:
-            tsv_writer = csv.writer(out_file, delimiter='\t')
-            header = ['source', 'target']
-            header = header + [key for key in edge_keys]
-            tsv_writer.writerow(header)
-        # Write list of graph edges with all connectivity metrics (edge_keys)
-        with open('connectome_%s.tsv' % parkey, 'ab') as out_file:
-            nx.write_edgelist(G_out,
-                              out_file,
-                              comments='#',
-                              delimiter='\t',
-                              data=edge_keys,
-                              encoding='utf-8')
-
-        # Storing network/graph in other formats that might be prefered by the user
-        if 'gPickle' in output_types:
-            print('    - connectome_%s.gpickle' % parkey)
-            nx.write_gpickle(G_out, 'connectome_%s.gpickle' % parkey)
-        if 'mat' in output_types:
-            # edges
-            # size_edges = (int(parval['number_of_regions']), int(
-            #     parval['number_of_regions']))
-
-            edge_struct = {}
-            for edge_key in edge_keys:
-                if edge_key != 'fiblist':
-                    # print('edge key: %s ' % edge_key)
-                    edge_struct[edge_key] = nx.to_numpy_matrix(G_out, weight=edge_key)
-
-            # nodes
-            size_nodes = int(parval['number_of_regions'])
-
-            # Get the node attributes/keys from the first node and then break.
-            # Change w.r.t networkx2
-            for u, d in G_out.nodes(data=True):
-                node_keys = list(d.keys())
-                break
+def cmat_from_streamlines(streamlines, hdr, roi_volumes, roi_graphmls, parcellation_scheme, compute_curvature=True,
+                          additional_maps={}, output_types=['gPickle'], atlas_info={}, number_of_workers=1,
+                          chunk_size=100000, hierarchical_scales=False, max_endpoint_distance=0,
+                          map_sketch_size=16, save_final_tractogram=True, compression_error=0):
+    """ Create the connection matrix for each resolution from a stream of fibers, e.g. the output of a tracking
 
-            # print "size_nodes : "
-            # print size_nodes
-            #
-            # print "Number of nodes : %i" % len(G)
+    The fibers are consumed by chunks of ``chunk_size`` fibers and never
+    written as a whole, so that the tracking and the connectome creation are
+    fused without an intermediate tractogram. Only the fibers kept at the last
+    resolution are written to ``streamline_final.trk`` as they come (if
+    ``save_final_tractogram``). The statistics of the additional maps are
+    approximated as in the ``memory_budget`` mode of ``cmat``.
 
-            node_struct = {}
-            for node_key in node_keys:
-                if node_key == 'dn_position':
-                    node_arr = np.zeros([size_nodes, 3], dtype=np.float)
-                else:
-                    node_arr = np.zeros(size_nodes, dtype=np.object_)
-
-                node_n = 0
-                for _, node_data in G_out.nodes(data=True):
-                    node_arr[node_n] = node_data[node_key]
-                    # print " node_arr[%i]:" % node_n
-                    # print node_arr[node_n]
-                    node_n += 1
-                # print('node key: %s ' % node_key)
-                node_struct[node_key] = node_arr
-            print('    - connectome_%s.mat' % parkey)
-            sio.savemat('connectome_%s.mat' % parkey, long_field_names=True,
-                        mdict={'sc': edge_struct,
-                               'nodes': node_struct})
-        if 'graphml' in output_types:
-            g2 = nx.Graph()
-            for u_gml, v_gml, d_gml in G_out.edges(data=True):
-                g2.add_edge(u_gml, v_gml)
-                for key in d_gml:
-                    g2[u_gml][v_gml][key] = d_gml[key]
-            for u_gml, d_gml in G_out.nodes(data=True):
-                g2.add_node(u_gml)
-                if parcellation_scheme != "Lausanne2018":
-                    g2.node[u_gml]['dn_correspondence_id'] = d_gml['dn_correspondence_id']
-                else:
-                    g2.node[u_gml]['dn_multiscaleID'] = d_gml['dn_multiscaleID']
-                g2.node[u_gml]['dn_fsname'] = d_gml['dn_fsname']
-                g2.node[u_gml]['dn_hemisphere'] = d_gml['dn_hemisphere']
-                g2.node[u_gml]['dn_name'] = d_gml['dn_name']
-                g2.node[u_gml]['dn_position_x'] = d_gml['dn_position'][0]
-                g2.node[u_gml]['dn_position_y'] = d_gml['dn_position'][1]
-                g2.node[u_gml]['dn_position_z'] = d_gml['dn_position'][2]
-                g2.node[u_gml]['dn_region'] = d_gml['dn_region']
-                print('    - connectome_%s.graphml' % parkey)
-            nx.write_graphml(g2, 'connectome_%s.graphml' % parkey)
-
-        # print("Storing final fiber length array")
-        fiberlabels_fname = 'final_fiberslength_%s.npy' % str(parkey)
-        np.save(fiberlabels_fname, final_fiberlength_array)
-
-        # print("Storing all fiber labels (with orphans)")
-        fiberlabels_fname = 'filtered_fiberslabel_%s.npy' % str(parkey)
-        np.save(fiberlabels_fname, np.array(fiberlabels, dtype=np.int32), )
-
-        # print("Storing final fiber labels (no orphans)")
-        fiberlabels_noorphans_fname = 'final_fiberlabels_%s.npy' % str(parkey)
-        np.save(fiberlabels_noorphans_fname, final_fiberlabels_array)
-
-        if not streamline_wrote:
-            print("  > Filtering tractography - keeping only no orphan fibers")
-            finalfibers_fname = 'streamline_final.trk'
-            save_fibers(hdr, fib, finalfibers_fname, final_fibers_idx)
+    Parameters
+    ----------
+    streamlines: iterable of fibers (arrays of points in trackvis voxmm coordinates)
+    hdr: trackvis header describing the space of the fibers
+    roi_volumes: ROI volumes registered to diffusion space
+    roi_graphmls: GraphML description of the ROI volumes (Lausanne2018)
+    parcellation_scheme: parcellation scheme
+    compute_curvature: compute the mean curvature of the fibers if True
+    additional_maps: dictionary of the additional map files indexed by map name
+    output_types: output types of the connectivity matrices
+    atlas_info: resolutions of a custom atlas
+    number_of_workers: number of processes used to process the resolutions in parallel
+    chunk_size: number of fibers processed at once
+    hierarchical_scales, max_endpoint_distance: see ``get_label_lookup_volume``
+    map_sketch_size: number of bins of the per-edge histograms of the map values (see ``EdgeMapStatistics``)
+    save_final_tractogram: write the fibers kept at the last resolution to ``streamline_final.trk``
+    compression_error: if set, maximal error (in mm) of the compression of the fibers of ``streamline_final.trk``
+    """
+    print("========================")
+    print("> Creation of connectome maps from a stream of fibers")
+    print('... parcellation : %s' % parcellation_scheme)
+
+    resolutions = get_resolutions(parcellation_scheme, roi_graphmls, atlas_info)
+    roi_fnames, roi_datas = load_roi_volumes(resolutions, roi_volumes, parcellation_scheme)
+    roiVoxelSize = nib.load(roi_volumes[0]).get_header().get_zooms()
+    label_volume, label_mappings = get_label_lookup_volume(roi_datas, hierarchical_scales, roiVoxelSize,
+                                                           max_endpoint_distance)
+    del roi_datas
+
+    # the fibers of streamline_final.trk are the fibers kept at the last resolution (see cmat)
+    n_rois = [parval['number_of_regions'] for parval in resolutions.values()]
+    writer = TrkChunkWriter('streamline_final.trk', hdr, compression_error,
+                            number_of_workers) if save_final_tractogram else None
+
+    def _save_final_fibers(start, fib, chunk_labels, chunk_outside):
+        fiberlabels, _ = get_fiber_labels(chunk_labels[:, :, -1], chunk_outside, n_rois[-1])
+        writer.write([fib[i] for i in np.flatnonzero(fiberlabels[:, 0] > 0)])
+
+    print("  >> Process the fibers by chunks of %i fibers" % chunk_size)
+    # the per-fiber arrays are written to disk chunk by chunk and memory-mapped
+    fiber_dir = tempfile.mkdtemp(prefix='cmat_fibers_', dir=os.getcwd())
+    try:
+        fiber_data = compute_fiber_data_from_chunks(
+            iter_streamline_chunks(streamlines, chunk_size), label_volume, roiVoxelSize, additional_maps,
+            compute_curvature, fiber_dir, n_rois, number_of_workers, map_sketch_size, label_mappings,
+            chunk_callback=_save_final_fibers if writer is not None else None)
+        del label_volume
+        if writer is not None:
+            writer.close()
+            print("Writing final no orphan fibers: streamline_final.trk")
+
+        if np.any(fiber_data['outside']):
+            print("  ... ERROR: %i fibers start or end outside the volume. They are discarded." %
+                  np.count_nonzero(fiber_data['outside']))
+
+        scales, results = compute_scale_connectomes(resolutions, roi_fnames, parcellation_scheme, fiber_data,
+                                                    output_types, number_of_workers)
+        if writer is not None:
+            save_streamline_indexes(scales, results, np.array(writer.n_points, dtype=np.int64), writer.hdr)
+    finally:
+        shutil.rmtree(fiber_dir, ignore_errors=True)
 
     print("Done.")
     print("========================")
@@ -683,6 +2375,8 @@ class CMTK_cmatInputSpec(BaseInterfaceInputSpec):
         File(exists=True), desc='Tractography result', mandatory=True)
     roi_volumes = InputMultiPath(
         File(exists=True), desc='ROI volumes registered to diffusion space')
+    reference_image = File(exists=True, desc='Image defining the voxel grid of the fibers of a .tck track file '
+                                             '(default: first ROI volume)')
     parcellation_scheme = traits.Enum('Lausanne2008', ['Lausanne2008', 'Lausanne2018', 'NativeFreesurfer', 'Custom'],
                                       usedefault=True)
     roi_graphmls = InputMultiPath(
@@ -694,6 +2388,35 @@ class CMTK_cmatInputSpec(BaseInterfaceInputSpec):
         File, desc='Additional calculated maps (ADC, gFA, ...)')
     output_types = traits.List(
         Str, desc='Output types of the connectivity matrices')
+    number_of_workers = traits.Int(
+        1, desc='Number of processes used to build the connectomes of the different resolutions in parallel',
+        usedefault=True)
+    memory_budget = traits.Int(
+        0, desc='Memory budget (in MB) for the points of one chunk of fibers, used to process the tractogram by '
+                'chunks (0: the whole tractogram is loaded in memory). The per-fiber arrays are memory-mapped '
+                'and the per-edge arrays are not included in the budget',
+        usedefault=True)
+    hierarchical_scales = traits.Bool(
+        False, desc='Label the fiber endpoints in the finest resolution only and derive the labels '
+                    'of the nested coarser resolutions from it', usedefault=True)
+    max_endpoint_distance = traits.Float(
+        0, desc='Maximal distance (in mm) at which the fiber endpoints falling in the background are assigned '
+                'to the nearest ROI (0: they are orphans)', usedefault=True)
+    map_statistics = traits.Enum(
+        'exact', ['exact', 'approximate'], usedefault=True,
+        desc='Statistics of the additional maps: exact (all the sampled values are kept) or approximate '
+             '(bounded memory, exact mean and std, median approximated from per-edge histograms)')
+    map_sketch_size = traits.Int(
+        16, desc='Number of bins of the per-edge histograms of the map values used by the approximate statistics',
+        usedefault=True)
+    compression_error = traits.Float(
+        0, desc='Maximal error (in mm) of the lossy compression of the fibers saved in streamline_final.trk '
+                '(0: no compression)', usedefault=True)
+    cache_dir = Directory(desc='Directory of the on-disk cache of the fiber data keyed by the content of the '
+                               'tractogram, ROI volumes and maps (not set: no cache)')
+    cache_disk_budget = traits.Int(
+        0, desc='Disk budget (in MB) of the fiber data cache, the least recently used entries being evicted '
+                '(0: unlimited)', usedefault=True)
     probtrackx = traits.Bool(False)
     voxel_connectivity = InputMultiPath(File(exists=True),
                                         desc="ProbtrackX connectivity matrices (# seed voxels x # target ROIs)")
@@ -702,10 +2425,12 @@ class CMTK_cmatInputSpec(BaseInterfaceInputSpec):
 class CMTK_cmatOutputSpec(TraitedSpec):
     endpoints_file = File()
     endpoints_mm_file = File()
+    fiberslength_file = File()
     final_fiberslength_files = OutputMultiPath(File())
     filtered_fiberslabel_files = OutputMultiPath(File())
     final_fiberlabels_files = OutputMultiPath(File())
     streamline_final_file = File()
+    streamline_index_files = OutputMultiPath(File())
     connectivity_matrices = OutputMultiPath(File())
 
 
@@ -733,7 +2458,15 @@ class CMTK_cmat(BaseInterface):
              roi_graphmls=self.inputs.roi_graphmls,
              parcellation_scheme=self.inputs.parcellation_scheme, atlas_info=self.inputs.atlas_info,
              compute_curvature=self.inputs.compute_curvature,
-             additional_maps=additional_maps, output_types=self.inputs.output_types)
+             additional_maps=additional_maps, output_types=self.inputs.output_types,
+             number_of_workers=self.inputs.number_of_workers, memory_budget=self.inputs.memory_budget,
+             hierarchical_scales=self.inputs.hierarchical_scales,
+             max_endpoint_distance=self.inputs.max_endpoint_distance,
+             map_statistics=self.inputs.map_statistics, map_sketch_size=self.inputs.map_sketch_size,
+             reference_image=self.inputs.reference_image if isdefined(self.inputs.reference_image) else None,
+             compression_error=self.inputs.compression_error,
+             cache_dir=self.inputs.cache_dir if isdefined(self.inputs.cache_dir) else None,
+             cache_disk_budget=self.inputs.cache_disk_budget)
 
         if 'cff' in self.inputs.output_types:
             cvt = cmtk.CFFConverter()
@@ -750,6 +2483,7 @@ class CMTK_cmat(BaseInterface):
         outputs = self._outputs().get()
         outputs['endpoints_file'] = os.path.abspath('endpoints.npy')
         outputs['endpoints_mm_file'] = os.path.abspath('endpointsmm.npy')
+        outputs['fiberslength_file'] = os.path.abspath('fiberslength.npy')
         outputs['final_fiberslength_files'] = glob.glob(
             os.path.abspath('final_fiberslength*'))
         outputs['filtered_fiberslabel_files'] = glob.glob(
@@ -758,12 +2492,517 @@ class CMTK_cmat(BaseInterface):
             os.path.abspath('final_fiberlabels*'))
         outputs['streamline_final_file'] = os.path.abspath(
             'streamline_final.trk')
+        outputs['streamline_index_files'] = glob.glob(
+            os.path.abspath('streamline_index_*.npy'))
+        outputs['connectivity_matrices'] = glob.glob(
+            os.path.abspath('connectome*'))
+
+        return outputs
+
+
+class CMTK_cmat_from_endpointsInputSpec(BaseInterfaceInputSpec):
+    endpoints_mm_file = File(exists=True, mandatory=True,
+                             desc='Endpoints of the fibers in milimeter coordinates (endpointsmm.npy from CMTK_cmat)')
+    fiberslength_file = File(exists=True, mandatory=True,
+                             desc='Lengths of all the fibers (fiberslength.npy from CMTK_cmat)')
+    roi_volumes = InputMultiPath(
+        File(exists=True), desc='ROI volumes registered to diffusion space', mandatory=True)
+    parcellation_scheme = traits.Enum('Lausanne2008', ['Lausanne2008', 'Lausanne2018', 'NativeFreesurfer', 'Custom'],
+                                      usedefault=True)
+    roi_graphmls = InputMultiPath(
+        File(exists=True), desc='GraphML description of ROI volumes (Lausanne2018)')
+    atlas_info = Dict(mandatory=False, desc="custom atlas information")
+    output_types = traits.List(
+        Str, desc='Output types of the connectivity matrices')
+    number_of_workers = traits.Int(
+        1, desc='Number of processes used to build the connectomes of the different resolutions in parallel',
+        usedefault=True)
+    hierarchical_scales = traits.Bool(
+        False, desc='Label the fiber endpoints in the finest resolution only and derive the labels '
+                    'of the nested coarser resolutions from it', usedefault=True)
+    max_endpoint_distance = traits.Float(
+        0, desc='Maximal distance (in mm) at which the fiber endpoints falling in the background are assigned '
+                'to the nearest ROI (0: they are orphans)', usedefault=True)
+
+
+class CMTK_cmat_from_endpointsOutputSpec(TraitedSpec):
+    final_fiberslength_files = OutputMultiPath(File())
+    filtered_fiberslabel_files = OutputMultiPath(File())
+    final_fiberlabels_files = OutputMultiPath(File())
+    connectivity_matrices = OutputMultiPath(File())
+
+
+class CMTK_cmat_from_endpoints(BaseInterface):
+    """ Build the connectomes of a parcellation from the endpoints and lengths cached by CMTK_cmat """
+    input_spec = CMTK_cmat_from_endpointsInputSpec
+    output_spec = CMTK_cmat_from_endpointsOutputSpec
+
+    def _run_interface(self, runtime):
+        cmat_from_endpoints(endpoints_mm_file=self.inputs.endpoints_mm_file,
+                            fiberslength_file=self.inputs.fiberslength_file,
+                            roi_volumes=self.inputs.roi_volumes, roi_graphmls=self.inputs.roi_graphmls,
+                            parcellation_scheme=self.inputs.parcellation_scheme, atlas_info=self.inputs.atlas_info,
+                            output_types=self.inputs.output_types, number_of_workers=self.inputs.number_of_workers,
+                            hierarchical_scales=self.inputs.hierarchical_scales,
+                            max_endpoint_distance=self.inputs.max_endpoint_distance)
+
+        if 'cff' in self.inputs.output_types:
+            cvt = cmtk.CFFConverter()
+            cvt.inputs.title = 'Connectome mapper'
+            cvt.inputs.nifti_volumes = self.inputs.roi_volumes
+            cvt.inputs.gpickled_networks = glob.glob(
+                os.path.abspath("connectome_*.gpickle"))
+            cvt.run()
+
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['final_fiberslength_files'] = glob.glob(
+            os.path.abspath('final_fiberslength*'))
+        outputs['filtered_fiberslabel_files'] = glob.glob(
+            os.path.abspath('filtered_fiberslabel*'))
+        outputs['final_fiberlabels_files'] = glob.glob(
+            os.path.abspath('final_fiberlabels*'))
         outputs['connectivity_matrices'] = glob.glob(
             os.path.abspath('connectome*'))
 
         return outputs
 
 
+def compute_ledoit_wolf_shrinkage(emp_cov, sample_sq_norms, n_samples):
+    """ Shrink an empirical covariance matrix towards a scaled identity with the Ledoit-Wolf coefficient
+
+    Same as ``sklearn.covariance.ledoit_wolf`` on centered samples, computed
+    from the empirical covariance and the squared norms of the samples
+    instead of the samples themselves.
+
+    Parameters
+    ----------
+    emp_cov: empirical covariance matrix of shape [#features, #features] (normalized by n_samples)
+    sample_sq_norms: array of shape [#samples] with the squared norm of each centered sample
+    n_samples: number of samples
+
+    Returns
+    -------
+    (shrunk_cov: shrunk covariance matrix
+    shrinkage): shrinkage coefficient in [0, 1]
+    """
+    n_features = emp_cov.shape[0]
+    trace = np.trace(emp_cov)
+    mu = trace / n_features
+    delta_ = (emp_cov ** 2).sum()
+    beta = ((sample_sq_norms ** 2).sum() / n_samples - delta_) / (n_features * n_samples)
+    delta = (delta_ - 2.0 * mu * trace + n_features * mu ** 2) / n_features
+    beta = min(beta, delta)
+    shrinkage = 0.0 if beta <= 0 else beta / delta
+
+    shrunk_cov = (1.0 - shrinkage) * emp_cov
+    shrunk_cov.flat[::n_features + 1] += shrinkage * mu
+    return shrunk_cov, shrinkage
+
+
+def compute_connectivity_matrices(ts, connectivity_metrics=('corr',), dtype=np.float32):
+    """ Compute functional connectivity matrices of time-series from a single empirical covariance
+
+    The covariance of the centered series is computed with one matrix product
+    and all the estimators are derived from it:
+
+    * ``cov``: empirical covariance
+    * ``corr``: Pearson correlation (same as ``np.corrcoef`` up to the precision of ``dtype``)
+    * ``partial_corr``: partial correlation from the precision matrix of the
+      Ledoit-Wolf shrunk correlation matrix (see ``compute_ledoit_wolf_shrinkage``)
+    * ``tangent``: matrix logarithm of the shrunk correlation matrix, i.e. its
+      projection in the tangent space of the covariance matrices at the identity.
+      Group studies can re-project it at a group mean.
+
+    The series which are constant (e.g. empty ROIs) get NaN rows and columns.
+
+    Parameters
+    ----------
+    ts: array of shape [#series, #time points]
+    connectivity_metrics: estimators to compute
+    dtype: floating point type of the covariance computation
+
+    Returns
+    -------
+    matrices: dictionary of the arrays of shape [#series, #series] indexed by estimator
+    """
+    ts = np.asarray(ts, dtype=dtype)
+    n_tp = ts.shape[1]
+    centered = ts - ts.mean(axis=1, keepdims=True)
+    cov = centered.dot(centered.T) / n_tp
+
+    std = np.sqrt(np.diag(cov))
+    valid = np.isfinite(std) & (std > 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        corr = cov / np.outer(std, std)
+    corr[~valid, :] = np.nan
+    corr[:, ~valid] = np.nan
+    np.clip(corr, -1, 1, out=corr)
+    corr[valid, valid] = 1
+
+    matrices = {}
+    if 'cov' in connectivity_metrics:
+        matrices['cov'] = cov
+    if 'corr' in connectivity_metrics:
+        matrices['corr'] = corr
+
+    if 'partial_corr' in connectivity_metrics or 'tangent' in connectivity_metrics:
+        # Ledoit-Wolf shrinkage of the correlation matrix of the non-constant series
+        z = centered[valid] / std[valid, None]
+        shrunk, shrinkage = compute_ledoit_wolf_shrinkage(corr[np.ix_(valid, valid)].astype(np.float64),
+                                                          (z.astype(np.float64) ** 2).sum(axis=0), n_tp)
+        del z
+        print("  ... Ledoit-Wolf shrinkage: %.4f" % shrinkage)
+        if 'partial_corr' in connectivity_metrics:
+            precision = np.linalg.inv(shrunk)
+            d = np.sqrt(np.diag(precision))
+            partial = -precision / np.outer(d, d)
+            partial.flat[::len(d) + 1] = 1
+            matrices['partial_corr'] = np.full(corr.shape, np.nan, dtype=dtype)
+            matrices['partial_corr'][np.ix_(valid, valid)] = partial
+        if 'tangent' in connectivity_metrics:
+            eigvals, eigvecs = np.linalg.eigh(shrunk)
+            matrices['tangent'] = np.full(corr.shape, np.nan, dtype=dtype)
+            matrices['tangent'][np.ix_(valid, valid)] = (eigvecs * np.log(eigvals)).dot(eigvecs.T)
+    return matrices
+
+
+def compute_correlation_matrix(ts, dtype=np.float32):
+    """ Compute the Pearson correlation matrix of time-series with one matrix product
+
+    Same as ``np.corrcoef(ts)`` up to the precision of ``dtype`` (see ``compute_connectivity_matrices``).
+
+    Parameters
+    ----------
+    ts: array of shape [#series, #time points]
+    dtype: floating point type of the computation
+
+    Returns
+    -------
+    corr: array of shape [#series, #series] (NaN for the constant series)
+    """
+    return compute_connectivity_matrices(ts, ['corr'], dtype)['corr']
+
+
+def compute_sliding_window_fc(ts, window_length, step=1, dtype=np.float32):
+    """ Compute the correlation matrices of sliding windows over time-series incrementally
+
+    The sums and cross-products of the series in the window are updated as it
+    slides: the ``step`` time points leaving the window are subtracted and the
+    ``step`` time points entering it are added, instead of recomputing them
+    from the ``window_length`` time points of every window. They are accumulated
+    in float64 on the globally centered series to limit the rounding drift.
+
+    Parameters
+    ----------
+    ts: array of shape [#series, #time points]
+    window_length: number of time points of the windows
+    step: number of time points between the starts of consecutive windows
+    dtype: data type of the result (e.g. float16 for a compact output)
+
+    Returns
+    -------
+    (fc: array of shape [#windows, #series * (#series - 1) / 2] with the correlations
+         of the upper triangle (``np.triu_indices(#series, 1)``) of each window
+    window_starts): first time point of each window
+    """
+    x = np.asarray(ts, dtype=np.float64)
+    n_series, n_tp = x.shape
+    if window_length < 2 or window_length > n_tp:
+        raise ValueError('The window length must be between 2 and the number of time points (%i)' % n_tp)
+    if step < 1:
+        raise ValueError('The step of the sliding window must be at least 1')
+
+    x = x - x.mean(axis=1, keepdims=True)
+    # variances below the rounding error of the running sums are those of constant windows
+    min_var = 1e-10 * (x ** 2).mean(axis=1)
+    window_starts = np.arange(0, n_tp - window_length + 1, step)
+    rows, cols = np.triu_indices(n_series, 1)
+    upper = rows * n_series + cols
+    fc = np.empty((len(window_starts), len(rows)), dtype=dtype)
+
+    window = x[:, :window_length]
+    sums = window.sum(axis=1)
+    cross = window.dot(window.T)
+    for w, start in enumerate(window_starts):
+        if w > 0:
+            if step < window_length:
+                leaving = x[:, start - step:start]
+                entering = x[:, start - step + window_length:start + window_length]
+                sums += entering.sum(axis=1) - leaving.sum(axis=1)
+                # both rank-step updates in one matrix product
+                cross += np.hstack((entering, leaving)).dot(np.hstack((entering, -leaving)).T)
+            else:
+                # the windows do not overlap
+                window = x[:, start:start + window_length]
+                sums = window.sum(axis=1)
+                cross = window.dot(window.T)
+
+        mean = sums / window_length
+        var = np.diag(cross) / window_length - mean ** 2
+        var[var <= min_var] = np.nan
+        inv_std = 1.0 / np.sqrt(var)
+        corr = np.take(cross, upper)
+        corr /= window_length
+        corr -= mean[rows] * mean[cols]
+        with np.errstate(invalid='ignore'):
+            corr *= inv_std[rows] * inv_std[cols]
+        fc[w] = np.clip(corr, -1, 1)
+    return fc, window_starts
+
+
+def load_roi_averaging_matrix(roi_fname, n_rois, roi_data=None):
+    """ Load the sparse averaging matrix of a ROI volume, computing it if needed
+
+    The matrix (see ``compute_roi_averaging_matrix``) is cached in the file
+    ``<ROI volume name>_averaging.npz`` next to the ROI volume, so that the runs
+    and sessions using the same registered parcellation reuse it. The cache file
+    stores the content hash of the ROI volume and is recomputed if the volume
+    changed. If the directory of the ROI volume is not writable, the matrix is
+    not cached.
+
+    Parameters
+    ----------
+    roi_fname: ROI volume
+    n_rois: number of ROIs (labels 1 to n_rois)
+    roi_data: data of the ROI volume if already loaded
+
+    Returns
+    -------
+    (voxels: int64 array with the flat indices of the voxels of the ROIs
+    averaging: float32 CSR matrix of shape [n_rois, #voxels]
+    shape): shape of the ROI volume
+    """
+    roi_dir, roi_name, _ = split_filename(roi_fname)
+    cache_fname = op.join(roi_dir, '%s_averaging.npz' % roi_name)
+    roi_hash = hash_file(roi_fname)
+
+    if op.exists(cache_fname):
+        cached = np.load(cache_fname)
+        if str(cached['roi_hash']) == roi_hash and int(cached['n_rois']) == int(n_rois):
+            print("Load the ROI averaging matrix from %s" % cache_fname)
+            averaging = sparse.csr_matrix((cached['data'], cached['indices'], cached['indptr']),
+                                          shape=(int(n_rois), len(cached['voxels'])))
+            return cached['voxels'], averaging, tuple(cached['shape'])
+
+    if roi_data is None:
+        roi_data = nib.load(roi_fname).get_data()
+    print("Compute the ROI averaging matrix (%i rois)" % n_rois)
+    voxels, averaging = compute_roi_averaging_matrix(roi_data, n_rois)
+    try:
+        fd, tmp_fname = tempfile.mkstemp(dir=roi_dir, suffix='.npz')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, roi_hash=roi_hash, n_rois=int(n_rois), shape=roi_data.shape[:3], voxels=voxels,
+                     data=averaging.data, indices=averaging.indices, indptr=averaging.indptr)
+        os.replace(tmp_fname, cache_fname)
+    except (IOError, OSError):
+        print("  ... WARNING - the ROI averaging matrix could not be cached in %s" % roi_dir)
+    return voxels, averaging, roi_data.shape[:3]
+
+
+def extract_roi_timeseries(fdata, voxels, averaging, shape):
+    """ Compute the average time-series of all ROIs with one sparse product
+
+    Parameters
+    ----------
+    fdata: 4D fMRI data
+    voxels, averaging, shape: ROI averaging matrix (see ``load_roi_averaging_matrix``)
+
+    Returns
+    -------
+    ts: float32 array of shape [#ROIs, #time points] (NaN for the empty ROIs)
+    """
+    # voxel-by-time matrix of the voxels of the ROIs only
+    data = np.asarray(fdata[np.unravel_index(voxels, shape)], dtype=np.float32)
+    ts = np.asarray(averaging.dot(data), dtype=np.float32)
+    ts[np.diff(averaging.indptr) == 0] = np.nan
+    return ts
+
+
+def compute_rsfmri_scale_connectome(parkey, parval, roi_fname, parcellation_scheme, fdata, index, output_types,
+                                    connectivity_metrics=('corr',), dynamic_fc=False, dfc_window_length=60,
+                                    dfc_step=1, dfc_dtype='float32'):
+    """ Compute the ROI average time-series and the functional connectome of one resolution
+
+    Parameters
+    ----------
+    parkey: name of the resolution
+    parval: dictionary with the ``number_of_regions`` and the
+            ``node_information_graphml`` of the resolution
+    roi_fname: ROI volume of the resolution registered to the functional space
+    parcellation_scheme: parcellation scheme
+    fdata: 4D fMRI data (array or path to a ``.npy`` file, see ``share_arrays``)
+    index: indices of the time points kept after scrubbing (None without scrubbing)
+    output_types: output types of the connectivity matrices
+    connectivity_metrics: functional connectivity estimators (see ``compute_connectivity_matrices``)
+    dynamic_fc: also compute the correlations of sliding windows (see ``compute_sliding_window_fc``)
+    dfc_window_length: number of time points of the sliding windows (the sliding-window
+                       connectome is skipped if it exceeds the number of time points)
+    dfc_step: number of time points between the starts of consecutive windows
+    dfc_dtype: data type of the sliding-window correlations ('float32' or 'float16')
+    """
+    fdata = load_shared_arrays(fdata)
+
+    print("Resolution = " + parkey)
+
+    # Open the corresponding ROI
+    print("Open the corresponding ROI")
+    print(roi_fname)
+    roi = nib.load(roi_fname)
+    mask = roi.get_data()
+
+    # Compute average time-series
+    # nROIs: number of ROIs for current resolution
+    nROIs = parval['number_of_regions']
+
+    # matrix number of rois vs timepoints, computed for all the ROIs at once
+    voxels, averaging, shape = load_roi_averaging_matrix(roi_fname, nROIs, mask)
+    ts = extract_roi_timeseries(fdata, voxels, averaging, shape)
+    print("ts_shape:", ts.shape)
+
+    np.save(os.path.abspath('averageTimeseries_%s.npy' % parkey), ts)
+    sio.savemat(os.path.abspath(
+        'averageTimeseries_%s.mat' % parkey), {'ts': ts})
+
+    # Create matrix, add node information from parcellation and recover ROI indexes
+    print("Create the connection matrix (%s rois)" % nROIs)
+    G = nx.Graph()
+    gp = nx.read_graphml(parval['node_information_graphml'])
+    if parcellation_scheme != "Lausanne2018":
+        label_key = "dn_correspondence_id"
+    else:
+        label_key = "dn_multiscaleID"
+    node_table = compute_roi_node_table(mask, max([int(d[label_key]) for _, d in gp.nodes(data=True)] + [0]))
+    ROI_idx = []
+    for u, d in gp.nodes(data=True):
+        G.add_node(int(u))
+        for key in d:
+            G.nodes[int(u)][key] = d[key]
+        # compute a position for the node based on the mean position of the
+        # ROI in voxel coordinates (segmentation volume )
+        if parcellation_scheme != "Lausanne2018":
+            G.nodes[int(u)]['dn_position'] = tuple(node_table['centroid'][int(d["dn_correspondence_id"])])
+            ROI_idx.append(int(d["dn_correspondence_id"]))
+        else:
+            G.nodes[int(u)]['dn_position'] = tuple(node_table['centroid'][int(d["dn_multiscaleID"])])
+            ROI_idx.append(int(d["dn_multiscaleID"]))
+
+    # Sliding windows need contiguous time points so they are computed before scrubbing
+    if dynamic_fc and not 2 <= dfc_window_length <= ts.shape[1]:
+        print("  ... WARNING - the sliding-window connectome is not computed: the window length (%i) must be "
+              "between 2 and the number of time points (%i)" % (dfc_window_length, ts.shape[1]))
+    elif dynamic_fc:
+        print("Compute the sliding-window connectome (window: %i, step: %i)" % (dfc_window_length, dfc_step))
+        fc, window_starts = compute_sliding_window_fc(ts, dfc_window_length, dfc_step, np.dtype(dfc_dtype))
+        dyn_rows, dyn_cols = np.triu_indices(ts.shape[0], 1)
+        print('    - dynamic_connectome_%s.npz' % parkey)
+        np.savez(os.path.abspath('dynamic_connectome_%s.npz' % parkey), fc=fc, window_starts=window_starts,
+                 edges=np.column_stack((np.asarray(ROI_idx)[dyn_rows], np.asarray(ROI_idx)[dyn_cols])),
+                 window_length=dfc_window_length, step=dfc_step)
+        del fc
+
+    # Censoring time-series
+    if index is not None:
+        ts_after_scrubbing = ts[:, index]
+        np.save(os.path.abspath(
+            'averageTimeseries_%s_after_scrubbing.npy' % parkey), ts_after_scrubbing)
+        sio.savemat(os.path.abspath('averageTimeseries_%s_after_scrubbing.mat' % parkey),
+                    {'ts': ts_after_scrubbing})
+        ts = ts_after_scrubbing
+        print('ts.shape : ', ts.shape)
+
+    # initialize connectivity matrix
+    nnodes = ts.shape[0]
+    rows, cols = np.triu_indices(nnodes)
+    matrices = compute_connectivity_matrices(ts, connectivity_metrics)
+    edge_data = dict((metric, matrices[metric][rows, cols].astype(np.float64))
+                     for metric in connectivity_metrics)
+    del matrices
+    edges = np.column_stack((np.asarray(ROI_idx)[rows], np.asarray(ROI_idx)[cols]))
+    # np.save( op.join(gconf.get_timeseries(), 'fconnectome_%s.npy' % s), fmat )
+    # sio.savemat( op.join(gconf.get_timeseries(), 'fconnectome_%s.mat' % s), {'fmat':fmat} )
+
+    # the edges are only added to the graph for the graph outputs
+    if 'gPickle' in output_types or 'graphml' in output_types:
+        edge_metrics = list(edge_data.keys())
+        G.add_edges_from((int(u), int(v), dict(zip(edge_metrics, values)))
+                         for (u, v), values in zip(edges.tolist(),
+                                                   np.column_stack([edge_data[k] for k in edge_metrics]).tolist()))
+
+    node_ids = [int(u) for u in gp.nodes()]
+    _, edge_order, _ = order_edges_as_networkx(edges, node_ids)
+    # NaN correlations (e.g. of empty ROIs) are kept as values in all outputs
+    edge_keys = get_first_edge_keys(edge_data, edge_order, nan_undefined=False)
+
+    print('    - connectome_%s.tsv' % parkey)
+    write_connectome_tsv('connectome_%s.tsv' % parkey, edges, edge_data, edge_keys, node_ids, nan_undefined=False)
+
+    # storing network
+    if 'gPickle' in output_types:
+        nx.write_gpickle(G, 'connectome_%s.gpickle' % parkey)
+    if 'mat' in output_types:
+        # edges
+        edge_struct = get_connectome_matrices(edges, edge_data, edge_keys, node_ids, nan_undefined=False)
+
+        # nodes
+        size_nodes = int(parval['number_of_regions'])
+
+        # Get the node attributes/keys from the first node and then break.
+        # Change w.r.t networkx2
+        for u, d in G.nodes(data=True):
+            node_keys = list(d.keys())
+            break
+
+        node_struct = {}
+        for node_key in node_keys:
+            if node_key == 'dn_position':
+                node_arr = np.zeros([size_nodes, 3], dtype=np.float)
+            else:
+                node_arr = np.zeros(size_nodes, dtype=np.object_)
+            node_n = 0
+            for _, node_data in G.nodes(data=True):
+                node_arr[node_n] = node_data[node_key]
+                node_n += 1
+            node_struct[node_key] = node_arr
+
+        sio.savemat('connectome_%s.mat' % parkey, mdict={
+                    'sc': edge_struct, 'nodes': node_struct})
+    if 'npz' in output_types:
+        save_connectome_npz('connectome_%s.npz' % parkey, edges, edge_data, list(G.nodes(data=True)))
+    if 'graphml' in output_types and parcellation_scheme != "Lausanne2018":
+        g2 = nx.Graph()
+        for u_gml, d_gml in G.nodes(data=True):
+            g2.add_node(u_gml, {'dn_correspondence_id': d_gml['dn_correspondence_id'],
+                                'dn_fsname': d_gml['dn_fsname'],
+                                'dn_hemisphere': d_gml['dn_hemisphere'],
+                                'dn_name': d_gml['dn_name'],
+                                'dn_position_x': float(d_gml['dn_position'][0]),
+                                'dn_position_y': float(d_gml['dn_position'][1]),
+                                'dn_position_z': float(d_gml['dn_position'][2]),
+                                'dn_region': d_gml['dn_region']})
+        for u_gml, v_gml, d_gml in G.edges(data=True):
+            g2.add_edge(u_gml, v_gml, dict((k, float(v)) for k, v in d_gml.items()))
+        nx.write_graphml(g2, 'connectome_%s.graphml' % parkey)
+
+    if 'graphml' in output_types and (
+            parcellation_scheme == "Lausanne2018" or parcellation_scheme == 'NativeFreesurfer'):
+        g2 = nx.Graph()
+        for u_gml, d_gml in G.nodes(data=True):
+            g2.add_node(u_gml, {'dn_multiscaleID': d_gml['dn_multiscaleID'],
+                                'dn_fsname': d_gml['dn_fsname'],
+                                'dn_hemisphere': d_gml['dn_hemisphere'],
+                                'dn_name': d_gml['dn_name'],
+                                'dn_position_x': float(d_gml['dn_position'][0]),
+                                'dn_position_y': float(d_gml['dn_position'][1]),
+                                'dn_position_z': float(d_gml['dn_position'][2]),
+                                'dn_region': d_gml['dn_region']})
+        for u_gml, v_gml, d_gml in G.edges(data=True):
+            g2.add_edge(u_gml, v_gml, dict((k, float(v)) for k, v in d_gml.items()))
+        nx.write_graphml(g2, 'connectome_%s.graphml' % parkey)
+
+
 class rsfmri_conmat_InputSpec(BaseInterfaceInputSpec):
     func_file = File(exists=True, mandatory=True, desc="fMRI volume")
     roi_volumes = InputMultiPath(
@@ -780,6 +3019,19 @@ class rsfmri_conmat_InputSpec(BaseInterfaceInputSpec):
     DVARS_th = Float()
     output_types = traits.List(
         Str, desc='Output types of the connectivity matrices')
+    number_of_workers = traits.Int(
+        1, desc='Number of processes used to build the connectomes of the different resolutions in parallel',
+        usedefault=True)
+    connectivity_metrics = traits.List(
+        traits.Enum('corr', 'partial_corr', 'tangent', 'cov'), ['corr'], usedefault=True,
+        desc='Functional connectivity estimators derived from the covariance of the ROI time-series: '
+             'Pearson correlation, Ledoit-Wolf partial correlation, tangent space and covariance')
+    dynamic_fc = Bool(False, usedefault=True,
+                      desc='Compute the correlations of sliding windows over the (unscrubbed) ROI time-series')
+    dfc_window_length = traits.Int(60, usedefault=True, desc='Number of time points of the sliding windows')
+    dfc_step = traits.Int(1, usedefault=True, desc='Number of time points between consecutive windows')
+    dfc_dtype = traits.Enum('float32', 'float16', usedefault=True,
+                            desc='Data type of the saved sliding-window correlations')
 
 
 class rsfmri_conmat_OutputSpec(TraitedSpec):
@@ -787,6 +3039,8 @@ class rsfmri_conmat_OutputSpec(TraitedSpec):
         File(exists=True), desc="ROI average timeseries")
     scrubbed_idx = File(exists=True)
     connectivity_matrices = OutputMultiPath(File(exists=True))
+    dynamic_connectivity_matrices = OutputMultiPath(
+        File(exists=True), desc="Sliding-window correlations of each resolution")
 
 
 class rsfmri_conmat(BaseInterface):
@@ -801,8 +3055,6 @@ class rsfmri_conmat(BaseInterface):
 
         fdata = nib.load(self.inputs.func_file).get_data()
 
-        tp = fdata.shape[3]
-
         # OLD
         # if self.inputs.parcellation_scheme != "Custom":
         #     resolutions = get_parcellation(self.inputs.parcellation_scheme)
@@ -845,263 +3097,71 @@ class rsfmri_conmat(BaseInterface):
             resolutions = self.inputs.atlas_info
             print(resolutions)
 
-        index = np.linspace(0, tp - 1, tp).astype('int')
-
-        # if self.inputs.apply_scrubbing:
-        #     # load scrubbing FD and DVARS series
-        #     FD = np.load( self.inputs.FD )
-        #     DVARS = np.load( self.inputs.DVARS )
-        #     # evaluate scrubbing mask
-        #     FD_th = self.inputs.FD_th
-        #     DVARS_th = self.inputs.DVARS_th
-        #     FD_mask = np.array(np.nonzero(FD < FD_th))[0,:]
-        #     DVARS_mask = np.array(np.nonzero(DVARS < DVARS_th))[0,:]
-        #     index = np.sort(np.unique(np.concatenate((FD_mask,DVARS_mask)))) + 1
-        #     index = np.concatenate(([0],index))
-        #     log_scrubbing = "DISCARDED time points after scrubbing: " + str(FD.shape[0]-index.shape[0]+1) + " over " + str(FD.shape[0]+1)
-        #     print(log_scrubbing)
-        #     np.save( os.path.abspath( 'tp_after_scrubbing.npy'), index )
-        #     sio.savemat( os.path.abspath('tp_after_scrubbing.mat'), {'index':index} )
-        # else:
-        #     index = np.linspace(0,tp-1,tp).astype('int')
-
-        # loop throughout all the resolutions ('scale33', ..., 'scale500')
-        for parkey, parval in list(resolutions.items()):
-            print("Resolution = " + parkey)
-
-            # Open the corresponding ROI
-            print("Open the corresponding ROI")
-            for vol in self.inputs.roi_volumes:
-                if (parkey in vol) or (len(self.inputs.roi_volumes) == 1):
-                    roi_fname = vol
-                    print(roi_fname)
-
-            roi = nib.load(roi_fname)
-            mask = roi.get_data()
-
-            # Compute average time-series
-            # nROIs: number of ROIs for current resolution
-            nROIs = parval['number_of_regions']
-
-            # matrix number of rois vs timepoints
-            ts = np.zeros((nROIs, tp), dtype=np.float32)
-
-            # loop throughout all the ROIs (current resolution)
-            for i in range(1, nROIs + 1):
-                ts[i - 1, :] = fdata[mask == i].mean(axis=0)
-            print("ts_shape:", ts.shape)
-
-            np.save(os.path.abspath('averageTimeseries_%s.npy' % parkey), ts)
+        # Apply scrubbing (if enabled)
+        index = None
+        if self.inputs.apply_scrubbing:
+            # load scrubbing FD and DVARS series
+            FD = np.load(self.inputs.FD)
+            DVARS = np.load(self.inputs.DVARS)
+            # evaluate scrubbing mask
+            FD_th = self.inputs.FD_th
+            DVARS_th = self.inputs.DVARS_th
+            FD_mask = np.array(np.nonzero(FD < FD_th))[0, :]
+            DVARS_mask = np.array(np.nonzero(DVARS < DVARS_th))[0, :]
+            index = np.sort(
+                np.unique(np.concatenate((FD_mask, DVARS_mask)))) + 1
+            index = np.concatenate(([0], index))
+            log_scrubbing = "DISCARDED time points after scrubbing: " + str(
+                FD.shape[0] - index.shape[0] + 1) + " over " + str(FD.shape[0] + 1)
+            print(log_scrubbing)
+            np.save(os.path.abspath('tp_after_scrubbing.npy'), index)
             sio.savemat(os.path.abspath(
-                'averageTimeseries_%s.mat' % parkey), {'ts': ts})
+                'tp_after_scrubbing.mat'), {'index': index})
 
-        # Apply scrubbing (if enabled) and compute correlation
         # loop throughout all the resolutions ('scale33', ..., 'scale500')
+        scales = []
         for parkey, parval in list(resolutions.items()):
-            print("Resolution = " + parkey)
-
-            # Open the corresponding ROI
-            print("Open the corresponding ROI")
             for vol in self.inputs.roi_volumes:
-                if parkey in vol:
+                if (parkey in vol) or (len(self.inputs.roi_volumes) == 1):
                     roi_fname = vol
-                    print(roi_fname)
-            roi = nib.load(roi_fname)
-            roiData = roi.get_data()
-
-            # Average roi time-series
-            ts = np.load(os.path.abspath('averageTimeseries_%s.npy' % parkey))
-
-            # nROIs: number of ROIs for current resolution
-            nROIs = parval['number_of_regions']
-
-            # Create matrix, add node information from parcellation and recover ROI indexes
-            print("Create the connection matrix (%s rois)" % nROIs)
-            G = nx.Graph()
-            gp = nx.read_graphml(parval['node_information_graphml'])
-            ROI_idx = []
-            for u, d in gp.nodes(data=True):
-                G.add_node(int(u))
-                for key in d:
-                    G.nodes[int(u)][key] = d[key]
-                # compute a position for the node based on the mean position of the
-                # ROI in voxel coordinates (segmentation volume )
-                if self.inputs.parcellation_scheme != "Lausanne2018":
-                    G.nodes[int(u)]['dn_position'] = tuple(
-                        np.mean(np.where(mask == int(d["dn_correspondence_id"])), axis=1))
-                    ROI_idx.append(int(d["dn_correspondence_id"]))
-                else:
-                    G.nodes[int(u)]['dn_position'] = tuple(
-                        np.mean(np.where(mask == int(d["dn_multiscaleID"])), axis=1))
-                    ROI_idx.append(int(d["dn_multiscaleID"]))
-            # # matrix number of rois vs timepoints
-            # ts = np.zeros( (nROIs,tp), dtype = np.float32 )
-            #
-            # # loop throughout all the ROIs (current resolution)
-            # roi_line = 0
-            # for i in ROI_idx:
-            #     ts[roi_line,:] = fdata[roiData==i].mean( axis = 0 )
-            #     roi_line += 1
-            #
-            # np.save( os.path.abspath('averageTimeseries_%s.npy' % parkey), ts )
-            # sio.savemat( os.path.abspath('averageTimeseries_%s.mat' % parkey), {'TCS':ts} )
-
-            # Censoring time-series
-            if self.inputs.apply_scrubbing:
-                # load scrubbing FD and DVARS series
-                FD = np.load(self.inputs.FD)
-                DVARS = np.load(self.inputs.DVARS)
-                # evaluate scrubbing mask
-                FD_th = self.inputs.FD_th
-                DVARS_th = self.inputs.DVARS_th
-                FD_mask = np.array(np.nonzero(FD < FD_th))[0, :]
-                DVARS_mask = np.array(np.nonzero(DVARS < DVARS_th))[0, :]
-                index = np.sort(
-                    np.unique(np.concatenate((FD_mask, DVARS_mask)))) + 1
-                index = np.concatenate(([0], index))
-                log_scrubbing = "DISCARDED time points after scrubbing: " + str(
-                    FD.shape[0] - index.shape[0] + 1) + " over " + str(FD.shape[0] + 1)
-                print(log_scrubbing)
-                np.save(os.path.abspath('tp_after_scrubbing.npy'), index)
-                sio.savemat(os.path.abspath(
-                    'tp_after_scrubbing.mat'), {'index': index})
-                ts_after_scrubbing = ts[:, index]
-                np.save(os.path.abspath(
-                    'averageTimeseries_%s_after_scrubbing.npy' % parkey), ts_after_scrubbing)
-                sio.savemat(os.path.abspath('averageTimeseries_%s_after_scrubbing.mat' % parkey),
-                            {'ts': ts_after_scrubbing})
-                ts = ts_after_scrubbing
-                print('ts.shape : ', ts.shape)
-
-                # initialize connectivity matrix
-                nnodes = ts.shape[0]
-                i = -1
-                for i_signal in ts:
-                    i += 1
-                    for j in range(i, nnodes):
-                        j_signal = ts[j, :]
-                        value = np.corrcoef(i_signal, j_signal)[0, 1]
-                        G.add_edge(ROI_idx[i], ROI_idx[j])
-                        G[ROI_idx[i]][ROI_idx[j]]['corr'] = value
-                        # fmat[i,j] = value
-                        # fmat[j,i] = value
-                # np.save( op.join(gconf.get_timeseries(), 'fconnectome_%s_after_scrubbing.npy' % s), fmat )
-                # sio.savemat( op.join(gconf.get_timeseries(),
-                #    'fconnectome_%s_after_scrubbing.mat' % s), {'fmat':fmat} )
-            else:
-                nnodes = ts.shape[0]
-
-                i = -1
-                for i_signal in ts:
-                    i += 1
-                    for j in range(i, nnodes):
-                        j_signal = ts[j, :]
-                        value = np.corrcoef(i_signal, j_signal)[0, 1]
-                        G.add_edge(ROI_idx[i], ROI_idx[j])
-                        G[ROI_idx[i]][ROI_idx[j]]['corr'] = value
-                        # fmat[i,j] = value
-                        # fmat[j,i] = value
-                # np.save( op.join(gconf.get_timeseries(), 'fconnectome_%s.npy' % s), fmat )
-                # sio.savemat( op.join(gconf.get_timeseries(), 'fconnectome_%s.mat' % s), {'fmat':fmat} )
-
-            # Get the edge attributes/keys/weights from the first edge and then break.
-            # Change w.r.t networkx2
-            edge_keys = []
-            for _, _, d in G.edges(data=True):
-                # print(list(d.keys()))
-                edge_keys = list(d.keys())
-                break
+            scales.append((parkey, parval, roi_fname, self.inputs.parcellation_scheme))
+
+        dynamic_fc_args = dict(dynamic_fc=self.inputs.dynamic_fc,
+                               dfc_window_length=self.inputs.dfc_window_length,
+                               dfc_step=self.inputs.dfc_step,
+                               dfc_dtype=self.inputs.dfc_dtype)
+
+        number_of_workers = min(self.inputs.number_of_workers, len(scales))
+        if number_of_workers > 1:
+            # The fMRI data is shared with the workers through a memory-mapped .npy file
+            print("Process %i resolutions with %i workers" % (len(scales), number_of_workers))
+            shared_dir = tempfile.mkdtemp(prefix='conmat_shared_', dir=os.getcwd())
+            try:
+                shared_fdata = share_arrays({'fdata': fdata}, shared_dir)['fdata']
+                with ProcessPoolExecutor(max_workers=number_of_workers) as executor:
+                    futures = [executor.submit(compute_rsfmri_scale_connectome, *scale, fdata=shared_fdata,
+                                               index=index, output_types=self.inputs.output_types,
+                                               connectivity_metrics=self.inputs.connectivity_metrics,
+                                               **dynamic_fc_args)
+                               for scale in scales]
+                    for future in futures:
+                        future.result()
+            finally:
+                shutil.rmtree(shared_dir, ignore_errors=True)
+        else:
+            for scale in scales:
+                compute_rsfmri_scale_connectome(*scale, fdata=fdata, index=index,
+                                                output_types=self.inputs.output_types,
+                                                connectivity_metrics=self.inputs.connectivity_metrics,
+                                                **dynamic_fc_args)
 
-            print('    - connectome_%s.tsv' % parkey)
-
-            with open('connectome_%s.tsv' % parkey, 'w') as out_file:
-                tsv_writer = csv.writer(out_file, delimiter='\t')
-                header = ['source', 'target']
-                header = header + [key for key in edge_keys]
-                tsv_writer.writerow(header)
-
-            with open('connectome_%s.tsv' % parkey, 'ab') as out_file:
-                nx.write_edgelist(G,
-                                  out_file,
-                                  comments='#',
-                                  delimiter='\t',
-                                  data=edge_keys,
-                                  encoding='utf-8')
-
-            # storing network
-            if 'gPickle' in self.inputs.output_types:
-                nx.write_gpickle(G, 'connectome_%s.gpickle' % parkey)
-            if 'mat' in self.inputs.output_types:
-                # edges
-                # size_edges = (int(parval['number_of_regions']), int(
-                #     parval['number_of_regions']))
-
-                edge_struct = {}
-                for edge_key in edge_keys:
-                    edge_struct[edge_key] = nx.to_numpy_matrix(
-                        G, weight=edge_key)
-
-                # nodes
-                size_nodes = int(parval['number_of_regions'])
-
-                # Get the node attributes/keys from the first node and then break.
-                # Change w.r.t networkx2
-                for u, d in G.nodes(data=True):
-                    node_keys = list(d.keys())
-                    break
-
-                node_struct = {}
-                for node_key in node_keys:
-                    if node_key == 'dn_position':
-                        node_arr = np.zeros([size_nodes, 3], dtype=np.float)
-                    else:
-                        node_arr = np.zeros(size_nodes, dtype=np.object_)
-                    node_n = 0
-                    for _, node_data in G.nodes(data=True):
-                        node_arr[node_n] = node_data[node_key]
-                        node_n += 1
-                    node_struct[node_key] = node_arr
-
-                sio.savemat('connectome_%s.mat' % parkey, mdict={
-                            'sc': edge_struct, 'nodes': node_struct})
-            if 'graphml' in self.inputs.output_types and self.inputs.parcellation_scheme != "Lausanne2018":
-                g2 = nx.Graph()
-                for u_gml, d_gml in G.nodes(data=True):
-                    g2.add_node(u_gml, {'dn_correspondence_id': d_gml['dn_correspondence_id'],
-                                        'dn_fsname': d_gml['dn_fsname'],
-                                        'dn_hemisphere': d_gml['dn_hemisphere'],
-                                        'dn_name': d_gml['dn_name'],
-                                        'dn_position_x': float(d_gml['dn_position'][0]),
-                                        'dn_position_y': float(d_gml['dn_position'][1]),
-                                        'dn_position_z': float(d_gml['dn_position'][2]),
-                                        'dn_region': d_gml['dn_region']})
-                for u_gml, v_gml, d_gml in G.edges(data=True):
-                    g2.add_edge(u_gml, v_gml, {'corr': float(d_gml['corr'])})
-                nx.write_graphml(g2, 'connectome_%s.graphml' % parkey)
-
-            if 'graphml' in self.inputs.output_types and (
-                    self.inputs.parcellation_scheme == "Lausanne2018" or self.inputs.parcellation_scheme == 'NativeFreesurfer'):
-                g2 = nx.Graph()
-                for u_gml, d_gml in G.nodes(data=True):
-                    g2.add_node(u_gml, {'dn_multiscaleID': d_gml['dn_multiscaleID'],
-                                        'dn_fsname': d_gml['dn_fsname'],
-                                        'dn_hemisphere': d_gml['dn_hemisphere'],
-                                        'dn_name': d_gml['dn_name'],
-                                        'dn_position_x': float(d_gml['dn_position'][0]),
-                                        'dn_position_y': float(d_gml['dn_position'][1]),
-                                        'dn_position_z': float(d_gml['dn_position'][2]),
-                                        'dn_region': d_gml['dn_region']})
-                for u_gml, v_gml, d_gml in G.edges(data=True):
-                    g2.add_edge(u_gml, v_gml, {'corr': float(d_gml['corr'])})
-                nx.write_graphml(g2, 'connectome_%s.graphml' % parkey)
-
-            if 'cff' in self.inputs.output_types:
-                cvt = cmtk.CFFConverter()
-                cvt.inputs.title = 'Connectome mapper'
-                cvt.inputs.nifti_volumes = self.inputs.roi_volumes
-                cvt.inputs.gpickled_networks = glob.glob(
-                    os.path.abspath("connectome_*.gpickle"))
-                cvt.run()
+        if 'cff' in self.inputs.output_types:
+            cvt = cmtk.CFFConverter()
+            cvt.inputs.title = 'Connectome mapper'
+            cvt.inputs.nifti_volumes = self.inputs.roi_volumes
+            cvt.inputs.gpickled_networks = glob.glob(
+                os.path.abspath("connectome_*.gpickle"))
+            cvt.run()
 
         print("[ DONE ]")
         return runtime
@@ -1114,6 +3174,9 @@ class rsfmri_conmat(BaseInterface):
             os.path.abspath('averageTimeseries_*'))
         if self.inputs.apply_scrubbing:
             outputs['scrubbed_idx'] = os.path.abspath('tp_after_scrubbing.npy')
+        if self.inputs.dynamic_fc:
+            outputs['dynamic_connectivity_matrices'] = glob.glob(
+                os.path.abspath('dynamic_connectome_*.npz'))
         return outputs
 
 
@@ -11,10 +11,11 @@ import os
 import numpy as np
 import nibabel.trackvis as tv
 
-from .util import length
+from .streamlines import streamlines_to_buffer, compute_lengths
 
 
-def compute_length_array(trkfile=None, streams=None, savefname='lengths.npy'):
+def compute_length_array(trkfile=None, streams=None, savefname='lengths.npy', number_of_threads=1,
+                         chunk_size=100000):
     if streams is None and trkfile is not None:
         print("Compute length array for fibers in %s" % trkfile)
         streams, hdr = tv.read(trkfile, as_generator=True)
@@ -26,9 +27,17 @@ def compute_length_array(trkfile=None, streams=None, savefname='lengths.npy'):
     else:
         n_fibers = len(streams)
 
+    # compute the lengths by chunks of fibers concatenated in a flat buffer
     leng = np.zeros(n_fibers, dtype=np.float)
-    for i, fib in enumerate(streams):
-        leng[i] = length(fib[0])
+    streams = iter(streams)
+    start = 0
+    while start < n_fibers:
+        points, offsets = streamlines_to_buffer([fib[0] for _, fib in zip(range(chunk_size), streams)])
+        stop = start + len(offsets) - 1
+        if stop == start:
+            break
+        leng[start:stop] = compute_lengths(points, offsets, number_of_threads)
+        start = stop
 
     # store length array
     np.save(savefname, leng)
@@ -48,16 +57,16 @@ def filter_fibers(intrk, outtrk='', fiber_cutoff_lower=20, fiber_cutoff_upper=50
         base, ext = os.path.splitext(filename)
         outtrk = os.path.abspath(base + '_cutfiltered' + ext)
 
+    # load trackfile (downside, needs everything in memory)
+    fibold, hdrold = tv.read(intrk)
+
     # compute length array
-    le = compute_length_array(intrk)
+    le = compute_length_array(streams=fibold)
 
     # cut the fibers smaller than value
     reducedidx = np.where((le > fiber_cutoff_lower) &
                           (le < fiber_cutoff_upper))[0]
 
-    # load trackfile (downside, needs everything in memory)
-    fibold, hdrold = tv.read(intrk)
-
     # rewrite the track vis file with the reduced number of fibers
     outstreams = []
     for i in reducedidx:
@@ -53,6 +53,71 @@ class discard_tp(BaseInterface):
         return outputs
 
 
+def regress_out(data, X, mask=None, chunk_size=10000):
+    """ Replace the time-series of the voxels by the residuals of their least-squares fit on regressors
+
+    The design matrix is factored once: the residuals are the projection of the
+    time-series on the orthogonal complement of the columns of ``X`` (same
+    residuals as an ordinary least-squares fit, also for rank-deficient
+    designs). They are computed for chunks of voxels with matrix products.
+
+    Parameters
+    ----------
+    data: 4D array of shape [x, y, z, #time points], modified in place
+    X: design matrix of shape [#time points, #regressors]
+    mask: 3D array with the voxels to process (default: the voxels which are not zero at all time points)
+    chunk_size: number of voxels processed at once (bounds the memory used)
+
+    Returns
+    -------
+    data: the input array with the residuals
+    """
+    u, sv, _ = np.linalg.svd(np.asarray(X, dtype=np.float64), full_matrices=False)
+    rank = np.sum(sv > sv.max() * max(X.shape) * np.finfo(np.float64).eps)
+    basis = u[:, :rank]
+
+    if mask is None:
+        mask = np.any(data != 0, axis=3)
+    voxels = np.nonzero(mask)
+    for start in range(0, len(voxels[0]), chunk_size):
+        chunk = tuple(v[start:start + chunk_size] for v in voxels)
+        Y = data[chunk].astype(np.float64)
+        Y -= Y.dot(basis).dot(basis.T)
+        data[chunk] = Y
+    return data
+
+
+def compute_detrending_basis(tp, mode='linear', spline_knot_interval=60):
+    """ Build the basis of the trends removed from the time-series by ``Detrending``
+
+    Parameters
+    ----------
+    tp: number of time points
+    mode: 'linear' or 'quadratic' (Legendre polynomials up to degree 1 or 2),
+          or 'cubic' (cubic B-splines)
+    spline_knot_interval: number of time points between the knots of the cubic B-splines
+
+    Returns
+    -------
+    basis: array of shape [#time points, #basis functions]
+    """
+    x = np.arange(tp, dtype=np.float64)
+    if mode == 'cubic':
+        from scipy.interpolate import BSpline
+
+        order = 3
+        # interior knots every spline_knot_interval time points, centered on the series
+        interior = np.arange(spline_knot_interval / 2.0, tp - 1 - spline_knot_interval / 2.0, spline_knot_interval)
+        knots = np.concatenate(([0] * (order + 1), interior, [tp - 1] * (order + 1)))
+        n_splines = len(knots) - order - 1
+        basis = BSpline(knots, np.eye(n_splines), order, extrapolate=True)(x)
+    else:
+        degree = {'linear': 1, 'quadratic': 2}[mode]
+        # Legendre polynomials of the time points rescaled to [-1, 1] are better conditioned than powers
+        basis = np.polynomial.legendre.legvander(2 * x / max(tp - 1, 1) - 1, degree)
+    return basis
+
+
 class nuisance_InputSpec(BaseInterfaceInputSpec):
     in_file = File(exists=True)
     brainfile = File(desc='Eroded brain mask registered to fMRI space')
@@ -159,7 +224,6 @@ class nuisance_regression(BaseInterface):
 
         # s = gconf.parcellation.keys()[0]
 
-        gm = nib.load(self.inputs.gm_file[0]).get_data().astype(np.uint32)
         # if float(self.inputs.n_discard) > 0:
         #     n_discard = int(self.inputs.n_discard) - 1
         #     if self.inputs.motion_nuisance:
@@ -218,19 +282,13 @@ class nuisance_regression(BaseInterface):
             X = move
             print('> Detrend motion average signals')
 
-        import statsmodels.api as sm
-        X = sm.add_constant(X)
+        # add the constant regressor
+        X = np.column_stack((np.ones(tp), X.reshape(tp, -1)))
         # print('Shape X GLM')
         # print(X.shape)
 
-        # loop throughout all GM voxels
-        for index, _ in np.ndenumerate(gm):
-            Y = data[index[0], index[1], index[2], :].reshape(tp, 1)
-            gls_model = sm.GLS(Y, X)
-            gls_results = gls_model.fit()
-            # new_data[index[0],index[1],index[2],:] = gls_results.resid
-            new_data[index[0], index[1], index[2],
-                     :] = gls_results.resid  # + gls_results.params[8]
+        # fit all the voxels at once
+        regress_out(new_data, X)
 
         img = nib.Nifti1Image(
             new_data, dataimg.get_affine(), dataimg.get_header())
@@ -258,6 +316,8 @@ class detrending_InputSpec(BaseInterfaceInputSpec):
     gm_file = InputMultiPath(
         File(exists=True), desc="ROI files registered to fMRI space")
     mode = Enum(["linear", "quadratic", "cubic"])
+    spline_knot_interval = Int(60, usedefault=True,
+                               desc="Number of time points between the knots of the cubic-spline detrending")
 
 
 class detrending_OutputSpec(TraitedSpec):
@@ -269,10 +329,13 @@ class Detrending(BaseInterface):
     output_spec = detrending_OutputSpec
 
     def _run_interface(self, runtime):
-        """ linear/quadratic detrending
+        """ linear/quadratic/cubic-spline detrending
         """
 
-        print("Linear detrending")
+        titles = {'linear': "Linear detrending",
+                  'quadratic': "Quadratic detrending",
+                  'cubic': "Cubic-spline detrending"}
+        print(titles[self.inputs.mode])
         print("=================")
 
         # Output from previous preprocessing step
@@ -283,58 +346,18 @@ class Detrending(BaseInterface):
         data = dataimg.get_data()
         tp = data.shape[3]
 
-        # GLM: regress out nuisance covariates
+        # The polynomial and spline bases contain the linear trend, so that each
+        # mode is a single projection of the GM voxels out of its basis
         new_data_det = data.copy()
         gm = nib.load(self.inputs.gm_file[0]).get_data().astype(np.uint32)
 
-        from scipy import signal
-
-        for index, value in np.ndenumerate(gm):
-            if value == 0:
-                continue
-
-            Ydet = signal.detrend(
-                data[index[0], index[1], index[2], :].reshape(tp, 1), axis=0)
-            new_data_det[index[0], index[1], index[2], :] = Ydet[:, 0]
+        basis = compute_detrending_basis(tp, self.inputs.mode, self.inputs.spline_knot_interval)
+        regress_out(new_data_det, basis, mask=gm != 0)
 
         img = nib.Nifti1Image(
             new_data_det, dataimg.get_affine(), dataimg.get_header())
         nib.save(img, os.path.abspath('fMRI_detrending.nii.gz'))
 
-        if self.inputs.mode == 'quadratic':
-            print("Quadratic detrending")
-            print("=================")
-            from obspy.signal.detrend import polynomial
-
-            # GLM: regress out nuisance covariates
-            new_data_det2 = new_data_det.copy()
-            for index, value in np.ndenumerate(gm):
-                if value == 0:
-                    continue
-                Ydet = polynomial(
-                    new_data_det2[index[0], index[1], index[2], :], order=2)
-
-            img = nib.Nifti1Image(
-                new_data_det2, dataimg.get_affine(), dataimg.get_header())
-            nib.save(img, os.path.abspath('fMRI_detrending.nii.gz'))
-
-        if self.inputs.mode == 'cubic':
-            print("Cubic-spline detrending")
-            print("=================")
-            from obspy.signal.detrend import spline
-
-            # GLM: regress out nuisance covariates
-            new_data_det2 = new_data_det.copy()
-            for index, value in np.ndenumerate(gm):
-                if value == 0:
-                    continue
-                Ydet = spline(
-                    new_data_det2[index[0], index[1], index[2], :], order=3)
-
-            img = nib.Nifti1Image(
-                new_data_det2, dataimg.get_affine(), dataimg.get_header())
-            nib.save(img, os.path.abspath('fMRI_detrending.nii.gz'))
-
         print("[ DONE ]")
         return runtime
 
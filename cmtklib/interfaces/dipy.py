@@ -9,7 +9,8 @@ Interfaces to the algorithms in dipy
 """
 
 from nipype.interfaces.dipy.base import DipyDiffusionInterface, DipyBaseInterface, DipyBaseInterfaceInputSpec
-from nipype.interfaces.base import TraitedSpec, File, traits, isdefined, BaseInterfaceInputSpec, InputMultiPath
+from nipype.interfaces.base import TraitedSpec, File, traits, isdefined, BaseInterfaceInputSpec, InputMultiPath, \
+    OutputMultiPath
 from nipype import logging
 # import nipype.pipeline.engine as pe
 import gzip
@@ -28,6 +29,17 @@ standard_library.install_aliases()
 IFLOGGER = logging.getLogger('nipype.interface')
 
 
+def _compress_tracks(streamlines, compression_error, multiprocess):
+    """ Compress the streamlines by linearization before they are saved (see ``cmtklib.streamlines.compress_streamlines``) """
+    from multiprocessing import cpu_count
+    from cmtklib.streamlines import compress_streamlines
+
+    IFLOGGER.info('Compressing tracks (max error: %g mm)' % compression_error)
+    compressed, _ = compress_streamlines(list(streamlines), compression_error,
+                                         number_of_threads=cpu_count() if multiprocess else 1)
+    return compressed
+
+
 class DTIEstimateResponseSHInputSpec(DipyBaseInterfaceInputSpec):
     in_mask = File(
         exists=True, desc=('input mask in which we find single fibers'))
@@ -541,6 +553,9 @@ class TensorInformedEudXTractographyInputSpec(BaseInterfaceInputSpec):
     num_seeds = traits.Int(10000, mandatory=True, usedefault=True,
                            desc=('desired number of tracks in tractography'))
     out_prefix = traits.Str(desc=('output prefix for file names'))
+    compression_error = traits.Float(0, usedefault=True,
+                                     desc=('Maximal error (in mm) of the lossy compression of the saved '
+                                           'streamlines (0: no compression)'))
 
 
 class TensorInformedEudXTractographyOutputSpec(TraitedSpec):
@@ -685,6 +700,9 @@ class TensorInformedEudXTractography(DipyBaseInterface):
                            step_sz=self.inputs.step_size,
                            a_low=self.inputs.fa_thresh)
 
+        if self.inputs.compression_error:
+            streamlines = _compress_tracks(streamlines, self.inputs.compression_error, self.inputs.multiprocess)
+
         IFLOGGER.info('Saving tracks')
         save_trk(self._gen_filename('tracked', ext='.trk'),
                  streamlines, affine, fa.shape)
@@ -776,6 +794,37 @@ class DirectionGetterTractographyInputSpec(BaseInterfaceInputSpec):
     num_seeds = traits.Int(10000, mandatory=True, usedefault=True,
                            desc=('desired number of tracks in tractography'))
     out_prefix = traits.Str(desc=('output prefix for file names'))
+    compression_error = traits.Float(0, usedefault=True,
+                                     desc=('Maximal error (in mm) of the lossy compression of the saved '
+                                           'streamlines (0: no compression)'))
+    build_connectome = traits.Bool(False, usedefault=True,
+                                   desc=('Build the connectomes from the streamlines as they are tracked, '
+                                         'without writing the whole tractogram'))
+    roi_volumes = InputMultiPath(File(exists=True),
+                                 desc='ROI volumes registered to diffusion space (required to build the connectome)')
+    roi_graphmls = InputMultiPath(File(exists=True),
+                                  desc='GraphML description of ROI volumes (Lausanne2018)')
+    parcellation_scheme = traits.Enum('Lausanne2008', ['Lausanne2008', 'Lausanne2018', 'NativeFreesurfer', 'Custom'],
+                                      usedefault=True)
+    atlas_info = traits.Dict(desc='custom atlas information')
+    additional_maps = traits.List(File, desc='Additional calculated maps (ADC, gFA, ...)')
+    compute_curvature = traits.Bool(True, usedefault=True, desc='Compute curvature')
+    output_types = traits.List(traits.Str, desc='Output types of the connectivity matrices')
+    number_of_workers = traits.Int(
+        1, usedefault=True,
+        desc='Number of processes used to build the connectomes of the different resolutions in parallel')
+    hierarchical_scales = traits.Bool(False, usedefault=True,
+                                      desc='Label the fiber endpoints in the finest scale only and derive the '
+                                           'labels of the nested coarser scales from it')
+    max_endpoint_distance = traits.Float(0, usedefault=True,
+                                         desc='Maximal distance (in mm) at which the fiber endpoints falling in the '
+                                              'background are assigned to the nearest ROI (0: they are orphans)')
+    map_sketch_size = traits.Int(16, usedefault=True,
+                                 desc='Number of bins of the per-edge histograms of the map values')
+    connectome_chunk_size = traits.Int(100000, usedefault=True,
+                                       desc='Number of streamlines processed at once to build the connectome')
+    save_final_tractogram = traits.Bool(True, usedefault=True,
+                                        desc='Save the streamlines connecting two ROIs of the last resolution')
 
 
 class DirectionGetterTractographyOutputSpec(TraitedSpec):
@@ -785,6 +834,15 @@ class DirectionGetterTractographyOutputSpec(TraitedSpec):
     out_seeds = File(desc=('file containing the (N,3) *voxel* coordinates used'
                            ' in seeding.'))
     streamlines = File(desc='Numpy array of streamlines')
+    endpoints_file = File(desc='Endpoints of the streamlines (build_connectome)')
+    endpoints_mm_file = File(desc='Endpoints of the streamlines in mm (build_connectome)')
+    fiberslength_file = File(desc='Lengths of the streamlines (build_connectome)')
+    final_fiberslength_files = OutputMultiPath(File())
+    filtered_fiberslabel_files = OutputMultiPath(File())
+    final_fiberlabels_files = OutputMultiPath(File())
+    streamline_final_file = File(desc='Streamlines connecting two ROIs of the last resolution (build_connectome)')
+    streamline_index_files = OutputMultiPath(File())
+    connectivity_matrices = OutputMultiPath(File())
 
 
 class DirectionGetterTractography(DipyBaseInterface):
@@ -804,6 +862,45 @@ class DirectionGetterTractography(DipyBaseInterface):
     input_spec = DirectionGetterTractographyInputSpec
     output_spec = DirectionGetterTractographyOutputSpec
 
+    def _build_connectome(self, streamlines, imref):
+        """ Build the connectomes from the streamlines (RAS+ mm) as they are generated """
+        import glob
+        from nipype.utils.filemanip import split_filename
+        from cmtklib.connectome import cmat_from_streamlines, map_rasmm_streamlines
+
+        additional_maps = {}
+        if isdefined(self.inputs.additional_maps):
+            additional_maps = dict((split_filename(add_map)[1], add_map)
+                                   for add_map in self.inputs.additional_maps if add_map != '')
+        atlas_info = self.inputs.atlas_info if isdefined(self.inputs.atlas_info) else {}
+        roi_graphmls = self.inputs.roi_graphmls if isdefined(self.inputs.roi_graphmls) else []
+        output_types = self.inputs.output_types if isdefined(self.inputs.output_types) else ['gPickle']
+
+        IFLOGGER.info('Building the connectomes from the tracked streamlines')
+        streamlines, trkhdr = map_rasmm_streamlines(streamlines, imref)
+        cmat_from_streamlines(streamlines, trkhdr,
+                              roi_volumes=self.inputs.roi_volumes, roi_graphmls=roi_graphmls,
+                              parcellation_scheme=self.inputs.parcellation_scheme,
+                              compute_curvature=self.inputs.compute_curvature, additional_maps=additional_maps,
+                              output_types=output_types, atlas_info=atlas_info,
+                              number_of_workers=self.inputs.number_of_workers,
+                              chunk_size=self.inputs.connectome_chunk_size,
+                              hierarchical_scales=self.inputs.hierarchical_scales,
+                              max_endpoint_distance=self.inputs.max_endpoint_distance,
+                              map_sketch_size=self.inputs.map_sketch_size,
+                              save_final_tractogram=self.inputs.save_final_tractogram,
+                              compression_error=self.inputs.compression_error)
+
+        if 'cff' in output_types:
+            from nipype.interfaces import cmtk
+            cvt = cmtk.CFFConverter()
+            cvt.inputs.title = 'Connectome mapper'
+            cvt.inputs.nifti_volumes = self.inputs.roi_volumes
+            if self.inputs.save_final_tractogram:
+                cvt.inputs.tract_files = ['streamline_final.trk']
+            cvt.inputs.gpickled_networks = glob.glob(op.abspath("connectome_*.gpickle"))
+            cvt.run()
+
     def _run_interface(self, runtime):
         from dipy.tracking import utils
         from dipy.direction import DeterministicMaximumDirectionGetter, \
@@ -822,6 +919,9 @@ class DirectionGetterTractography(DipyBaseInterface):
         if (not (isdefined(self.inputs.in_model))):
             raise RuntimeError(('in_model should be supplied'))
 
+        if self.inputs.build_connectome and not isdefined(self.inputs.roi_volumes):
+            raise RuntimeError(('roi_volumes should be supplied to build the connectome'))
+
         img = nib.load(self.inputs.in_file)
         imref = nib.four_to_three(img)[0]
         affine = img.affine
@@ -1023,9 +1123,15 @@ class DirectionGetterTractography(DipyBaseInterface):
             streamlines = LocalTracking(
                 dg, classifier, tseeds, affine, step_size=self.inputs.step_size, max_cross=1)
 
-            IFLOGGER.info('Saving tracks')
-            sft = StatefulTractogram(streamlines, imref, Space.RASMM)
-            save_trk(sft, self._gen_filename('tracked', ext='.trk'))
+            if self.inputs.build_connectome:
+                self._build_connectome(streamlines, imref)
+            else:
+                if self.inputs.compression_error:
+                    streamlines = _compress_tracks(streamlines, self.inputs.compression_error,
+                                                   self.inputs.multiprocess)
+                IFLOGGER.info('Saving tracks')
+                sft = StatefulTractogram(streamlines, imref, Space.RASMM)
+                save_trk(sft, self._gen_filename('tracked', ext='.trk'))
 
         else:
             IFLOGGER.info('Performing PFT tractography')
@@ -1044,13 +1150,18 @@ class DirectionGetterTractography(DipyBaseInterface):
 
             # streamlines = list(pft_streamline_generator)
 
+            if self.inputs.build_connectome:
+                self._build_connectome(pft_streamline_generator, imref)
+            else:
+                IFLOGGER.info('Saving tracks')
+                from dipy.tracking.streamline import Streamlines
 
-            IFLOGGER.info('Saving tracks')
-            from dipy.tracking.streamline import Streamlines
-
-            streamlines = Streamlines(pft_streamline_generator)
-            sft = StatefulTractogram(streamlines, imref, Space.RASMM)
-            save_trk(sft, self._gen_filename('tracked', ext='.trk'))
+                streamlines = Streamlines(pft_streamline_generator)
+                if self.inputs.compression_error:
+                    streamlines = _compress_tracks(streamlines, self.inputs.compression_error,
+                                                   self.inputs.multiprocess)
+                sft = StatefulTractogram(streamlines, imref, Space.RASMM)
+                save_trk(sft, self._gen_filename('tracked', ext='.trk'))
 
             # from nibabel.streamlines import Field, Tractogram
             # from nibabel.orientations import aff2axcodes
@@ -1071,12 +1182,28 @@ class DirectionGetterTractography(DipyBaseInterface):
     def _list_outputs(self):
         outputs = self._outputs().get()
         outputs['streamlines'] = self._gen_filename('streamlines', ext='.npy')
-        outputs['tracks'] = self._gen_filename('tracked', ext='.trk')
         outputs['tracks2'] = self._gen_filename('tracked_old', ext='.trk')
         outputs['tracks3'] = self._gen_filename('tracked_nib2', ext='.trk')
         if self.inputs.save_seeds:
             outputs['out_seeds'] = self._gen_filename('seeds', ext='.txt')
 
+        if self.inputs.build_connectome:
+            import glob
+            outputs['endpoints_file'] = op.abspath('endpoints.npy')
+            outputs['endpoints_mm_file'] = op.abspath('endpointsmm.npy')
+            outputs['fiberslength_file'] = op.abspath('fiberslength.npy')
+            outputs['final_fiberslength_files'] = glob.glob(op.abspath('final_fiberslength*'))
+            outputs['filtered_fiberslabel_files'] = glob.glob(op.abspath('filtered_fiberslabel*'))
+            outputs['final_fiberlabels_files'] = glob.glob(op.abspath('final_fiberlabels*'))
+            outputs['connectivity_matrices'] = glob.glob(op.abspath('connectome*'))
+            # only the streamlines of streamline_final.trk are saved (tracks is undefined without it)
+            if self.inputs.save_final_tractogram:
+                outputs['streamline_final_file'] = op.abspath('streamline_final.trk')
+                outputs['tracks'] = op.abspath('streamline_final.trk')
+                outputs['streamline_index_files'] = glob.glob(op.abspath('streamline_index_*.npy'))
+        else:
+            outputs['tracks'] = self._gen_filename('tracked', ext='.trk')
+
         return outputs
 
     def _gen_filename(self, name, ext=None):
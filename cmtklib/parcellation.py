@@ -24,6 +24,7 @@ import numpy as np
 
 try:
     from scipy import ndimage
+    from scipy import sparse
     import scipy.ndimage.morphology as nd
 except ImportError:
     raise Exception(
@@ -126,6 +127,9 @@ class ComputeParcellationRoiVolumes(BaseInterface):
             gp = nx.read_graphml(roi_info_graphml)
             n_nodes = len(gp)
 
+            # Count the voxels of all parcels at once
+            roi_counts = compute_roi_node_table(roiData)['volume']
+
             # variables used by the percent counter
             pc = -1
             cnt = -1
@@ -154,8 +158,8 @@ class ComputeParcellationRoiVolumes(BaseInterface):
                 parcel_name = d["dn_name"]
 
                 # Compute the parcel/ROI volume
-                parcel_volumetry = np.sum(roiData == int(
-                    parcel_label)) * voxel_volume
+                parcel_volumetry = (roi_counts[int(parcel_label)] if int(parcel_label) < len(roi_counts)
+                                    else 0) * voxel_volume
 
                 f_volumetry.write(
                     '{:<4}, {:<55}, {:<10}, {:>10} \n'.format(parcel_label, parcel_name, parcel_type, parcel_volumetry))
@@ -180,6 +184,142 @@ class ComputeParcellationRoiVolumes(BaseInterface):
         return filepaths
 
 
+def compute_roi_node_table(roi_data, max_label=0):
+    """ Compute the voxel count, centroid and bounding box of all the ROIs of a parcellation in one pass
+
+    Parameters
+    ----------
+    roi_data: 3D integer array of ROI labels (0 is the background)
+    max_label: the tables cover at least the labels up to max_label
+
+    Returns
+    -------
+    node_table: dictionary of arrays indexed by label, with
+        ``volume`` the number of voxels of each ROI,
+        ``centroid`` the mean voxel coordinates of each ROI (NaN for empty ROIs),
+        ``bbox_min`` / ``bbox_max`` the first / last voxel coordinates of the
+        bounding box of each ROI (-1 for empty ROIs)
+    """
+    roi_data = np.asarray(roi_data)
+    labels = roi_data.ravel().astype(np.int64)
+    voxels = np.flatnonzero(labels > 0)
+    labels = labels[voxels]
+    n_labels = max(int(max_label), int(labels.max()) if len(labels) > 0 else 0) + 1
+
+    # voxel coordinates of the labeled voxels sorted by label
+    order = np.argsort(labels, kind='stable')
+    labels = labels[order]
+    coords = np.column_stack(np.unravel_index(voxels[order], roi_data.shape))
+    del voxels, order
+
+    volume = np.bincount(labels, minlength=n_labels)
+    centroid = np.full((n_labels, 3), np.nan)
+    bbox_min = np.full((n_labels, 3), -1, dtype=np.int64)
+    bbox_max = np.full((n_labels, 3), -1, dtype=np.int64)
+
+    present = np.flatnonzero(volume)
+    if len(present) > 0:
+        starts = np.searchsorted(labels, present)
+        centroid[present] = np.add.reduceat(coords, starts, axis=0) / volume[present, None].astype(np.float64)
+        bbox_min[present] = np.minimum.reduceat(coords, starts, axis=0)
+        bbox_max[present] = np.maximum.reduceat(coords, starts, axis=0)
+
+    return {'volume': volume, 'centroid': centroid, 'bbox_min': bbox_min, 'bbox_max': bbox_max}
+
+
+def compute_roi_averaging_matrix(roi_data, n_rois):
+    """ Build the sparse matrix averaging the voxels of each ROI of a parcellation
+
+    The ROI average time-series are then ``averaging.dot(data[voxels])`` for
+    the voxel-by-time matrix ``data[voxels]``.
+
+    Parameters
+    ----------
+    roi_data: 3D integer array of ROI labels (0 is the background)
+    n_rois: number of ROIs (labels 1 to n_rois)
+
+    Returns
+    -------
+    (voxels: int64 array with the flat (C order) indices of the voxels labeled from 1 to n_rois
+    averaging): float32 CSR matrix of shape [n_rois, #voxels] whose row i - 1 averages
+                the voxels of label i (empty for the empty ROIs)
+    """
+    labels = np.asarray(roi_data).ravel()
+    voxels = np.flatnonzero((labels > 0) & (labels <= n_rois))
+    rows = labels[voxels].astype(np.int64) - 1
+    counts = np.bincount(rows, minlength=int(n_rois))
+    weights = (1.0 / counts[rows]).astype(np.float32)
+    averaging = sparse.csr_matrix((weights, (rows, np.arange(len(voxels)))), shape=(int(n_rois), len(voxels)),
+                                  dtype=np.float32)
+    return voxels, averaging
+
+
+def compute_label_mapping(fine_roi_data, coarse_roi_data):
+    """ Map each ROI of a fine parcellation to the ROI of a coarser parcellation it overlaps the most
+
+    The Lausanne scales are nested, so that every ROI of a scale is (up to
+    the registration) included in one ROI of each coarser scale.
+
+    Parameters
+    ----------
+    fine_roi_data: 3D integer array of ROI labels of the fine parcellation
+    coarse_roi_data: 3D integer array of ROI labels of the coarse parcellation (same voxel grid)
+
+    Returns
+    -------
+    mapping: int32 array of shape [max fine label + 1] with the coarse label of
+             each fine label (0 for the background and for fine labels which do
+             not overlap any coarse ROI)
+    """
+    fine = np.asarray(fine_roi_data).ravel().astype(np.int64)
+    coarse = np.asarray(coarse_roi_data).ravel().astype(np.int64)
+    n_fine = int(fine.max()) + 1 if fine.size > 0 else 1
+    n_coarse = int(coarse.max()) + 1 if coarse.size > 0 else 1
+
+    labeled = (fine > 0) & (coarse > 0)
+    pairs, overlap = np.unique(fine[labeled] * n_coarse + coarse[labeled], return_counts=True)
+    pair_fine = pairs // n_coarse
+
+    # keep the coarse label with the largest overlap for each fine label
+    order = np.lexsort((overlap, pair_fine))
+    last = np.flatnonzero(np.diff(np.append(pair_fine[order], -1)) != 0)
+    mapping = np.zeros(n_fine, dtype=np.int32)
+    mapping[pair_fine[order][last]] = pairs[order][last] % n_coarse
+    return mapping
+
+
+def compute_nearest_label_volume(roi_data, voxel_size, max_radius):
+    """ Assign to each background voxel the label of the nearest ROI voxel within a maximal distance
+
+    Looking up the endpoints of the fibers in this volume assigns the endpoints
+    falling in the background to the nearest ROI with a single gather.
+
+    Parameters
+    ----------
+    roi_data: 3D integer array of ROI labels (0 is the background)
+    voxel_size: voxel size in mm
+    max_radius: maximal distance in mm between a background voxel and its nearest ROI voxel
+
+    Returns
+    -------
+    nearest_label_data: 3D array with the labels of roi_data, extended to the
+                        background voxels closer than max_radius to a ROI
+    """
+    roi_data = np.asarray(roi_data)
+    if not np.any(roi_data > 0):
+        return roi_data.copy()
+
+    background = roi_data <= 0
+    indices = np.zeros((roi_data.ndim,) + roi_data.shape, dtype=np.int32)
+    distances = ndimage.distance_transform_edt(background, sampling=voxel_size[:roi_data.ndim],
+                                               return_distances=True, return_indices=True, indices=indices)
+    nearest_label_data = roi_data[tuple(indices)]
+    del indices
+    too_far = background & (distances > max_radius)
+    nearest_label_data[too_far] = roi_data[too_far]
+    return nearest_label_data
+
+
 def erode_mask(fsdir, maskFile):
     """ Erodes the mask """
     # Define erosion mask
@@ -0,0 +1,290 @@
+# Copyright (C) 2009-2020, Ecole Polytechnique Federale de Lausanne (EPFL) and
+# Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland
+# All rights reserved.
+#
+#  This software is distributed under the open-source license Modified BSD.
+
+""" CMTK Streamline geometry functions
+
+The streamlines are stored in a flat buffer of points with the offsets of the
+streamlines in the buffer (same layout as nibabel ``ArraySequence``): the points
+of streamline ``i`` are ``points[offsets[i]:offsets[i + 1]]``.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+def streamlines_to_buffer(streamlines, dtype=None):
+    """ Concatenate the points of a list of streamlines in a flat buffer
+
+    Parameters
+    ----------
+    streamlines: list of arrays of shape [#points, 3]
+    dtype: data type of the buffer (default: data type of the streamlines)
+
+    Returns
+    -------
+    (points: array of shape [#points, 3] with the points of all streamlines
+    offsets): int array of shape [#streamlines + 1]
+    """
+    offsets = np.zeros(len(streamlines) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(s) for s in streamlines])
+    if len(streamlines) > 0:
+        points = np.concatenate(streamlines)
+    else:
+        points = np.zeros((0, 3))
+    if dtype is not None:
+        points = points.astype(dtype, copy=False)
+    return points, offsets
+
+
+def get_point_streamlines(offsets):
+    """ Return the index of the streamline of each point of the buffer """
+    return np.repeat(np.arange(len(offsets) - 1, dtype=np.int32), np.diff(offsets))
+
+
+def _map_chunks(func, points, offsets, number_of_threads):
+    """ Apply func to chunks of consecutive streamlines in a thread pool and concatenate the results """
+    n = len(offsets) - 1
+    if number_of_threads <= 1 or n < 2 * number_of_threads:
+        return func(points, offsets)
+
+    bounds = np.linspace(0, n, 4 * number_of_threads + 1).astype(np.int64)
+
+    def _run(f0, f1):
+        o0, o1 = offsets[f0], offsets[f1]
+        return func(points[o0:o1], offsets[f0:f1 + 1] - o0)
+
+    with ThreadPoolExecutor(max_workers=number_of_threads) as executor:
+        results = list(executor.map(_run, bounds[:-1], bounds[1:]))
+    return np.concatenate(results)
+
+
+def _segment_lengths(points):
+    """ Length of the segments between consecutive points of the buffer """
+    return np.sqrt((np.diff(points, axis=0) ** 2).sum(axis=1))
+
+
+def _lengths(points, offsets):
+    n = len(offsets) - 1
+    if len(points) < 2:
+        return np.zeros(n)
+    # segments between the last point of a streamline and the first point of the next one are not counted
+    point_streamlines = get_point_streamlines(offsets)
+    inside = point_streamlines[1:] == point_streamlines[:-1]
+    return np.bincount(point_streamlines[:-1][inside], weights=_segment_lengths(points)[inside], minlength=n)
+
+
+def compute_lengths(points, offsets, number_of_threads=1):
+    """ Compute the euclidean length of all streamlines
+
+    Parameters
+    ----------
+    points: array of shape [#points, 3] (see ``streamlines_to_buffer``)
+    offsets: int array of shape [#streamlines + 1]
+    number_of_threads: number of threads used to process chunks of streamlines in parallel
+
+    Returns
+    -------
+    lengths: float64 array of shape [#streamlines] (0 for streamlines with less than 2 points)
+    """
+    return _map_chunks(_lengths, points, offsets, number_of_threads)
+
+
+def _cumulative_lengths(points, offsets):
+    if len(points) == 0:
+        return np.zeros(0)
+    cumulative = np.zeros(len(points))
+    cumulative[1:] = np.cumsum(_segment_lengths(points), dtype=np.float64)
+    # restart from 0 at the first point of each streamline
+    starts = offsets[:-1][np.diff(offsets) > 0]
+    return cumulative - np.repeat(cumulative[starts], np.diff(np.append(starts, len(points))))
+
+
+def compute_cumulative_lengths(points, offsets, number_of_threads=1):
+    """ Compute the cumulative length along all streamlines
+
+    Parameters
+    ----------
+    points: array of shape [#points, 3] (see ``streamlines_to_buffer``)
+    offsets: int array of shape [#streamlines + 1]
+    number_of_threads: number of threads used to process chunks of streamlines in parallel
+
+    Returns
+    -------
+    cumulative_lengths: float64 array of shape [#points] with the length of each
+                        streamline from its first point up to each of its points
+    """
+    return _map_chunks(_cumulative_lengths, points, offsets, number_of_threads)
+
+
+def _gradient(values, offsets):
+    """ Same as ``np.gradient(values)[0]`` applied separately to each streamline of the buffer """
+    grad = np.empty_like(values)
+    if len(values) < 2:
+        grad[:] = np.nan
+        return grad
+    grad[1:-1] = (values[2:] - values[:-2]) / 2.0
+
+    starts = offsets[:-1]
+    ends = offsets[1:] - 1
+    valid = (ends - starts) > 0
+    starts = starts[valid]
+    ends = ends[valid]
+    # one-sided differences at the extremities of each streamline
+    grad[starts] = values[starts + 1] - values[starts]
+    grad[ends] = values[ends] - values[ends - 1]
+
+    single = offsets[:-1][~valid & (np.diff(offsets) > 0)]
+    grad[single] = np.nan
+    return grad
+
+
+def _magnitudes(xyz):
+    mag = np.sum(xyz ** 2, axis=1) ** 0.5
+    mag[mag == 0] = np.finfo(float).eps
+    return mag
+
+
+def _mean_curvatures(points, offsets):
+    n = len(offsets) - 1
+    dxyz = _gradient(points, offsets)
+    ddxyz = _gradient(dxyz, offsets)
+    k = _magnitudes(np.cross(dxyz, ddxyz)) / (_magnitudes(dxyz) ** 3)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.bincount(get_point_streamlines(offsets), weights=k, minlength=n) / np.diff(offsets)
+
+
+def compute_mean_curvatures(points, offsets, number_of_threads=1):
+    """ Compute the mean curvature of all streamlines
+
+    Same as ``cmtklib.util.mean_curvature`` applied to each streamline.
+
+    Parameters
+    ----------
+    points: array of shape [#points, 3] (see ``streamlines_to_buffer``)
+    offsets: int array of shape [#streamlines + 1]
+    number_of_threads: number of threads used to process chunks of streamlines in parallel
+
+    Returns
+    -------
+    mean_curvatures: float64 array of shape [#streamlines] (NaN for streamlines with less than 2 points)
+    """
+    return _map_chunks(_mean_curvatures, points, offsets, number_of_threads)
+
+
+def iter_rasmm_to_voxmm(streamlines, affine, voxel_size):
+    """ Convert streamlines from RAS+ mm coordinates to the trackvis voxmm coordinates of a reference image
+
+    The streamlines are converted one at a time so that a generator (e.g. a
+    tracking algorithm) can be consumed without being materialized.
+
+    Parameters
+    ----------
+    streamlines: iterable of arrays of shape [#points, 3] in RAS+ mm coordinates
+    affine: voxel to RAS+ mm affine of the reference image
+    voxel_size: voxel size of the reference image
+
+    Returns
+    -------
+    voxmm_streamlines: generator of float32 arrays of shape [#points, 3]
+    """
+    ras_to_vox = np.linalg.inv(affine)
+    voxel_size = np.asarray(voxel_size[:3], dtype=np.float64)
+    for pts in streamlines:
+        vox = np.dot(pts, ras_to_vox[:3, :3].T) + ras_to_vox[:3, 3]
+        # trackvis voxel centers are at (index + 0.5) * voxel_size
+        yield ((vox + 0.5) * voxel_size).astype(np.float32)
+
+
+def _compression_mask(points, offsets, tol_error, max_segment_length):
+    points = np.asarray(points, dtype=np.float64)
+    keep = np.zeros(len(points), dtype=bool)
+    starts = offsets[:-1]
+    ends = offsets[1:] - 1
+    nonempty = ends >= starts
+    keep[starts[nonempty]] = True
+    keep[ends[nonempty]] = True
+
+    # all the streamlines are linearized in lockstep: the segment from the anchor
+    # (last kept point) to the candidate point grows while it stays within the
+    # error of the points in between
+    active = (ends - starts) >= 2
+    anchors = starts[active]
+    candidates = anchors + 2
+    lasts = ends[active]
+    while len(anchors) > 0:
+        segments = points[candidates] - points[anchors]
+        segment_norms = np.einsum('ij,ij->i', segments, segments)
+
+        n_between = candidates - anchors - 1
+        between_offsets = np.cumsum(n_between) - n_between
+        between = np.arange(n_between.sum()) + np.repeat(anchors + 1 - between_offsets, n_between)
+
+        # squared distance of the points in between to the segment
+        d = points[between] - np.repeat(points[anchors], n_between, axis=0)
+        s = np.repeat(segments, n_between, axis=0)
+        t = np.einsum('ij,ij->i', d, s) / np.repeat(np.maximum(segment_norms, np.finfo(float).tiny), n_between)
+        np.clip(t, 0, 1, out=t)
+        d -= t[:, None] * s
+        max_errors = np.maximum.reduceat(np.einsum('ij,ij->i', d, d), between_offsets)
+
+        failed = (max_errors > tol_error ** 2) | (segment_norms > max_segment_length ** 2)
+        # the point before the candidate is kept and becomes the new anchor
+        keep[candidates[failed] - 1] = True
+        anchors[failed] = candidates[failed] - 1
+        candidates += 1
+
+        remaining = candidates <= lasts
+        anchors = anchors[remaining]
+        candidates = candidates[remaining]
+        lasts = lasts[remaining]
+    return keep
+
+
+def compute_compression_mask(points, offsets, tol_error=0.01, max_segment_length=10, number_of_threads=1):
+    """ Select the points kept by the linearization of the streamlines
+
+    Same algorithm as ``dipy.tracking.streamline.compress_streamlines``: the
+    points of a streamline are dropped as long as they are within ``tol_error``
+    of the segment joining the kept points around them, and the segments are
+    not longer than ``max_segment_length``. The extremities are always kept.
+
+    Parameters
+    ----------
+    points: array of shape [#points, 3] (see ``streamlines_to_buffer``)
+    offsets: int array of shape [#streamlines + 1]
+    tol_error: maximal distance (in the units of the points, e.g. mm) between a dropped point and the compressed streamline
+    max_segment_length: maximal length of the segments of the compressed streamlines
+    number_of_threads: number of threads used to process chunks of streamlines in parallel
+
+    Returns
+    -------
+    keep: bool array of shape [#points]
+    """
+    def _mask(chunk_points, chunk_offsets):
+        return _compression_mask(chunk_points, chunk_offsets, tol_error, max_segment_length)
+    return _map_chunks(_mask, points, offsets, number_of_threads)
+
+
+def compress_streamlines(streamlines, tol_error=0.01, max_segment_length=10, number_of_threads=1):
+    """ Compress a list of streamlines by linearization (see ``compute_compression_mask``)
+
+    Parameters
+    ----------
+    streamlines: list of arrays of shape [#points, 3]
+    tol_error: maximal distance between a dropped point and the compressed streamline
+    max_segment_length: maximal length of the segments of the compressed streamlines
+    number_of_threads: number of threads used to process chunks of streamlines in parallel
+
+    Returns
+    -------
+    compressed: list of arrays of shape [#kept points, 3]
+    keep: list of bool arrays with the points kept in each streamline
+    """
+    points, offsets = streamlines_to_buffer(streamlines)
+    keep = compute_compression_mask(points, offsets, tol_error, max_segment_length, number_of_threads)
+    masks = np.split(keep, offsets[1:-1])
+    return [np.asarray(s)[m] for s, m in zip(streamlines, masks)], masks
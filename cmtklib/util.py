@@ -35,6 +35,61 @@ class bcolors:
     UNDERLINE = '\033[4m'
 
 
+def load_connectome_npz(fname, weight, dtype=np.float32):
+    """ Load the dense connectivity matrix of a measure from a connectome saved in the npz format
+
+    Parameters
+    ----------
+    fname: ``.npz`` file saved by ``cmtklib.connectome.save_connectome_npz``
+    weight: name of the edge measure
+    dtype: data type of the matrix
+
+    Returns
+    -------
+    connmat: array of shape [#nodes, #nodes] with rows and columns in the order
+             of the node table (0 where there is no edge, NaN where the measure
+             is undefined for an edge)
+    """
+    with np.load(fname) as data:
+        node_ids = data['node_id']
+        source = data['edge_source']
+        target = data['edge_target']
+        values = data['edge_' + weight]
+
+    sorter = np.argsort(node_ids)
+    u = np.searchsorted(node_ids, source, sorter=sorter)
+    v = np.searchsorted(node_ids, target, sorter=sorter)
+    valid = (u < len(node_ids)) & (v < len(node_ids))
+    valid[valid] &= (node_ids[sorter[u[valid]]] == source[valid]) & (node_ids[sorter[v[valid]]] == target[valid])
+    u = sorter[u[valid]]
+    v = sorter[v[valid]]
+    values = values[valid].astype(dtype)
+
+    connmat = np.zeros((len(node_ids), len(node_ids)), dtype=dtype)
+    connmat[u, v] = values
+    connmat[v, u] = values
+    return connmat
+
+
+def load_graph_matrix(connmat_fname, weight):
+    """ Load the connectivity matrix of a measure, from the npz version of the gpickle file if it exists
+
+    Both formats give the same matrix: rows and columns in the order of the
+    nodes, 0 where there is no edge and NaN where the measure is undefined for
+    an edge (edges of the gpickle graph without the measure).
+    """
+    npz_fname = op.splitext(connmat_fname)[0] + '.npz'
+    if op.exists(npz_fname):
+        return load_connectome_npz(npz_fname, weight)
+    connmat_gp = nx.read_gpickle(connmat_fname)
+    node_index = dict((u, i) for i, u in enumerate(connmat_gp.nodes()))
+    connmat = np.zeros((len(node_index), len(node_index)), dtype=np.float32)
+    for u, v, d in connmat_gp.edges(data=True):
+        connmat[node_index[u], node_index[v]] = d.get(weight, np.nan)
+        connmat[node_index[v], node_index[u]] = d.get(weight, np.nan)
+    return connmat
+
+
 def load_graphs(output_dir, subjects, parcellation_scheme, weight):
     if parcellation_scheme == 'Lausanne2008':
         bids_atlas_label = 'L2008'
@@ -61,9 +116,7 @@ def load_graphs(output_dir, subjects, parcellation_scheme, weight):
                                             '{}_{}_label-{}_conndata-snetwork_connectivity.gpickle'.format(subj,
                                                                                                            subj_session,
                                                                                                            bids_atlas_label))
-                    connmat_gp = nx.read_gpickle(connmat_fname)
-                    connmat = nx.to_numpy_matrix(
-                        connmat_gp, weight=weight, dtype=np.float32)
+                    connmat = load_graph_matrix(connmat_fname, weight)
     else:
         # For each parcellation scale
         for scale in np.arange(1, 6):
@@ -83,9 +136,7 @@ def load_graphs(output_dir, subjects, parcellation_scheme, weight):
                         connmat_fname = op.join(conn_derivatives_dir,
                                                 '{}_{}_label-{}_desc-scale{}_conndata-snetwork_connectivity.gpickle'.format(
                                                     subj, subj_session, bids_atlas_label, scale))
-                        connmat_gp = nx.read_gpickle(connmat_fname)
-                        connmat = nx.to_numpy_matrix(
-                            connmat_gp, weight=weight, dtype=np.float32)
+                        connmat = load_graph_matrix(connmat_fname, weight)
                 # TODO: finalize condition and append all conmat to a list
     return connmat
 
@@ -0,0 +1,73 @@
+import os
+import time
+
+import numpy as np
+
+from cmtklib.cache import ArrayCache, hash_file, make_cache_key
+
+
+def test_put_and_get(tmp_path):
+    cache = ArrayCache(str(tmp_path / 'cache'))
+    key = make_cache_key('geometry', 'abc', 1.5)
+    assert key == make_cache_key('geometry', 'abc', 1.5)
+    assert key != make_cache_key('geometry', 'abc', 2.5)
+    assert cache.get(key) is None
+
+    arrays = {'lengths': np.arange(10, dtype=np.float32), 'endpoints': np.ones((10, 2, 3), dtype=np.int32)}
+    cache.put(key, arrays)
+    cached = cache.get(key)
+    assert sorted(cached) == sorted(arrays)
+    for name, value in arrays.items():
+        assert isinstance(cached[name], np.memmap)
+        np.testing.assert_array_equal(cached[name], value)
+    assert not [d for d in os.listdir(cache.cache_dir) if d.startswith('.tmp_')]
+
+
+def test_lru_eviction(tmp_path):
+    # 1 MB budget and entries of 0.4 MB
+    cache = ArrayCache(str(tmp_path / 'cache'), disk_budget=1)
+    values = np.zeros(50000, dtype=np.float64)
+    now = time.time()
+    for i, key in enumerate(('a', 'b')):
+        cache.put(key, {'values': values})
+        os.utime(os.path.join(cache.cache_dir, key), (now - 100 + i, now - 100 + i))
+    # 'a' becomes the most recently used entry
+    assert cache.get('a') is not None
+
+    cache.put('c', {'values': values})
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('c') is not None
+
+    # the entry just stored is kept even if it exceeds the budget alone
+    cache.put('d', {'values': np.zeros(200000, dtype=np.float64)})
+    assert cache.get('d') is not None
+    assert cache.get('a') is None and cache.get('c') is None
+
+
+def test_stale_temporary_entries_are_removed(tmp_path):
+    cache = ArrayCache(str(tmp_path / 'cache'))
+    stale = os.path.join(cache.cache_dir, '.tmp_stale')
+    recent = os.path.join(cache.cache_dir, '.tmp_recent')
+    os.makedirs(stale)
+    os.makedirs(recent)
+    old = time.time() - cache.stale_tmp_age - 10
+    os.utime(stale, (old, old))
+
+    cache.evict()
+    assert not os.path.exists(stale)
+    assert os.path.exists(recent)
+
+
+def test_file_hashes(tmp_path):
+    cache = ArrayCache(str(tmp_path / 'cache'))
+    fname = str(tmp_path / 'volume.nii')
+    with open(fname, 'wb') as f:
+        f.write(b'first content')
+    digest = cache.hash_file(fname)
+    assert digest == hash_file(fname)
+    assert cache.hash_file(fname) == digest
+
+    with open(fname, 'wb') as f:
+        f.write(b'second content')
+    os.utime(fname, (time.time() + 10, time.time() + 10))
+    assert cache.hash_file(fname) == hash_file(fname) != digest
@@ -0,0 +1,182 @@
+import os
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from cmtklib.connectome import compute_scale_connectomes, build_edge_index, save_streamline_index, \
+    load_streamline_index, extract_edge_bundle
+
+
+def test_shared_arrays_removed_when_a_worker_fails(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    resolutions = {'scale1': {'number_of_regions': 2, 'node_information_graphml': 'missing_scale1.graphml'},
+                   'scale2': {'number_of_regions': 3, 'node_information_graphml': 'missing_scale2.graphml'}}
+    fiber_data = {'labels': np.zeros((4, 2, 2), dtype=np.int32), 'outside': np.zeros(4, dtype=bool),
+                  'lengths': np.ones(4), 'maps': {}, 'edge_maps': {}}
+    with pytest.raises(Exception):
+        compute_scale_connectomes(resolutions, ['missing_scale1.nii.gz', 'missing_scale2.nii.gz'], 'Custom',
+                                  fiber_data, ['gPickle'], number_of_workers=2)
+    assert not [d for d in os.listdir(str(tmp_path)) if d.startswith('cmat_shared_')]
+
+
+def test_streamline_index_bundle_extraction(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.RandomState(0)
+    n_fibers, n_rois = 60, 4
+    fibers = [rng.rand(rng.randint(2, 9), 3).astype(np.float32) * 10 for _ in range(n_fibers)]
+    fiberlabels = np.sort(rng.randint(1, n_rois + 1, size=(n_fibers, 2)), axis=1)
+    # only part of the fibers are stored in the final tractogram
+    final_fibers_idx = np.flatnonzero(rng.rand(n_fibers) < 0.7)
+
+    hdr = nib.trackvis.empty_header()
+    hdr['n_count'] = len(final_fibers_idx)
+    nib.trackvis.write('streamline_final.trk', [(fibers[i], None, None) for i in final_fibers_idx], hdr)
+
+    edges, offsets, edge_fibers = build_edge_index(fiberlabels, np.arange(n_fibers), n_rois)
+    fnames = save_streamline_index('streamline_index_scale1', edges, offsets, edge_fibers, n_rois,
+                                   final_fibers_idx, [len(fibers[i]) for i in final_fibers_idx], hdr)
+    assert all(os.path.exists(fname) for fname in fnames)
+
+    index = load_streamline_index('streamline_index_scale1')
+    assert isinstance(index['offsets'], np.memmap)
+    for u in range(1, n_rois + 1):
+        for v in range(u, n_rois + 1):
+            expected = [i for i in final_fibers_idx if tuple(fiberlabels[i]) == (u, v)]
+            bundle = extract_edge_bundle('streamline_index_scale1', 'streamline_final.trk', v, u,
+                                         out_file='bundle.trk')
+            assert len(bundle) == len(expected)
+            for (points, _, _), i in zip(bundle, expected):
+                np.testing.assert_array_equal(points, fibers[i])
+            assert len(nib.trackvis.read('bundle.trk')[0]) == len(expected)
+
+
+def _create_tractography(dirname, n_rois=5, n_fibers=200, seed=0):
+    """ Create a ROI volume with its GraphML node description, a FA map and streamlines in RAS+ mm
+
+    Returns
+    -------
+    (roi_fname, fa_fname, atlas_info, streamlines): the streamlines are also saved in ``tracks.tck``
+    """
+    import networkx as nx
+
+    rng = np.random.RandomState(seed)
+    shape = (12, 10, 8)
+    affine = np.array([[2., 0, 0, -12], [0, 2., 0, -10], [0, 0, 2., -8], [0, 0, 0, 1]])
+    roi_data = rng.randint(0, n_rois + 1, size=shape).astype(np.int16)
+    roi_fname = os.path.join(dirname, 'ROIv_scale1.nii.gz')
+    nib.save(nib.Nifti1Image(roi_data, affine), roi_fname)
+    fa_fname = os.path.join(dirname, 'FA.nii.gz')
+    nib.save(nib.Nifti1Image(rng.rand(*shape).astype(np.float32), affine), fa_fname)
+    atlas_info = {'scale1': {'number_of_regions': n_rois,
+                             'node_information_graphml': os.path.join(dirname, 'ROIv_scale1.graphml')}}
+    gp = nx.Graph()
+    for i in range(1, n_rois + 1):
+        gp.add_node(str(i), dn_correspondence_id=str(i), dn_name='roi%i' % i, dn_region='cortical')
+    nx.write_graphml(gp, atlas_info['scale1']['node_information_graphml'])
+
+    lower, upper = affine[:3, 3], affine[:3, 3] + 2 * (np.array(shape) - 1)
+    streamlines = []
+    for _ in range(n_fibers):
+        start, end = lower + rng.rand(3) * (upper - lower), lower + rng.rand(3) * (upper - lower)
+        t = np.linspace(0, 1, rng.randint(5, 30))[:, None]
+        streamlines.append((start + t * (end - start)).astype(np.float32))
+    nib.streamlines.save(nib.streamlines.Tractogram(streamlines, affine_to_rasmm=np.eye(4)),
+                         os.path.join(dirname, 'tracks.tck'))
+    return roi_fname, fa_fname, atlas_info, streamlines
+
+
+def _assert_same_connectomes(G, G_ref, keys=None):
+    assert G_ref.number_of_edges() > 0
+    assert sorted(G.edges()) == sorted(G_ref.edges())
+    for u, v, d in G_ref.edges(data=True):
+        if keys is None:
+            assert sorted(G[u][v]) == sorted(d)
+        for key in (keys if keys is not None else d):
+            np.testing.assert_allclose(G[u][v][key], d[key], rtol=1e-5, err_msg=key)
+
+
+def test_connectome_from_streamlines_matches_cmat(tmp_path, monkeypatch):
+    import networkx as nx
+    from cmtklib.connectome import cmat, cmat_from_streamlines, map_rasmm_streamlines
+
+    roi_fname, fa_fname, atlas_info, streamlines = _create_tractography(str(tmp_path))
+    kwargs = dict(roi_volumes=[roi_fname], roi_graphmls=[], parcellation_scheme='Custom',
+                  additional_maps={'FA': fa_fname}, output_types=['gPickle'], atlas_info=atlas_info)
+    (tmp_path / 'two_steps').mkdir()
+    (tmp_path / 'fused').mkdir()
+    monkeypatch.chdir(tmp_path / 'two_steps')
+    cmat(str(tmp_path / 'tracks.tck'), map_statistics='approximate', reference_image=fa_fname, **kwargs)
+    monkeypatch.chdir(tmp_path / 'fused')
+    cmat_from_streamlines(*map_rasmm_streamlines(iter(streamlines), fa_fname), chunk_size=64, **kwargs)
+
+    _assert_same_connectomes(nx.read_gpickle(str(tmp_path / 'fused' / 'connectome_scale1.gpickle')),
+                             nx.read_gpickle(str(tmp_path / 'two_steps' / 'connectome_scale1.gpickle')))
+    for name in ('streamline_final.trk', 'fiberslength.npy'):
+        assert os.path.exists(str(tmp_path / 'fused' / name))
+
+
+def test_connectome_from_endpoints_of_another_parcellation(tmp_path, monkeypatch):
+    import networkx as nx
+    from cmtklib.connectome import cmat, cmat_from_endpoints
+
+    roi_fname, fa_fname, atlas_info, _ = _create_tractography(str(tmp_path))
+    # another parcellation registered to the same space
+    (tmp_path / 'other').mkdir()
+    other_roi_fname, _, other_atlas_info, _ = _create_tractography(str(tmp_path / 'other'), n_rois=7, seed=1)
+    kwargs = dict(roi_graphmls=[], parcellation_scheme='Custom', output_types=['gPickle'])
+
+    for dirname, rois, info in (('first', roi_fname, atlas_info), ('reference', other_roi_fname, other_atlas_info)):
+        (tmp_path / dirname).mkdir()
+        monkeypatch.chdir(tmp_path / dirname)
+        cmat(str(tmp_path / 'tracks.tck'), [rois], atlas_info=info, reference_image=fa_fname, **kwargs)
+
+    (tmp_path / 'from_endpoints').mkdir()
+    monkeypatch.chdir(tmp_path / 'from_endpoints')
+    cmat_from_endpoints(str(tmp_path / 'first' / 'endpointsmm.npy'), str(tmp_path / 'first' / 'fiberslength.npy'),
+                        [other_roi_fname], atlas_info=other_atlas_info, **kwargs)
+
+    G = nx.read_gpickle('connectome_scale1.gpickle')
+    G_ref = nx.read_gpickle(str(tmp_path / 'reference' / 'connectome_scale1.gpickle'))
+    keys = list(list(G.edges(data=True))[0][2])
+    assert 'number_of_fibers' in keys
+    _assert_same_connectomes(G, G_ref, keys)
+
+
+def test_cmat_reuses_the_cached_fiber_data(tmp_path, monkeypatch, capsys):
+    import networkx as nx
+    from cmtklib.connectome import cmat
+
+    roi_fname, fa_fname, atlas_info, _ = _create_tractography(str(tmp_path))
+    kwargs = dict(roi_volumes=[roi_fname], roi_graphmls=[], parcellation_scheme='Custom',
+                  additional_maps={'FA': fa_fname}, atlas_info=atlas_info, reference_image=fa_fname)
+
+    for dirname, output_types, cache_dir in (('reference', ['gPickle'], None),
+                                             ('first', ['gPickle'], str(tmp_path / 'cache')),
+                                             ('rerun', ['gPickle', 'mat'], str(tmp_path / 'cache'))):
+        (tmp_path / dirname).mkdir()
+        monkeypatch.chdir(tmp_path / dirname)
+        capsys.readouterr()
+        cmat(str(tmp_path / 'tracks.tck'), output_types=output_types, cache_dir=cache_dir, **kwargs)
+
+    assert 'loaded from the cache' in capsys.readouterr().out
+    assert os.path.exists(str(tmp_path / 'rerun' / 'connectome_scale1.mat'))
+    G_ref = nx.read_gpickle(str(tmp_path / 'reference' / 'connectome_scale1.gpickle'))
+    for dirname in ('first', 'rerun'):
+        _assert_same_connectomes(nx.read_gpickle(str(tmp_path / dirname / 'connectome_scale1.gpickle')), G_ref)
+
+
+def test_edge_index_matches_per_edge_search():
+    rng = np.random.RandomState(0)
+    n_rois = 9
+    fiberlabels = np.sort(rng.randint(1, n_rois + 1, size=(500, 2)), axis=1)
+    fibers_idx = np.sort(rng.choice(2000, size=500, replace=False))
+
+    edges, offsets, fibers = build_edge_index(fiberlabels, fibers_idx, n_rois)
+    assert len(offsets) == len(edges) + 1 and offsets[-1] == len(fibers_idx)
+    # edges sorted by (startROI, endROI), each with the fibers found by np.where as in the original cmat
+    expected_edges = sorted(set(map(tuple, fiberlabels.tolist())))
+    assert [tuple(e) for e in edges.tolist()] == expected_edges
+    for e, (u, v) in enumerate(expected_edges):
+        idx = np.where((fiberlabels[:, 0] == u) & (fiberlabels[:, 1] == v))[0]
+        np.testing.assert_array_equal(fibers[offsets[e]:offsets[e + 1]], fibers_idx[idx])
@@ -0,0 +1,82 @@
+import nipype.interfaces.utility as util
+import nipype.pipeline.engine as pe
+
+from cmp.stages.connectome.connectome import ConnectomeStage
+from cmp.stages.diffusion.diffusion import DiffusionStage
+
+
+def _create_stage_flow(stage):
+    """ Create the workflow of a stage as done by ``Pipeline.create_stage_flow`` """
+    flow = pe.Workflow(name=stage.name)
+    inputnode = pe.Node(interface=util.IdentityInterface(fields=stage.inputs), name="inputnode")
+    outputnode = pe.Node(interface=util.IdentityInterface(fields=stage.outputs), name="outputnode")
+    flow.add_nodes([inputnode, outputnode])
+    stage.create_workflow(flow, inputnode, outputnode)
+    return flow
+
+
+def _connections(flow, src, dst):
+    return flow._graph.get_edge_data(flow.get_node(src), flow.get_node(dst))['connect']
+
+
+def _dipy_diffusion_stage(tmp_path):
+    stage = DiffusionStage(str(tmp_path), str(tmp_path))
+    stage.config.recon_processing_tool = 'Dipy'
+    stage.config.tracking_processing_tool = 'Dipy'
+    stage.config.diffusion_model = 'Probabilistic'
+    stage.config.dipy_tracking_config.SD = True
+    return stage
+
+
+def test_tracking_builds_the_connectome(tmp_path):
+    connectome_stage = ConnectomeStage(str(tmp_path), str(tmp_path))
+    stage = _dipy_diffusion_stage(tmp_path)
+    stage.config.dipy_tracking_config.build_connectome = True
+    stage.config.dipy_tracking_config.connectome_chunk_size = 1000
+    assert not stage.builds_connectome()
+    stage.connectome_config = connectome_stage.config
+    assert stage.builds_connectome()
+
+    flow = _create_stage_flow(stage)
+    tracking = flow.get_node('tracking')
+    dipy_tracking = tracking.get_node('dipy_probabilistic_tracking')
+    assert dipy_tracking.inputs.build_connectome
+    assert dipy_tracking.inputs.connectome_chunk_size == 1000
+    assert dipy_tracking.inputs.output_types == connectome_stage.config.output_types
+
+    assert ('out_file', 'inputnode.roi_volumes') in _connections(flow, 'dilate_rois', 'tracking')
+    assert ('out', 'inputnode.additional_maps') in _connections(flow, 'merge_additional_maps', 'tracking')
+    assert ('roi_graphMLs', 'inputnode.roi_graphMLs') in _connections(flow, 'inputnode', 'tracking')
+    assert ('outputnode.connectivity_matrices', 'connectivity_matrices') in _connections(flow, 'tracking',
+                                                                                         'outputnode')
+    inputs = [dst for _, dst in _connections(tracking, 'inputnode', 'dipy_probabilistic_tracking')]
+    for name in ('roi_volumes', 'roi_graphmls', 'parcellation_scheme', 'atlas_info', 'additional_maps'):
+        assert name in inputs
+
+    # The connectome stage only passes the connectomes built by the tracking through
+    connectome_stage.config.connectome_from_tracking = True
+    con_flow = _create_stage_flow(connectome_stage)
+    assert con_flow.list_node_names() == ['inputnode', 'outputnode']
+    assert ('connectivity_matrices', 'connectivity_matrices') in _connections(con_flow, 'inputnode', 'outputnode')
+
+
+def test_tensor_tracking_does_not_build_the_connectome(tmp_path):
+    stage = _dipy_diffusion_stage(tmp_path)
+    stage.config.diffusion_model = 'Deterministic'
+    stage.config.dipy_tracking_config.SD = False
+    stage.config.dipy_tracking_config.build_connectome = True
+    stage.connectome_config = ConnectomeStage(str(tmp_path), str(tmp_path)).config
+    assert not stage.builds_connectome()
+
+    flow = _create_stage_flow(stage)
+    assert 'merge_additional_maps' not in flow.list_node_names()
+    assert 'build_connectome' not in flow.get_node('tracking').get_node('dipy_dtieudx_tracking').inputs.get()
+
+
+def test_tck_tractograms_use_the_wm_mask_grid(tmp_path):
+    from cmp.stages.diffusion.tracking import MRtrix_tracking_config
+
+    assert MRtrix_tracking_config().convert_to_trk
+
+    flow = _create_stage_flow(ConnectomeStage(str(tmp_path), str(tmp_path)))
+    assert ('wm_mask_registered', 'reference_image') in _connections(flow, 'inputnode', 'compute_matrice')
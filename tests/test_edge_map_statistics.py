@@ -0,0 +1,58 @@
+import numpy as np
+
+from cmtklib.connectome import EdgeMapStatistics, compute_map_histogram_bins, lookup_edge_map_statistics, \
+    compute_segment_statistics
+
+
+def test_edge_map_statistics_by_chunks():
+    rng = np.random.RandomState(0)
+    mdata = rng.rand(10, 10, 10)
+    keys = rng.randint(0, 20, size=5000) * 7
+    values = rng.rand(5000)
+
+    bin_edges = compute_map_histogram_bins(mdata, 16)
+    stats = EdgeMapStatistics(bin_edges)
+    for start in range(0, len(values), 700):
+        stats.update(keys[start:start + 700], values[start:start + 700])
+    summary = stats.summarize()
+
+    edge_keys = np.array([0, 7, 700, 133])
+    mean, median, std = lookup_edge_map_statistics(summary, edge_keys)
+    for e, key in enumerate(edge_keys):
+        edge_values = values[keys == key]
+        if len(edge_values) == 0:
+            assert np.isnan(mean[e]) and np.isnan(median[e]) and np.isnan(std[e])
+            continue
+        np.testing.assert_allclose(mean[e], edge_values.mean())
+        np.testing.assert_allclose(std[e], edge_values.std())
+        # the error of the median is bounded by the width of its bin
+        b = np.searchsorted(bin_edges, np.median(edge_values)) - 1
+        assert abs(median[e] - np.median(edge_values)) <= bin_edges[b + 1] - bin_edges[b]
+
+
+def test_edge_map_statistics_constant_edge():
+    stats = EdgeMapStatistics(np.linspace(0, 1, 17))
+    stats.update(np.array([3, 3, 5]), np.array([0.3, 0.3, 2.0]))
+    stats.update(np.array([3]), np.array([0.3]))
+    mean, median, std = lookup_edge_map_statistics(stats.summarize(), np.array([3, 5]))
+    np.testing.assert_allclose(mean, [0.3, 2.0])
+    np.testing.assert_allclose(median, [0.3, 2.0])
+    np.testing.assert_allclose(std, [0.0, 0.0], atol=1e-12)
+
+
+def test_segment_statistics():
+    rng = np.random.RandomState(0)
+    counts = np.array([3, 0, 1, 4, 7, 2, 0, 10])
+    offsets = np.append(0, np.cumsum(counts))
+    values = rng.rand(offsets[-1])
+    values[[1, 4, 5, 6, 7]] = np.nan
+
+    mean, median, std = compute_segment_statistics(values, offsets)
+    for s in range(len(counts)):
+        segment = values[offsets[s]:offsets[s + 1]]
+        if np.all(np.isnan(segment)):
+            assert np.isnan(mean[s]) and np.isnan(median[s]) and np.isnan(std[s])
+            continue
+        np.testing.assert_allclose(mean[s], np.nanmean(segment))
+        np.testing.assert_allclose(median[s], np.nanmedian(segment))
+        np.testing.assert_allclose(std[s], np.nanstd(segment), atol=1e-12)
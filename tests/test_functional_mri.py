@@ -0,0 +1,81 @@
+import os
+
+import nibabel as nib
+import numpy as np
+from scipy import signal
+from scipy.interpolate import make_lsq_spline
+
+from cmtklib.functionalMRI import regress_out, compute_detrending_basis, Detrending
+
+
+def test_regress_out_matches_ols():
+    rng = np.random.RandomState(0)
+    tp = 50
+    data = rng.randn(6, 5, 4, tp).astype(np.float32) + 100
+    data[0, 0, 0] = 0
+    regressors = rng.randn(tp, 3)
+    # the last regressor is a combination of the others (rank-deficient design)
+    X = np.column_stack((np.ones(tp), regressors, regressors[:, 0] - 2 * regressors[:, 2]))
+
+    expected = data.astype(np.float64)
+    for index in np.ndindex(data.shape[:3]):
+        if np.any(data[index] != 0):
+            beta = np.linalg.lstsq(X, data[index].astype(np.float64), rcond=None)[0]
+            expected[index] = data[index] - X.dot(beta)
+
+    residuals = regress_out(data.copy(), X, chunk_size=7)
+    assert residuals.dtype == np.float32
+    np.testing.assert_allclose(residuals, expected, atol=1e-4)
+    assert not residuals[0, 0, 0].any()
+
+    # only the voxels of the mask are processed
+    mask = np.zeros(data.shape[:3], dtype=bool)
+    mask[2:4] = True
+    residuals = regress_out(data.copy(), X, mask=mask)
+    np.testing.assert_allclose(residuals[mask], expected[mask], atol=1e-4)
+    np.testing.assert_array_equal(residuals[~mask], data[~mask])
+
+
+def _detrend(y, basis):
+    return regress_out(y[None, None, None, :].copy(), basis)[0, 0, 0]
+
+
+def test_detrending_basis():
+    rng = np.random.RandomState(0)
+    tp = 200
+    x = np.arange(tp, dtype=np.float64)
+    y = rng.randn(tp) + 1e-3 * (x - 80) ** 2 + 5e-6 * x ** 3 + 10 * np.sin(x / 30.0)
+
+    np.testing.assert_allclose(_detrend(y, compute_detrending_basis(tp, 'linear')), signal.detrend(y), atol=1e-9)
+
+    basis = compute_detrending_basis(tp, 'quadratic')
+    assert basis.shape == (tp, 3)
+    np.testing.assert_allclose(_detrend(y, basis), y - np.polyval(np.polyfit(x, y, 2), x), atol=1e-8)
+
+    # cubic B-splines with interior knots every 60 time points, centered on the series
+    basis = compute_detrending_basis(tp, 'cubic', spline_knot_interval=60)
+    knots = np.r_[[0] * 4, 30, 90, 150, [tp - 1] * 4]
+    assert basis.shape == (tp, len(knots) - 4)
+    np.testing.assert_allclose(_detrend(y, basis), y - make_lsq_spline(x, y, knots, k=3)(x), atol=1e-8)
+    # the cubic polynomials are in the span of the splines
+    np.testing.assert_allclose(_detrend(1e-6 * x ** 3 - x, basis), 0, atol=1e-8)
+
+
+def test_detrending_of_the_gm_voxels(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.RandomState(0)
+    tp = 80
+    data = (rng.randn(5, 4, 3, tp) + 1e-2 * np.arange(tp) ** 1.5).astype(np.float32)
+    gm = (rng.rand(5, 4, 3) > 0.5).astype(np.uint8)
+    nib.save(nib.Nifti1Image(data, np.eye(4)), 'fMRI.nii.gz')
+    nib.save(nib.Nifti1Image(gm, np.eye(4)), 'ROIv.nii.gz')
+
+    detrending = Detrending(in_file=os.path.abspath('fMRI.nii.gz'), gm_file=[os.path.abspath('ROIv.nii.gz')],
+                            mode='quadratic')
+    out_data = nib.load(detrending.run().outputs.out_file).get_fdata()
+
+    x = np.arange(tp)
+    for index in np.ndindex(gm.shape):
+        y = data[index].astype(np.float64)
+        expected = y - np.polyval(np.polyfit(x, y, 2), x) if gm[index] else y
+        np.testing.assert_allclose(out_data[index], expected, atol=1e-4)
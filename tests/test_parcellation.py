@@ -0,0 +1,93 @@
+import numpy as np
+
+from cmtklib.connectome import get_label_lookup_volume, map_multiscale_labels
+from cmtklib.parcellation import compute_label_mapping, compute_nearest_label_volume, \
+    compute_roi_averaging_matrix
+
+
+def test_label_mapping_of_nested_parcellations():
+    rng = np.random.RandomState(0)
+    fine = rng.randint(0, 21, size=(10, 9, 8))
+    fine[fine == 7] = 0
+    parent = np.r_[0, rng.randint(1, 5, size=20)]
+    coarse = parent[fine]
+
+    mapping = compute_label_mapping(fine, coarse)
+    assert mapping.shape == (21,)
+    np.testing.assert_array_equal(mapping[fine], coarse)
+
+    # with registration errors, each fine ROI is mapped to the coarse ROI it overlaps the most
+    noisy = coarse.copy()
+    flipped = rng.rand(*fine.shape) < 0.2
+    noisy[flipped] = rng.randint(0, 5, size=flipped.sum())
+    mapping = compute_label_mapping(fine, noisy)
+    for label in range(1, 21):
+        overlap = np.bincount(noisy[(fine == label) & (noisy > 0)], minlength=5)
+        if overlap.sum() == 0:
+            assert mapping[label] == 0
+        else:
+            assert overlap[mapping[label]] == overlap.max()
+    np.testing.assert_array_equal(mapping[1:], np.where(np.arange(1, 21) == 7, 0, parent[1:]))
+
+
+def test_hierarchical_scales_labels():
+    rng = np.random.RandomState(0)
+    fine = rng.randint(0, 31, size=(10, 9, 8)).astype(np.int16)
+    parents = [np.r_[0, rng.randint(1, 6, size=30)], np.r_[0, rng.randint(1, 13, size=30)]]
+    roi_datas = [parents[0][fine], parents[1][fine], fine]
+
+    label_volume, label_mappings = get_label_lookup_volume(roi_datas, hierarchical_scales=True)
+    assert label_volume.shape == fine.shape + (1,)
+    endpoints = rng.randint(0, 8, size=(50, 2, 3))
+    labels = label_volume[endpoints[..., 0], endpoints[..., 1], endpoints[..., 2]]
+    multiscale_labels = map_multiscale_labels(labels, label_mappings)
+
+    stacked, _ = get_label_lookup_volume(roi_datas)
+    np.testing.assert_array_equal(multiscale_labels, stacked[endpoints[..., 0], endpoints[..., 1], endpoints[..., 2]])
+
+
+def test_nearest_label_volume():
+    rng = np.random.RandomState(0)
+    roi_data = np.zeros((12, 10, 8), dtype=np.int16)
+    scattered = rng.rand(*roi_data.shape) < 0.02
+    roi_data[scattered] = rng.randint(1, 6, size=scattered.sum())
+    roi_data[2:4, 2:5, 1:3] = 3
+    roi_data[8:10, 6:9, 5:7] = 4
+    voxel_size = (1.0, 1.5, 2.5)
+    max_radius = 3.0
+
+    nearest = compute_nearest_label_volume(roi_data, voxel_size, max_radius)
+
+    roi_voxels = np.argwhere(roi_data > 0)
+    for index in np.ndindex(roi_data.shape):
+        if roi_data[index] > 0:
+            assert nearest[index] == roi_data[index]
+            continue
+        distances = np.sqrt((((roi_voxels - index) * voxel_size) ** 2).sum(axis=1))
+        if distances.min() > max_radius:
+            assert nearest[index] == 0
+        else:
+            # the label of one of the nearest ROI voxels (there can be ties)
+            nearest_labels = roi_data[tuple(roi_voxels[np.isclose(distances, distances.min())].T)]
+            assert nearest[index] in nearest_labels
+
+    np.testing.assert_array_equal(compute_nearest_label_volume(np.zeros((3, 3, 3)), voxel_size, 1), 0)
+
+
+def test_roi_averaging_matrix():
+    rng = np.random.RandomState(0)
+    n_rois = 6
+    roi_data = rng.randint(0, n_rois + 3, size=(7, 6, 5))
+    roi_data[roi_data == 2] = 0
+    data = rng.randn(7, 6, 5, 20)
+
+    voxels, averaging = compute_roi_averaging_matrix(roi_data, n_rois)
+    assert averaging.shape == (n_rois, len(voxels))
+    np.testing.assert_array_equal(voxels, np.flatnonzero((roi_data > 0) & (roi_data <= n_rois)))
+
+    ts = averaging.dot(data.reshape(-1, 20)[voxels])
+    for label in range(1, n_rois + 1):
+        if label == 2:
+            assert averaging[label - 1].nnz == 0
+        else:
+            np.testing.assert_allclose(ts[label - 1], data[roi_data == label].mean(axis=0), rtol=1e-5, atol=1e-6)
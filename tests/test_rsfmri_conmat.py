@@ -0,0 +1,242 @@
+import os
+
+import networkx as nx
+import nibabel as nib
+import nipype.interfaces.utility as util
+import nipype.pipeline.engine as pe
+import numpy as np
+import scipy.io as sio
+from scipy.linalg import logm
+
+from cmtklib.connectome import compute_rsfmri_scale_connectome, compute_connectivity_matrices, \
+    load_roi_averaging_matrix, extract_roi_timeseries
+from cmtklib.util import load_connectome_npz
+
+
+def _create_scale(dirname, n_rois=6, n_tp=40, seed=0):
+    """ Create a ROI volume, its GraphML node description and a 4D fMRI volume """
+    rng = np.random.RandomState(seed)
+    roi_data = rng.randint(0, n_rois + 1, size=(8, 7, 6)).astype(np.int16)
+    roi_fname = os.path.join(dirname, 'ROIv_scale1.nii.gz')
+    nib.save(nib.Nifti1Image(roi_data, np.eye(4)), roi_fname)
+
+    gp = nx.Graph()
+    for i in range(1, n_rois + 1):
+        gp.add_node(str(i), dn_correspondence_id=str(i), dn_name='roi%i' % i, dn_region='cortical')
+    graphml_fname = os.path.join(dirname, 'ROIv_scale1.graphml')
+    nx.write_graphml(gp, graphml_fname)
+
+    fdata = rng.randn(8, 7, 6, n_tp).astype(np.float32)
+    parval = {'number_of_regions': n_rois, 'node_information_graphml': graphml_fname}
+    return parval, roi_fname, roi_data, fdata
+
+
+def _baseline_graph(roi_data, fdata, n_rois):
+    """ Correlation graph as built by the loops over the ROI pairs of the original rsfmri_conmat """
+    ts = np.zeros((n_rois, fdata.shape[-1]), dtype=np.float32)
+    for i in range(1, n_rois + 1):
+        ts[i - 1, :] = fdata[roi_data == i].mean(axis=0)
+    G = nx.Graph()
+    G.add_nodes_from(range(1, n_rois + 1))
+    for i in range(n_rois):
+        for j in range(i, n_rois):
+            G.add_edge(i + 1, j + 1)
+            G[i + 1][j + 1]['corr'] = np.corrcoef(ts[i], ts[j])[0, 1]
+    return G
+
+
+def _read_tsv(fname):
+    with open(fname) as f:
+        return [line.rstrip('\n').split('\t') for line in f]
+
+
+def test_rsfmri_scale_connectome(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    parval, roi_fname, roi_data, fdata = _create_scale(str(tmp_path))
+
+    compute_rsfmri_scale_connectome('scale1', parval, roi_fname, 'Lausanne2008', fdata, None,
+                                    ['gPickle', 'mat'])
+
+    G_ref = _baseline_graph(roi_data, fdata, parval['number_of_regions'])
+    G = nx.read_gpickle('connectome_scale1.gpickle')
+    assert list(G.edges()) == list(G_ref.edges())
+    np.testing.assert_allclose([d['corr'] for _, _, d in G.edges(data=True)],
+                               [d['corr'] for _, _, d in G_ref.edges(data=True)], atol=1e-5)
+
+    tsv = _read_tsv('connectome_scale1.tsv')
+    assert tsv[0] == ['source', 'target', 'corr']
+    assert [row[:2] for row in tsv[1:]] == [[str(u), str(v)] for u, v in G_ref.edges()]
+    np.testing.assert_allclose([float(row[2]) for row in tsv[1:]],
+                               [d['corr'] for _, _, d in G_ref.edges(data=True)], atol=1e-5)
+
+    mat = sio.loadmat('connectome_scale1.mat')
+    np.testing.assert_allclose(mat['sc']['corr'][0, 0], nx.to_numpy_array(G_ref, weight='corr'), atol=1e-5)
+
+
+def test_rsfmri_scale_connectome_keeps_nan_correlations(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    parval, roi_fname, roi_data, fdata = _create_scale(str(tmp_path))
+    # the first ROI is empty (first edge undefined) and the third one has a constant signal
+    roi_data[roi_data == 1] = 0
+    nib.save(nib.Nifti1Image(roi_data, np.eye(4)), roi_fname)
+    fdata[roi_data == 3] = 1
+
+    compute_rsfmri_scale_connectome('scale1', parval, roi_fname, 'Lausanne2008', fdata, None,
+                                    ['gPickle', 'mat', 'npz'])
+
+    G_ref = _baseline_graph(roi_data, fdata, parval['number_of_regions'])
+    corr_ref = [d['corr'] for _, _, d in G_ref.edges(data=True)]
+    assert np.isnan(corr_ref[0])
+
+    G = nx.read_gpickle('connectome_scale1.gpickle')
+    np.testing.assert_allclose([d['corr'] for _, _, d in G.edges(data=True)], corr_ref, atol=1e-5)
+
+    tsv = _read_tsv('connectome_scale1.tsv')
+    assert tsv[0] == ['source', 'target', 'corr']
+    assert all(len(row) == 3 for row in tsv[1:])
+    np.testing.assert_allclose([float(row[2]) for row in tsv[1:]], corr_ref, atol=1e-5)
+
+    matrix_ref = nx.to_numpy_array(G_ref, weight='corr')
+    mat = sio.loadmat('connectome_scale1.mat')
+    np.testing.assert_allclose(mat['sc']['corr'][0, 0], matrix_ref, atol=1e-5)
+
+    np.testing.assert_allclose(load_connectome_npz('connectome_scale1.npz', 'corr'), matrix_ref, atol=1e-5)
+
+
+def _ledoit_wolf_corr(ts):
+    """ Ledoit-Wolf shrunk correlation matrix, as computed by ``sklearn.covariance.ledoit_wolf`` """
+    x = (ts - ts.mean(axis=1, keepdims=True)) / ts.std(axis=1, keepdims=True)
+    x = x.T.astype(np.float64)
+    n_samples, n_features = x.shape
+    emp_cov = x.T.dot(x) / n_samples
+    mu = np.trace(emp_cov) / n_features
+    beta_ = ((x ** 2).T.dot(x ** 2)).sum()
+    delta_ = (emp_cov ** 2).sum()
+    beta = (beta_ / n_samples - delta_) / (n_features * n_samples)
+    delta = (delta_ - 2 * mu * np.trace(emp_cov) + n_features * mu ** 2) / n_features
+    shrinkage = min(beta, delta) / delta
+    return (1 - shrinkage) * emp_cov + shrinkage * mu * np.eye(n_features)
+
+
+def test_connectivity_matrices():
+    rng = np.random.RandomState(0)
+    ts = rng.randn(8, 50).dot(rng.rand(50, 50)).astype(np.float32)
+    ts[5] = 2
+
+    matrices = compute_connectivity_matrices(ts, ['corr', 'partial_corr', 'tangent', 'cov'], np.float64)
+    valid = np.arange(8) != 5
+    shrunk = _ledoit_wolf_corr(ts[valid])
+    precision = np.linalg.inv(shrunk)
+    partial = -precision / np.sqrt(np.outer(np.diag(precision), np.diag(precision)))
+    np.fill_diagonal(partial, 1)
+
+    for metric in ('corr', 'partial_corr', 'tangent'):
+        assert np.isnan(matrices[metric][5]).all() and np.isnan(matrices[metric][:, 5]).all()
+    np.testing.assert_allclose(matrices['cov'], np.cov(ts, bias=True), atol=1e-8)
+    np.testing.assert_allclose(matrices['corr'][np.ix_(valid, valid)], np.corrcoef(ts[valid]), atol=1e-8)
+    np.testing.assert_allclose(matrices['partial_corr'][np.ix_(valid, valid)], partial, atol=1e-8)
+    np.testing.assert_allclose(matrices['tangent'][np.ix_(valid, valid)], logm(shrunk).real, atol=1e-6)
+
+    corr32 = compute_connectivity_matrices(ts, ['corr'])['corr']
+    assert corr32.dtype == np.float32
+    np.testing.assert_allclose(corr32, matrices['corr'], atol=1e-5)
+
+
+def test_rsfmri_scale_connectome_metrics_agree_across_outputs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    metrics = ['corr', 'partial_corr', 'cov']
+    parval, roi_fname, roi_data, fdata = _create_scale(str(tmp_path))
+    roi_data[roi_data == 1] = 0
+    nib.save(nib.Nifti1Image(roi_data, np.eye(4)), roi_fname)
+
+    compute_rsfmri_scale_connectome('scale1', parval, roi_fname, 'Lausanne2008', fdata, None,
+                                    ['gPickle', 'mat'], connectivity_metrics=metrics)
+
+    ts = np.load('averageTimeseries_scale1.npy')
+    matrices = compute_connectivity_matrices(ts, metrics)
+    rows, cols = np.triu_indices(parval['number_of_regions'])
+    assert np.isnan(matrices['partial_corr'][0]).all()
+
+    tsv = _read_tsv('connectome_scale1.tsv')
+    assert tsv[0] == ['source', 'target'] + metrics
+    assert [row[:2] for row in tsv[1:]] == [[str(u + 1), str(v + 1)] for u, v in zip(rows, cols)]
+    mat = sio.loadmat('connectome_scale1.mat')
+    G = nx.read_gpickle('connectome_scale1.gpickle')
+    for k, metric in enumerate(metrics):
+        np.testing.assert_allclose([float(row[2 + k]) for row in tsv[1:]], matrices[metric][rows, cols], atol=1e-6)
+        np.testing.assert_allclose(mat['sc'][metric][0, 0], matrices[metric], atol=1e-6)
+        np.testing.assert_allclose([G[u + 1][v + 1][metric] for u, v in zip(rows, cols)],
+                                   matrices[metric][rows, cols], atol=1e-6)
+
+
+def test_rsfmri_scale_connectome_skips_too_long_sliding_windows(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    parval, roi_fname, roi_data, fdata = _create_scale(str(tmp_path), n_tp=40)
+
+    # the default window (60 time points) is longer than the series
+    compute_rsfmri_scale_connectome('scale1', parval, roi_fname, 'Lausanne2008', fdata, None, ['gPickle'],
+                                    dynamic_fc=True)
+    assert os.path.exists('connectome_scale1.gpickle')
+    assert not os.path.exists('dynamic_connectome_scale1.npz')
+
+    compute_rsfmri_scale_connectome('scale1', parval, roi_fname, 'Lausanne2008', fdata, None, ['gPickle'],
+                                    dynamic_fc=True, dfc_window_length=40, dfc_step=5)
+    dfc = np.load('dynamic_connectome_scale1.npz')
+    n_rois = parval['number_of_regions']
+    assert dfc['fc'].shape == (1, n_rois * (n_rois - 1) // 2)
+
+
+def test_rsfmri_conmat_selected_estimators(tmp_path, monkeypatch):
+    from cmp.stages.connectome.fmri_connectome import ConnectomeStage
+    from cmtklib.connectome import rsfmri_conmat
+
+    monkeypatch.chdir(tmp_path)
+    metrics = ['partial_corr', 'tangent', 'cov']
+    parval, roi_fname, roi_data, fdata = _create_scale(str(tmp_path), n_tp=60)
+    func_fname = str(tmp_path / 'func.nii.gz')
+    nib.save(nib.Nifti1Image(fdata, np.eye(4)), func_fname)
+
+    stage = ConnectomeStage(str(tmp_path), str(tmp_path))
+    stage.config.connectivity_metrics = metrics
+    flow = pe.Workflow(name=stage.name)
+    stage.create_workflow(flow, pe.Node(util.IdentityInterface(fields=stage.inputs), name="inputnode"),
+                          pe.Node(util.IdentityInterface(fields=stage.outputs), name="outputnode"))
+    assert flow.get_node('compute_matrice').inputs.connectivity_metrics == metrics
+
+    conmat = rsfmri_conmat(func_file=func_fname, roi_volumes=[roi_fname], parcellation_scheme='Custom',
+                           atlas_info={'scale1': parval}, output_types=['gPickle'],
+                           connectivity_metrics=metrics)
+    conmat.run()
+
+    # each estimator is the same as when computed alone
+    ts = np.load('averageTimeseries_scale1.npy')
+    G = nx.read_gpickle('connectome_scale1.gpickle')
+    rows, cols = np.triu_indices(parval['number_of_regions'])
+    for u, v, d in G.edges(data=True):
+        assert sorted(d) == sorted(metrics)
+    for metric in metrics:
+        matrix = compute_connectivity_matrices(ts, [metric])[metric]
+        np.testing.assert_allclose([G[u + 1][v + 1][metric] for u, v in zip(rows, cols)], matrix[rows, cols],
+                                   atol=1e-6)
+
+
+def test_roi_timeseries_with_cached_averaging_matrix(tmp_path):
+    parval, roi_fname, roi_data, fdata = _create_scale(str(tmp_path))
+    n_rois = parval['number_of_regions']
+    roi_data[roi_data == 2] = 0
+    nib.save(nib.Nifti1Image(roi_data, np.eye(4)), roi_fname)
+    ts_ref = np.array([fdata[roi_data == i].mean(axis=0) if i != 2 else np.full(fdata.shape[-1], np.nan)
+                       for i in range(1, n_rois + 1)])
+
+    ts = extract_roi_timeseries(fdata, *load_roi_averaging_matrix(roi_fname, n_rois))
+    assert os.path.exists(str(tmp_path / 'ROIv_scale1_averaging.npz'))
+    np.testing.assert_allclose(ts, ts_ref, atol=1e-5)
+    # the cached matrix is reused
+    np.testing.assert_array_equal(extract_roi_timeseries(fdata, *load_roi_averaging_matrix(roi_fname, n_rois)), ts)
+
+    # the cached matrix is recomputed when the ROI volume changes
+    roi_data[roi_data == 3] = 2
+    nib.save(nib.Nifti1Image(roi_data, np.eye(4)), roi_fname)
+    ts = extract_roi_timeseries(fdata, *load_roi_averaging_matrix(roi_fname, n_rois))
+    np.testing.assert_allclose(ts[1], fdata[roi_data == 2].mean(axis=0), atol=1e-5)
+    assert np.isnan(ts[2]).all()
@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+from cmtklib.streamlines import (streamlines_to_buffer, compute_lengths, compute_cumulative_lengths,
+                                 compute_mean_curvatures, compress_streamlines)
+from cmtklib.util import length, mean_curvature
+
+
+def _random_streamlines(layout, seed=0):
+    """ Streamlines with the number of points given by layout (0 for an empty streamline) """
+    rng = np.random.RandomState(seed)
+    return [np.cumsum(rng.rand(n, 3), axis=0) for n in layout]
+
+
+def test_streamline_measures_with_empty_streamlines():
+    # empty streamlines at the start, in the middle and at the end of the buffer
+    for layout in ([0, 5, 4], [5, 0, 4], [5, 4, 0], [0, 5, 0, 0, 3, 0], [5, 0]):
+        streamlines = _random_streamlines(layout)
+        points, offsets = streamlines_to_buffer(streamlines)
+
+        lengths = compute_lengths(points, offsets)
+        assert lengths.shape == (len(layout),)
+        np.testing.assert_allclose(lengths, [length(s) if len(s) > 1 else 0 for s in streamlines])
+
+        cumulative = compute_cumulative_lengths(points, offsets)
+        assert cumulative.shape == (len(points),)
+        np.testing.assert_allclose(cumulative[offsets[1:][np.diff(offsets) > 0] - 1],
+                                   [length(s) for s in streamlines if len(s) > 0])
+
+        curvatures = compute_mean_curvatures(points, offsets)
+        for s, c in zip(streamlines, curvatures):
+            if len(s) > 2:
+                np.testing.assert_allclose(c, mean_curvature(s))
+            elif len(s) == 0:
+                assert np.isnan(c)
+
+
+def test_lengths_by_chunks_of_streamlines():
+    streamlines = _random_streamlines([0, 6, 2, 0, 1, 7, 3, 0, 5, 0], seed=1)
+    points, offsets = streamlines_to_buffer(streamlines)
+    np.testing.assert_allclose(compute_lengths(points, offsets, number_of_threads=2),
+                               compute_lengths(points, offsets))
+
+
+def _segment_distances(points, a, b):
+    """ Distances of points to the segment [a, b] """
+    ab = b - a
+    t = np.clip((points - a).dot(ab) / max(ab.dot(ab), np.finfo(float).tiny), 0, 1)
+    return np.sqrt(((points - a - t[:, None] * ab) ** 2).sum(axis=1))
+
+
+def test_compression_error_bound():
+    rng = np.random.RandomState(0)
+    streamlines = [np.cumsum(0.1 * rng.randn(n, 3) + [0.5, 0, 0], axis=0) for n in (0, 1, 2, 3, 40, 200)]
+    tol_error, max_segment_length = 0.2, 4
+
+    compressed, masks = compress_streamlines(streamlines, tol_error, max_segment_length, number_of_threads=2)
+    assert sum(len(c) for c in compressed) < sum(len(s) for s in streamlines)
+    for s, c, m in zip(streamlines, compressed, masks):
+        np.testing.assert_array_equal(c, s[m])
+        if len(s) == 0:
+            continue
+        # the extremities are kept
+        assert m[0] and m[-1]
+        kept = np.flatnonzero(m)
+        for first, last in zip(kept[:-1], kept[1:]):
+            if last - first > 1:
+                assert _segment_distances(s[first + 1:last], s[first], s[last]).max() <= tol_error
+                assert np.linalg.norm(s[last] - s[first]) <= max_segment_length
+
+
+def test_compression_matches_dipy():
+    streamlinespeed = pytest.importorskip('dipy.tracking.streamlinespeed')
+    rng = np.random.RandomState(1)
+    streamlines = [np.cumsum(0.2 * rng.randn(n, 3) + [0.3, 0.1, 0], axis=0).astype(np.float32)
+                   for n in (3, 25, 100, 300)]
+
+    compressed, _ = compress_streamlines(streamlines, 0.1, 10)
+    for c, c_ref in zip(compressed, streamlinespeed.compress_streamlines(streamlines, 0.1, 10)):
+        np.testing.assert_array_equal(c, c_ref)